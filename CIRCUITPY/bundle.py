@@ -0,0 +1,285 @@
+"""Packed macro profile bundle.
+
+build_macros.py validates the files in /macros on the host and packs them
+into a single file, so the MacroPad can boot without importing any of
+them. All numbers are big endian.
+
+    header     "MPB1" | version (1) | profile count (2) | directory size (4)
+    directory  per profile: offset (4) | length (2) | key | platform |
+               appName | name
+    records    per profile: SLOT_COUNT slots | encoder
+
+A slot is a present flag (1) and, when present, color (3) | flags (1) |
+label | op count (1) | ops. FLAG_REPEAT marks a macro that repeats while
+its key is held, FLAG_HOST one whose text the server types when it can.
+An op is OP_PRESS or OP_RELEASE followed by a keycode (1), OP_DELAY
+followed by milliseconds (2), or OP_TEXT followed by a long string.
+Strings are a length (1) and UTF-8 bytes. Long strings use a length of 2
+bytes.
+
+The encoder is an action (1), 0 when the app leaves it to the default
+profile, | flags (1) | increment keys | decrement keys, where keys are a
+count (1) and keycodes (1 each). Version 1 records have no encoder.
+
+This file runs on the device as well as the host.
+"""
+import struct
+
+MAGIC = b"MPB1"
+BUNDLE_VERSION = 2
+SLOT_COUNT = 12
+HEADER = ">4sBHI"
+HEADER_SIZE = struct.calcsize(HEADER)
+
+OP_PRESS = 1
+OP_RELEASE = 2
+OP_DELAY = 3
+OP_TEXT = 4
+
+FLAG_REPEAT = 0x01
+FLAG_HOST = 0x02
+MACRO_OPTIONS = ("repeat", "host")
+"""Keys allowed in the options dict a macro can have after its sequence"""
+
+ENCODER_VOLUME = 1
+ENCODER_SCROLL = 2
+ENCODER_KEYS = 3
+ENCODER_ACTIONS = ("volume", "scroll", "keys")
+"""Encoder actions by name, ENCODER_VOLUME is the first"""
+ENCODER_OPTIONS = ("action", "increment", "decrement", "accelerate")
+"""Keys allowed in an app's encoder dict"""
+ENCODER_ACCELERATE = 0x01
+
+def _PackString(value: str, out: bytearray, long=False):
+    value = value.encode("utf-8")
+    if long:
+        out.extend(struct.pack(">H", len(value)))
+    elif len(value) > 0xFF:
+        raise ValueError(f"'{value}' is too long")
+    else:
+        out.append(len(value))
+    out.extend(value)
+
+def _ReadString(data, offset: int, long=False):
+    if long:
+        size = struct.unpack_from(">H", data, offset)[0]
+        offset += 2
+    else:
+        size = data[offset]
+        offset += 1
+    end = offset + size
+    return bytes(data[offset:end]).decode("utf-8"), end
+
+def PackSequence(sequence) -> bytes:
+    """Pack a macro key sequence as ops"""
+    if isinstance(sequence, str):
+        # A bare string is typed as is
+        sequence = [sequence] if sequence else []
+    out = bytearray()
+    count = 0
+    for item in sequence or ():
+        if isinstance(item, bool):
+            raise TypeError(f"{item} is not a keycode")
+        if isinstance(item, int):
+            if not 0 < abs(item) <= 0xFF:
+                raise ValueError(f"{item} is not a keycode")
+            out.append(OP_PRESS if item > 0 else OP_RELEASE)
+            out.append(abs(item))
+        elif isinstance(item, float):
+            if not 0 <= item <= 0xFFFF / 1000:
+                raise ValueError(f"Delay {item} is out of range")
+            out.append(OP_DELAY)
+            out.extend(struct.pack(">H", round(item * 1000)))
+        elif isinstance(item, str):
+            out.append(OP_TEXT)
+            _PackString(item, out, long=True)
+        else:
+            raise TypeError(f"{item!r} is not a keycode, delay or string")
+        count += 1
+    if count > 0xFF:
+        raise ValueError("Too many steps")
+    return bytes([count]) + bytes(out)
+
+def MacroFlags(macro) -> int:
+    """Flags byte for a (color, label, sequence[, options]) macro"""
+    options = macro[3] if len(macro) > 3 else None
+    flags = 0
+    if options and options.get("repeat"):
+        flags |= FLAG_REPEAT
+    if options and options.get("host"):
+        flags |= FLAG_HOST
+    return flags
+
+def PackKeys(keys) -> bytes:
+    """Pack a list of keycodes pressed together"""
+    keys = list(keys or ())
+    for key in keys:
+        if isinstance(key, bool) or not isinstance(key, int) or not 0 < key <= 0xFF:
+            raise ValueError(f"{key!r} is not a keycode")
+    if len(keys) > 6:
+        raise ValueError("At most 6 keys can be pressed together")
+    return bytes([len(keys)] + keys)
+
+def PackEncoder(encoder) -> bytes:
+    """Pack an app's encoder dict, or None to use the default profile's"""
+    if encoder is None:
+        return bytes(4)
+    action = encoder.get("action", "volume")
+    if action not in ENCODER_ACTIONS:
+        raise ValueError(f"Unknown encoder action {action!r}")
+    flags = ENCODER_ACCELERATE if encoder.get("accelerate", True) else 0
+    return (
+        bytes([ENCODER_ACTIONS.index(action) + 1, flags])
+        + PackKeys(encoder.get("increment"))
+        + PackKeys(encoder.get("decrement"))
+    )
+
+def PackProfile(app: dict) -> bytes:
+    """Pack the macros and encoder of an app dict into a record"""
+    out = bytearray()
+    macros = list(app["macros"])[:SLOT_COUNT]
+    macros += [None] * (SLOT_COUNT - len(macros))
+    for macro in macros:
+        if macro is None:
+            out.append(0)
+            continue
+        color, label, sequence = macro[:3]
+        out.append(1)
+        out.extend(struct.pack(">I", color)[1:])
+        out.append(MacroFlags(macro))
+        _PackString(label, out)
+        out.extend(PackSequence(sequence))
+    out.extend(PackEncoder(app.get("encoder")))
+    return bytes(out)
+
+def PackBundle(profiles: list) -> bytes:
+    """Pack (appKey, app dict) pairs into a bundle"""
+    records = [PackProfile(app) for _, app in profiles]
+    directory = bytearray()
+    for (appKey, app), record in zip(profiles, records):
+        directory.extend(b"\0\0\0\0")
+        directory.extend(struct.pack(">H", len(record)))
+        for value in (appKey, app["platform"], app["appName"], app["name"]):
+            _PackString(value, directory)
+    header = struct.pack(
+        HEADER, MAGIC, BUNDLE_VERSION, len(profiles), len(directory)
+    )
+    offset = len(header) + len(directory)
+    position = 0
+    for record in records:
+        struct.pack_into(">I", directory, position, offset)
+        offset += len(record)
+        position += 6
+        for _ in range(4):
+            position += 1 + directory[position]
+    return header + bytes(directory) + b"".join(records)
+
+def UnpackSequence(data, offset: int):
+    """Turn packed ops back into a macro key sequence"""
+    count = data[offset]
+    offset += 1
+    sequence = []
+    for _ in range(count):
+        op = data[offset]
+        offset += 1
+        if op == OP_PRESS:
+            sequence.append(data[offset])
+            offset += 1
+        elif op == OP_RELEASE:
+            sequence.append(-data[offset])
+            offset += 1
+        elif op == OP_DELAY:
+            sequence.append(struct.unpack_from(">H", data, offset)[0] / 1000)
+            offset += 2
+        elif op == OP_TEXT:
+            text, offset = _ReadString(data, offset, long=True)
+            sequence.append(text)
+        else:
+            raise ValueError(f"Unknown op {op}")
+    return sequence, offset
+
+def UnpackEncoder(data, offset: int):
+    """Turn a packed encoder back into an encoder dict, None for the
+    default profile's"""
+    action = data[offset]
+    flags = data[offset + 1]
+    offset += 2
+    keys = []
+    for _ in range(2):
+        count = data[offset]
+        keys.append(list(data[offset + 1:offset + 1 + count]))
+        offset += 1 + count
+    if not action:
+        return None, offset
+    return {
+        "action": ENCODER_ACTIONS[action - 1],
+        "increment": keys[0],
+        "decrement": keys[1],
+        "accelerate": bool(flags & ENCODER_ACCELERATE),
+    }, offset
+
+def UnpackProfile(data, header, version=BUNDLE_VERSION) -> dict:
+    """Turn a record back into an app dict. header is (platform, appName,
+    name)"""
+    platform, appName, name = header
+    macros = []
+    offset = 0
+    for _ in range(SLOT_COUNT):
+        present = data[offset]
+        offset += 1
+        if not present:
+            macros.append(None)
+            continue
+        color = (data[offset] << 16) | (data[offset + 1] << 8) | data[offset + 2]
+        flags = data[offset + 3]
+        label, offset = _ReadString(data, offset + 4)
+        sequence, offset = UnpackSequence(data, offset)
+        if flags:
+            options = {
+                "repeat": bool(flags & FLAG_REPEAT),
+                "host": bool(flags & FLAG_HOST),
+            }
+            macros.append((color, label, sequence, options))
+        else:
+            macros.append((color, label, sequence))
+    app = {
+        "name": name,
+        "appName": appName,
+        "platform": platform,
+        "macros": macros,
+    }
+    if version >= 2:
+        app["encoder"] = UnpackEncoder(data, offset)[0]
+    return app
+
+class BundleReader:
+    """Read profiles out of a bundle file by seeking to their record.
+    Bundles of older versions can still be read"""
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        magic, version, count, size = struct.unpack(
+            HEADER, self.file.read(HEADER_SIZE)
+        )
+        if magic != MAGIC or not 1 <= version <= BUNDLE_VERSION:
+            self.file.close()
+            raise ValueError(f"{path} is not a version {BUNDLE_VERSION} bundle")
+        self.version = version
+        self.index = {}
+        """appKey: (offset, length, platform, appName, name)"""
+        directory = self.file.read(size)
+        offset = 0
+        for _ in range(count):
+            position, length = struct.unpack_from(">IH", directory, offset)
+            appKey, offset = _ReadString(directory, offset + 6)
+            platform, offset = _ReadString(directory, offset)
+            appName, offset = _ReadString(directory, offset)
+            name, offset = _ReadString(directory, offset)
+            self.index[appKey] = (position, length, platform, appName, name)
+
+    def Read(self, appKey: str) -> dict:
+        """Return the app dict stored for appKey"""
+        position, length, platform, appName, name = self.index[appKey]
+        self.file.seek(position)
+        return UnpackProfile(
+            self.file.read(length), (platform, appName, name), self.version
+        )
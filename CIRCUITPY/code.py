@@ -1,29 +1,181 @@
 from adafruit_macropad import MacroPad
 from adafruit_display_text import label
 from adafruit_display_shapes.rect import Rect
+from array import array
 import asyncio
+import binascii
+import bundle
 import displayio
-import json
+import gc
+import math
+import microcontroller
 import os
 from rainbowio import colorwheel
+import struct
 import terminalio
 import time
+import sys
 import usb_cdc
+import wire
 
 MACRO_FOLDER = "/macros"
+MACRO_BUNDLE = "/macros.bin"
+"""Written by build_macros.py on the host. Used when it is newer than
+every file in MACRO_FOLDER"""
 DEFAULT_APP = "mac-Default"
+PROFILE_CACHE_SIZE = 4
+"""Profiles kept in RAM besides the default one"""
+MACRO_ERRORS = (
+    AttributeError,
+    ImportError,
+    IndexError,
+    KeyError,
+    NameError,
+    OSError,
+    SyntaxError,
+    TypeError,
+    ValueError,
+)
+SWITCH_TIMEOUT = 60
+REPEAT_DELAY = 0.5
+"""Seconds a repeating macro's key is held before it plays again"""
+REPEAT_INTERVAL = 0.1
+TEXT_CHUNK = 8
+"""Characters typed before letting the other tasks run"""
+INJECT_CHUNK = 900
+"""Characters per message when the server types for us, so each fits a
+frame. The server joins them and types the text in one go"""
+INJECT_TIMEOUT = 5
+"""Seconds to wait for the server to finish typing before going on with
+the macro"""
+FRAME_TIME = 1 / 30
+"""Shortest time between two display refreshes"""
+LAYOUT_CACHE_SIZE = 4
+"""Sets of key labels kept for recently shown layouts"""
+SWITCH_LABELS = ("<", "", ">") + ("",) * 9
+LED_FPS = 30
+"""Most LED frames drawn a second while an effect runs"""
+PRESSED_COLOR = 0xAAAAAA
+IDLE_POLL_INTERVAL = 0.05
+"""Seconds between polls of the keys, encoder and serial port while idle"""
+ENCODER_INTERVAL = 0.02
+"""Seconds between batches of encoder reports"""
+ENCODER_ACCEL_RATE = 10
+"""Detents per second the encoder can turn before it speeds up"""
+ENCODER_ACCEL = 0.1
+"""Extra steps per detent for each detent per second above the rate"""
+ENCODER_MAX_GAIN = 6
+BREATHE_COLOR = 0x202040
+WARM_MAGIC = b"MPW"
+WARM_VERSION = 1
+WARM_HEADER = ">3sBBH"
+"""magic | version | flags (1) | profile index checksum (2)"""
+WARM_AUTO_SWITCH = 0x01
+WARM_SAVE_DELAY = 5
+"""Seconds a profile picked by hand stays before it is written to NVM"""
+WARM_WRITE_INTERVAL = 300
+"""Fewest seconds between writes of a profile the server switched to, as
+every write wears the flash"""
 CLIENT_VERSION = "2022-02.0"
-MESSAGING_VERSION = "1"
+MESSAGING_VERSION = str(wire.PROTOCOL_VERSION)
+TASK_STATS = False
+"""Time every step of the main coroutines. Nothing is wrapped when False"""
+
+try:
+    from types import coroutine as _Coroutine
+except ImportError:
+    # CircuitPython coroutines are generators already
+    def _Coroutine(function):
+        return function
 
 class ServerData:
     """Class to store incoming serial data from the host device"""
     def __init__(self):
-        self.name = ""
-        self.platform = ""
-        self.buffer = b""
+        self.profile = ""
+        self.decoder = wire.FrameDecoder()
+        self.protocol = 1
         self.connected = False
         self.readTime = None
         self.updated = False
+        self.updatedEvent = asyncio.Event()
+        self.taskStats = []
+        self.leds = None
+        self.reportKeys = False
+        self.injector = None
+        self.injectId = 0
+        """Number of the newest text handed to the server to type"""
+        self.injected = 0
+        """Number of the newest text the server has typed"""
+        self.injectedEvent = asyncio.Event()
+        self.idle = False
+        self.idleEvent = asyncio.Event()
+        self.seq = 0
+        """Sequence number of the newest state message applied"""
+        self.digestEvent = asyncio.Event()
+        self.transfer = None
+        self.dropped = None
+        """Key of the profile whose remaining chunks are being ignored"""
+        self.reloads = []
+        self.reloadEvent = asyncio.Event()
+
+class ProfileTransfer:
+    """A profile record arriving from the server in chunks"""
+    def __init__(self, chunk: dict):
+        self.key = chunk["key"]
+        self.header = chunk["header"]
+        self.parts = chunk["parts"]
+        self.checksum = chunk["checksum"]
+        self.data = bytearray()
+        self.next = 0
+
+class TaskStats:
+    """Loop timing for one coroutine. Times are in nanoseconds"""
+    def __init__(self, name: str):
+        self.name = name
+        self.iterations = 0
+        self.totalTime = 0
+        self.maxTime = 0
+        self.lastRun = None
+
+    def Report(self, now: int) -> list:
+        """[name, iterations, total us, max us, us since it last ran]"""
+        since = None if self.lastRun is None else (now - self.lastRun) // 1000
+        return [
+            self.name,
+            self.iterations,
+            self.totalTime // 1000,
+            self.maxTime // 1000,
+            since,
+        ]
+
+@_Coroutine
+def Profiled(coro, stats: TaskStats):
+    """Drive coro one step at a time, from resuming to its next await, and
+    record how long each step took"""
+    value = None
+    error = None
+    while True:
+        start = time.monotonic_ns()
+        try:
+            if error is None:
+                yielded = coro.send(value)
+            else:
+                yielded = coro.throw(error)
+        except StopIteration as e:
+            return e.value
+        end = time.monotonic_ns()
+        elapsed = end - start
+        stats.iterations += 1
+        stats.totalTime += elapsed
+        if elapsed > stats.maxTime:
+            stats.maxTime = elapsed
+        stats.lastRun = end
+        try:
+            value = yield yielded
+            error = None
+        except BaseException as e:
+            value = None
+            error = e
 
 class MacropadMode:
     """Defines modes of the macropad"""
@@ -39,6 +191,617 @@ class MacropadMode:
     MEETING = 4
     """Mode for active online meeting"""
 
+MODE_EFFECTS = {
+    MacropadMode.SWITCH: "rainbow",
+    MacropadMode.MEETING: "pulse",
+}
+"""LED effect for each mode. Modes left out show the app colors, except
+IDLE, which turns the LEDs off"""
+
+class Keymap:
+    """A profile compiled for the key handlers.
+
+    Slots left empty in the profile are filled from the default keymap, so
+    every one of the 12 slots is resolved here, once. ops[slot] holds
+    (op, argument) pairs using the bundle OP_ codes. The argument of
+    OP_TEXT is an index into texts[slot]. releases[slot] holds the keys
+    still to let go of when the key comes back up. flags[slot] is the
+    bundle FLAG_ byte.
+
+    The encoder does one of the bundle ENCODER_ actions, with
+    encoderFlags, sending the encoderIncrement keycodes for a step
+    clockwise and encoderDecrement for one back with ENCODER_KEYS.
+    """
+    def __init__(self, name: str, platform: str):
+        self.name = name
+        self.platform = platform
+        self.colors = array("L", [0] * 12)
+        self.labels = [""] * 12
+        self.ops = [array("H")] * 12
+        self.texts = [()] * 12
+        self.releases = [array("B")] * 12
+        self.flags = bytearray(12)
+        self.encoderAction = bundle.ENCODER_VOLUME
+        self.encoderFlags = bundle.ENCODER_ACCELERATE
+        self.encoderIncrement = ()
+        self.encoderDecrement = ()
+
+def CompileKeymap(app: dict, default=None) -> Keymap:
+    """Turn an app dict into a Keymap, taking empty slots from default"""
+    keymap = Keymap(app["name"], app["platform"])
+    macros = app["macros"]
+    for slot in range(12):
+        macro = macros[slot] if slot < len(macros) else None
+        if macro is None:
+            if default is not None:
+                keymap.colors[slot] = default.colors[slot]
+                keymap.labels[slot] = default.labels[slot]
+                keymap.ops[slot] = default.ops[slot]
+                keymap.texts[slot] = default.texts[slot]
+                keymap.releases[slot] = default.releases[slot]
+                keymap.flags[slot] = default.flags[slot]
+            continue
+        color, text, sequence = macro[:3]
+        keymap.colors[slot] = color
+        keymap.labels[slot] = text
+        keymap.flags[slot] = bundle.MacroFlags(macro)
+        if isinstance(sequence, str):
+            sequence = [sequence] if sequence else []
+        ops = array("H")
+        texts = []
+        releases = array("B")
+        for item in sequence:
+            if isinstance(item, int):
+                if item >= 0:
+                    ops.append(bundle.OP_PRESS)
+                    ops.append(item)
+                    releases.append(item)
+                else:
+                    ops.append(bundle.OP_RELEASE)
+                    ops.append(-item)
+            elif isinstance(item, float):
+                ops.append(bundle.OP_DELAY)
+                ops.append(min(round(item * 1000), 0xFFFF))
+            elif isinstance(item, str):
+                ops.append(bundle.OP_TEXT)
+                ops.append(len(texts))
+                texts.append(item)
+            else:
+                print(f"{app['name']} key {slot + 1}: skipped {item!r}")
+        keymap.ops[slot] = ops
+        keymap.texts[slot] = tuple(texts)
+        keymap.releases[slot] = releases
+    encoder = app.get("encoder")
+    if encoder is not None:
+        keymap.encoderAction = bundle.ENCODER_ACTIONS.index(
+            encoder.get("action", "volume")
+        ) + 1
+        keymap.encoderFlags = (
+            bundle.ENCODER_ACCELERATE if encoder.get("accelerate", True) else 0
+        )
+        keymap.encoderIncrement = tuple(encoder.get("increment") or ())
+        keymap.encoderDecrement = tuple(encoder.get("decrement") or ())
+    elif default is not None:
+        keymap.encoderAction = default.encoderAction
+        keymap.encoderFlags = default.encoderFlags
+        keymap.encoderIncrement = default.encoderIncrement
+        keymap.encoderDecrement = default.encoderDecrement
+    return keymap
+
+def ReadMacroHeader(path: str) -> dict:
+    """Pull name, appName and platform out of a macro file without
+    importing it. Each has to be on its own line as a quoted key and value,
+    the way the bundled macro files are written."""
+    header = {}
+    with open(path, "r") as macroFile:
+        for line in macroFile:
+            line = line.strip()
+            quote = line[:1]
+            if quote not in ("'", '"'):
+                continue
+            for key in ("name", "appName", "platform"):
+                if key in header or not line.startswith(f"{quote}{key}{quote}"):
+                    continue
+                value = line[len(key) + 2:].lstrip()[1:].lstrip()
+                header[key] = value[1:value.index(value[0], 1)]
+            if len(header) == 3:
+                return header
+    raise KeyError("app name, appName or platform missing")
+
+class ProfileCache:
+    """Index of every macro profile, with only the most recently used ones
+    held in RAM.
+
+    The index maps an app key to (filename, platform, appName, name) and is
+    all that is built at boot. A profile is read from the bundle, or
+    imported from its file when filename is set, the first time it is asked
+    for, and compiled into a Keymap on top of the default profile. The
+    least recently used one is dropped once more than `size` are loaded.
+    Pinned profiles are never dropped. Records streamed from the host by
+    Replace stay in `streamed` and take the place of the stored profile.
+    A profile that fails to load stays in the index, so it can still be
+    listed and named, but is in `failed` and never tried again.
+    """
+    def __init__(self, size=PROFILE_CACHE_SIZE, default=DEFAULT_APP):
+        self.size = size
+        self.default = default
+        self.bundle = None
+        self.index = {}
+        self.profiles = {}
+        self.order = []
+        self.pinned = set()
+        self.streamed = {}
+        self.failed = set()
+
+    def __contains__(self, appKey: str) -> bool:
+        return appKey in self.index or appKey in self.profiles
+
+    def __getitem__(self, appKey: str) -> Keymap:
+        return self.Get(appKey)
+
+    def Add(self, appKey: str, filename: str, header: dict):
+        self.index[appKey] = (
+            filename, header["platform"], header["appName"], header["name"]
+        )
+
+    def UseBundle(self, reader: bundle.BundleReader):
+        """Index every profile in a bundle"""
+        self.bundle = reader
+        for appKey, entry in reader.index.items():
+            self.index[appKey] = (None, entry[2], entry[3], entry[4])
+
+    def Pin(self, appKey: str, app=None):
+        """Keep a profile resident, optionally one with no macro file"""
+        self.pinned.add(appKey)
+        if app is not None:
+            self.profiles[appKey] = CompileKeymap(app, self.profiles.get(self.default))
+        elif appKey in self.index:
+            self.Get(appKey)
+
+    def Name(self, appKey: str) -> str:
+        if appKey in self.index:
+            return self.index[appKey][3]
+        return self.profiles[appKey].name
+
+    def Platform(self, appKey: str) -> str:
+        if appKey in self.index:
+            return self.index[appKey][1]
+        return self.profiles[appKey].platform
+
+    def Get(self, appKey: str):
+        """Return the Keymap for appKey, loading it if needed. None if it
+        isn't known or fails to load."""
+        keymap = self.profiles.get(appKey)
+        if keymap is not None:
+            if appKey not in self.pinned and self.order[-1] != appKey:
+                self.order.remove(appKey)
+                self.order.append(appKey)
+            return keymap
+        if appKey not in self.index or appKey in self.failed:
+            return None
+        filename, platform, appName, name = self.index[appKey]
+        try:
+            if appKey in self.streamed:
+                app = bundle.UnpackProfile(
+                    self.streamed[appKey], (platform, appName, name)
+                )
+            elif filename is None:
+                app = self.bundle.Read(appKey)
+            else:
+                app = self._Import(filename)
+            keymap = CompileKeymap(app, self.profiles.get(self.default))
+        except MACRO_ERRORS as e:
+            print(f"Error Loading Macros: {filename or appKey}\n{e}")
+            self.failed.add(appKey)
+            return None
+        self._Store(appKey, keymap)
+        return keymap
+
+    @staticmethod
+    def _Import(filename: str) -> dict:
+        moduleName = f"{MACRO_FOLDER}/{filename[:-3]}"
+        try:
+            return __import__(moduleName).app
+        finally:
+            # Only the keymap is kept, don't let the module hold the app
+            sys.modules.pop(moduleName, None)
+
+    def _Store(self, appKey: str, keymap: Keymap):
+        self.profiles[appKey] = keymap
+        if appKey not in self.pinned:
+            self.order.append(appKey)
+            while len(self.order) > self.size:
+                del self.profiles[self.order.pop(0)]
+        gc.collect()
+
+    def Replace(self, appKey: str, header, record) -> bool:
+        """Use a profile record streamed from the host from now on. False
+        if it doesn't unpack"""
+        platform, appName, name = header
+        default = None if appKey == self.default else \
+            self.profiles.get(self.default)
+        try:
+            keymap = CompileKeymap(
+                bundle.UnpackProfile(record, (platform, appName, name)), default
+            )
+        except MACRO_ERRORS as e:
+            print(f"Error Loading Macros: {appKey}\n{e}")
+            return False
+        self.streamed[appKey] = bytes(record)
+        self.index[appKey] = (None, platform, appName, name)
+        self.failed.discard(appKey)
+        if appKey == self.default:
+            # Every other keymap took its empty slots from the old default
+            for key in self.order:
+                del self.profiles[key]
+            self.order = []
+        elif appKey in self.order:
+            self.order.remove(appKey)
+        self._Store(appKey, keymap)
+        return True
+
+def IndexMacros(apps: ProfileCache, appList: list):
+    """Fill the profile index from the bundle, or from the macro files when
+    there is no bundle or a file was edited after it was built"""
+    files = [name for name in os.listdir(MACRO_FOLDER) if name.endswith('.py')]
+    files.sort()
+    try:
+        bundleTime = os.stat(MACRO_BUNDLE)[8]
+    except OSError:
+        bundleTime = None
+    if bundleTime is not None:
+        newest = max(
+            [os.stat(f"{MACRO_FOLDER}/{name}")[8] for name in files] or [0]
+        )
+        if newest <= bundleTime:
+            try:
+                apps.UseBundle(bundle.BundleReader(MACRO_BUNDLE))
+                appList.extend(apps.bundle.index)
+                return
+            except (OSError, ValueError, IndexError) as e:
+                print(f"Error Loading Macros: {MACRO_BUNDLE}\n{e}")
+        else:
+            print(f"{MACRO_BUNDLE} is older than {MACRO_FOLDER}, run build_macros.py")
+    for filename in files:
+        try:
+            header = ReadMacroHeader(f"{MACRO_FOLDER}/{filename}")
+            appKey = f"{header['platform']}-{header['appName']}"
+            apps.Add(appKey, filename, header)
+            appList.append(appKey)
+        except MACRO_ERRORS as e:
+            print(f"Error Loading Macros: {filename}\n{e}")
+
+def KeyLabels(display) -> displayio.Group:
+    """A group of 12 key labels laid out in a 3x4 grid"""
+    group = displayio.Group()
+    for keyIndex in range(12):
+        x = keyIndex % 3
+        y = keyIndex // 3
+        group.append(
+            label.Label(
+                terminalio.FONT,
+                text="",
+                color=0xFFFFFF,
+                anchored_position=(
+                    (display.width - 1) * x / 2,
+                    (display.height - 1) - ((3 - y) * 12)
+                ),
+                anchor_point=(x / 2, 1.0)
+            )
+        )
+    return group
+
+class Renderer:
+    """Batches display changes into one refresh per frame.
+
+    The display no longer refreshes by itself. Text set here is held until
+    the Run task commits it: labels whose text is already right are
+    skipped, the rest are written and the display refreshes once. Commits
+    are at least FRAME_TIME apart, anything set in between goes out with
+    the next one.
+
+    Each recently shown layout, an app or switch mode, keeps key labels of
+    its own. Showing one of them again swaps its group in and only
+    rewrites the labels that differ.
+
+    Sleep blanks the display. Changes made while asleep are kept and
+    drawn on Wake.
+    """
+    def __init__(self, display, title: str):
+        self.display = display
+        display.auto_refresh = False
+        self.root = displayio.Group()
+        self.keys = displayio.Group()
+        self.root.append(self.keys)
+        self.root.append(Rect(0, 0, display.width, 12, fill=0xFFFFFF))
+        self.title = label.Label(
+            terminalio.FONT,
+            text=title,
+            color=0x000000,
+            anchored_position=(display.width // 2, -2),
+            anchor_point=(0.5, 0)
+        )
+        self.root.append(self.title)
+        self.empty = displayio.Group()
+        self.asleep = False
+        self.layouts = {}
+        self.order = []
+        self.pending = {}
+        self.dirty = asyncio.Event()
+        self.dirty.set()
+        self.lastRefresh = time.monotonic()
+        self.frames = 0
+
+    def SetText(self, textLabel, text: str):
+        if textLabel not in self.pending and textLabel.text == text:
+            return
+        self.pending[textLabel] = text
+        self.dirty.set()
+
+    def SetTitle(self, text: str):
+        self.SetText(self.title, text)
+
+    def SetKey(self, index: int, text: str):
+        self.SetText(self.keys[index], text)
+
+    def ShowKeys(self, layout: str, texts):
+        """Show 12 key labels, reusing the group kept for layout"""
+        group = self.layouts.get(layout)
+        if group is None:
+            if len(self.order) < LAYOUT_CACHE_SIZE:
+                group = KeyLabels(self.display)
+            else:
+                group = self.layouts.pop(self.order.pop(0))
+            self.layouts[layout] = group
+        else:
+            self.order.remove(layout)
+        self.order.append(layout)
+        for i in range(12):
+            self.SetText(group[i], texts[i])
+        if group is not self.keys:
+            self.keys = group
+            self.root[0] = group
+            self.dirty.set()
+
+    def Sleep(self):
+        if not self.asleep:
+            self.asleep = True
+            self.display.show(self.empty)
+            self.display.refresh()
+            self.lastRefresh = time.monotonic()
+
+    def Wake(self):
+        if self.asleep:
+            self.asleep = False
+            self.display.show(self.root)
+            self.dirty.set()
+
+    async def Run(self):
+        while True:
+            await self.dirty.wait()
+            if self.asleep:
+                self.dirty.clear()
+                continue
+            wait = self.lastRefresh + FRAME_TIME - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.dirty.clear()
+            for textLabel, text in self.pending.items():
+                if textLabel.text != text:
+                    textLabel.text = text
+            self.pending.clear()
+            self.display.refresh()
+            self.lastRefresh = time.monotonic()
+            self.frames += 1
+
+WHEEL = array("L", [colorwheel(i) for i in range(256)])
+LEVELS = bytes([
+    int(127.5 - 127.5 * math.cos(2 * math.pi * i / 256)) for i in range(256)
+])
+"""One breath, from off to full and back"""
+PHASES = bytes([((pin // 4 + (pin - 3) % 3) * 6) % 256 for pin in range(12)])
+"""Where each key sits on the rainbow"""
+
+def Scale(color: int, level: int) -> int:
+    """color at level/255 brightness"""
+    return (
+        ((((color >> 16) & 0xFF) * level >> 8) << 16)
+        | ((((color >> 8) & 0xFF) * level >> 8) << 8)
+        | ((color & 0xFF) * level >> 8)
+    )
+
+def Rainbow(leds, step: int):
+    pixels = leds.pixels
+    for pin in range(12):
+        pixels[pin] = WHEEL[(step - PHASES[pin]) & 0xFF]
+
+def Breathe(leds, step: int):
+    leds.pixels.fill(Scale(BREATHE_COLOR, LEVELS[step]))
+
+def Pulse(leds, step: int):
+    """The app's own colors, between half and full brightness"""
+    level = 128 + (LEVELS[(step * 2) & 0xFF] >> 1)
+    pixels = leds.pixels
+    colors = leds.colors
+    for pin in range(12):
+        pixels[pin] = Scale(colors[pin], level)
+
+EFFECTS = {
+    "rainbow": Rainbow,
+    "breathe": Breathe,
+    "pulse": Pulse,
+}
+"""Effects draw one frame into leds.pixels for a step from 0 to 255"""
+
+class LedAnimator:
+    """Draws the key LEDs from one task.
+
+    The pixels don't write themselves. Each frame is drawn in full and sent
+    with a single show(). With an effect running that happens at most fps
+    times a second. With none the app colors are drawn once and the task
+    sleeps until they, the pressed keys or the effect change. Blanked, the
+    LEDs are turned off and stay off until SetBlank(False).
+    """
+    def __init__(self, pixels, pressed: set, fps=LED_FPS):
+        self.pixels = pixels
+        pixels.auto_write = False
+        self.pressed = pressed
+        self.frameTime = 1 / fps
+        self.colors = array("L", [0] * 12)
+        self.effect = None
+        self.effectName = None
+        self.blank = False
+        self.step = 0
+        self.changed = asyncio.Event()
+        self.frames = 0
+        self.drawTime = 0
+        self.maxDrawTime = 0
+        self.windowStart = time.monotonic_ns()
+
+    def SetColors(self, colors):
+        for pin in range(12):
+            self.colors[pin] = colors[pin]
+        self.changed.set()
+
+    def SetEffect(self, name):
+        """Run one of EFFECTS, or show the app colors for None"""
+        if name != self.effectName:
+            self.effectName = name
+            self.effect = EFFECTS[name] if name else None
+            self.changed.set()
+
+    def SetBlank(self, blank: bool):
+        if blank != self.blank:
+            self.blank = blank
+            self.changed.set()
+
+    def Redraw(self):
+        self.changed.set()
+
+    def Report(self) -> list:
+        """[effect, fps cap, frames, us measured over, average draw us,
+        max draw us], counted since the last report"""
+        now = time.monotonic_ns()
+        report = [
+            self.effectName,
+            round(1 / self.frameTime),
+            self.frames,
+            (now - self.windowStart) // 1000,
+            self.drawTime // max(self.frames, 1) // 1000,
+            self.maxDrawTime // 1000,
+        ]
+        self.frames = 0
+        self.drawTime = 0
+        self.maxDrawTime = 0
+        self.windowStart = now
+        return report
+
+    async def Run(self):
+        pixels = self.pixels
+        while True:
+            self.changed.clear()
+            start = time.monotonic_ns()
+            effect = None if self.blank else self.effect
+            if self.blank:
+                pixels.fill(0)
+            elif effect is None:
+                for pin in range(12):
+                    pixels[pin] = self.colors[pin]
+            else:
+                effect(self, self.step)
+                self.step = (self.step + 1) & 0xFF
+            if not self.blank:
+                for pin in self.pressed:
+                    pixels[pin] = PRESSED_COLOR
+            pixels.show()
+            elapsed = time.monotonic_ns() - start
+            self.frames += 1
+            self.drawTime += elapsed
+            if elapsed > self.maxDrawTime:
+                self.maxDrawTime = elapsed
+            if effect is None:
+                await self.changed.wait()
+            else:
+                await asyncio.sleep(max(self.frameTime - elapsed / 1e9, 0))
+
+class EncoderPipeline:
+    """Turns encoder detents into HID reports for the current keymap.
+
+    EncoderHandler adds detents as it reads them and Run sends what has
+    built up at most every ENCODER_INTERVAL, so a fast spin goes out in a
+    few batches instead of one report per loop, or not at all. With
+    acceleration on, a batch is multiplied by a gain that grows with how
+    fast the encoder turned, up to ENCODER_MAX_GAIN. The fraction of a step
+    left over carries into the next batch. Scrolling sends a whole batch
+    as one mouse report.
+    """
+    def __init__(self, macropad: MacroPad):
+        self.consumerControl = macropad.consumer_control
+        self.volumeUp = macropad.ConsumerControlCode.VOLUME_INCREMENT
+        self.volumeDown = macropad.ConsumerControlCode.VOLUME_DECREMENT
+        self.mouse = macropad.mouse
+        self.keyboard = macropad.keyboard
+        self.keymap = None
+        self.delta = 0
+        self.carry = 0.0
+        self.lastBatch = 0.0
+        self.moved = asyncio.Event()
+
+    def Add(self, keymap: Keymap, delta: int):
+        self.keymap = keymap
+        self.delta += delta
+        self.moved.set()
+
+    def Steps(self, delta: int, now: float) -> int:
+        """Steps to send for delta detents, with acceleration applied"""
+        elapsed = max(now - self.lastBatch, ENCODER_INTERVAL)
+        self.lastBatch = now
+        if (delta > 0) != (self.carry > 0):
+            # Turning the other way, forget the fraction left over
+            self.carry = 0.0
+        gain = 1
+        if self.keymap.encoderFlags & bundle.ENCODER_ACCELERATE:
+            rate = abs(delta) / elapsed
+            gain = min(
+                ENCODER_MAX_GAIN,
+                1 + max(0, rate - ENCODER_ACCEL_RATE) * ENCODER_ACCEL
+            )
+        amount = delta * gain + self.carry
+        steps = int(amount)
+        self.carry = amount - steps
+        return steps
+
+    def Send(self, steps: int):
+        keymap = self.keymap
+        action = keymap.encoderAction
+        if action == bundle.ENCODER_SCROLL:
+            while steps:
+                # Clockwise scrolls down
+                wheel = max(-127, min(127, steps))
+                self.mouse.move(wheel=-wheel)
+                steps -= wheel
+        elif action == bundle.ENCODER_KEYS:
+            keys = keymap.encoderIncrement if steps > 0 else keymap.encoderDecrement
+            for _ in range(abs(steps)):
+                self.keyboard.press(*keys)
+                self.keyboard.release(*keys)
+        else:
+            code = self.volumeUp if steps > 0 else self.volumeDown
+            for _ in range(abs(steps)):
+                self.consumerControl.send(code)
+
+    async def Run(self):
+        while True:
+            await self.moved.wait()
+            self.moved.clear()
+            delta = self.delta
+            self.delta = 0
+            if delta:
+                steps = self.Steps(delta, time.monotonic())
+                if steps:
+                    self.Send(steps)
+            await asyncio.sleep(ENCODER_INTERVAL)
+
 class MacroPadState:
     """
     Class to store the current state of the macropad to share across async
@@ -46,193 +809,519 @@ class MacroPadState:
     """
     def __init__(self):
         self.pressed = set()
-        self.values = [0x000000] * 12
-        self.colorIndex = 0
-        self.colorInterval = 0.5
         self.position = 0
         self.labelText = "App"
         self.currentMode = MacropadMode.HOTKEY
         self.targetMode = MacropadMode.HOTKEY
+        self.pollDelay = 0
+        """Seconds the polling tasks sleep between polls, longer in IDLE"""
         self.appAutoSwitch = True
-        self.apps = {
-            "idle": {
-                "name": "Adafruit MacroPad",
-                "appName": 'Idle',
-                "platform": 'none',
-                "macros": [(0x000000, "", "")] * 12
-            }
-        }
+        self.apps = ProfileCache()
+        self.apps.Pin("idle", {
+            "name": "Adafruit MacroPad",
+            "appName": 'Idle',
+            "platform": 'none',
+            "macros": [(0x000000, "", "")] * 12
+        })
         self.defaultApp = DEFAULT_APP
         self.targetApp = self.defaultApp
         self.currentApp = None
         self.appList = ["auto"]
+        self.keymap = self.apps["idle"]
         self.targetSwitchIndex = None
         self.switchIndex = None
         self.switchTime = None
+        # Handlers sleep on these until the matching state changes
+        self.appChanged = asyncio.Event()
+        self.modeChanged = asyncio.Event()
+        self.modeEntered = asyncio.Event()
+        self.switchChanged = asyncio.Event()
+        self.autoSwitchChanged = asyncio.Event()
+        self.warmChanged = asyncio.Event()
+        self.appChanged.set()
+        self.autoSwitchChanged.set()
 
-async def GetServerData(serial:usb_cdc.data, data: ServerData):
-    """Get data from server and store in server data class"""
-    while True:
-        if data.readTime is not None and time.monotonic() - data.readTime > 0.5:
-            data.buffer = b""
-        data.buffer += ReadSerial(serial, data)
-        if data.buffer:
+    def SetTargetApp(self, app: str):
+        self.targetApp = app
+        self.appChanged.set()
+
+    def SetTargetMode(self, mode: int):
+        self.targetMode = mode
+        self.modeChanged.set()
+
+    def SetTargetSwitchIndex(self, index: int):
+        self.targetSwitchIndex = index
+        self.switchChanged.set()
+
+    def SetAutoSwitch(self, autoSwitch: bool):
+        self.appAutoSwitch = autoSwitch
+        self.autoSwitchChanged.set()
+        self.warmChanged.set()
+
+class WarmStart:
+    """Keeps the shown profile and the auto switch flag in
+    microcontroller.nvm, so the pad boots straight into them instead of
+    waiting for the server.
+
+    The record is WARM_HEADER, the app key as a string and a checksum of
+    everything before it. The index checksum ties it to the profiles it was
+    saved with: after an edit to /macros it is ignored. Nothing is written
+    when the record would not change. The index itself isn't kept here,
+    macros.bin already holds it and reading it takes one small read.
+    """
+    def __init__(self, nvm, appList: list):
+        self.nvm = nvm
+        self.indexChecksum = wire.Checksum("\n".join(appList).encode("utf-8"))
+        self.saved = None
+        self.lastWrite = None
+
+    def Pack(self, appKey: str, autoSwitch: bool) -> bytes:
+        key = appKey.encode("utf-8")
+        record = struct.pack(
+            WARM_HEADER, WARM_MAGIC, WARM_VERSION,
+            WARM_AUTO_SWITCH if autoSwitch else 0, self.indexChecksum
+        ) + bytes([len(key)]) + key
+        return record + struct.pack(">H", wire.Checksum(record))
+
+    def Load(self):
+        """(appKey, autoSwitch) from NVM, None without a valid record"""
+        if self.nvm is None:
+            return None
+        size = struct.calcsize(WARM_HEADER)
+        header = bytes(self.nvm[0:size + 1])
+        magic, version, flags, indexChecksum = struct.unpack_from(
+            WARM_HEADER, header
+        )
+        if magic != WARM_MAGIC or version != WARM_VERSION:
+            return None
+        end = size + 1 + header[size]
+        if end + 2 > len(self.nvm):
+            return None
+        record = bytes(self.nvm[0:end + 2])
+        if struct.unpack_from(">H", record, end)[0] != wire.Checksum(record[:end]):
+            print("Warm start record is corrupt")
+            return None
+        self.saved = record
+        if indexChecksum != self.indexChecksum:
+            print("Profiles changed since the warm start record was saved")
+            return None
+        return (
+            record[size + 1:end].decode("utf-8"),
+            bool(flags & WARM_AUTO_SWITCH),
+        )
+
+    def Restore(self, macroPadState: MacroPadState):
+        """Start on the saved profile, before the server says anything"""
+        state = self.Load()
+        if state is None:
+            return
+        appKey, autoSwitch = state
+        print(f"Warm start: {appKey}, auto switch {autoSwitch}")
+        macroPadState.appAutoSwitch = autoSwitch
+        if appKey in macroPadState.appList:
+            macroPadState.targetApp = appKey
+
+    def Save(self, appKey: str, autoSwitch: bool):
+        record = self.Pack(appKey, autoSwitch)
+        if record == self.saved:
+            return
+        try:
+            self.nvm[0:len(record)] = record
+        except (OSError, ValueError) as e:
+            print(f"Unable to save the warm start record: {e}")
+            return
+        self.saved = record
+        self.lastWrite = time.monotonic()
+
+    async def Run(self, macroPadState: MacroPadState):
+        """Write the record once the profile has settled. One picked by hand
+        is written soon, one the server keeps switching at most every
+        WARM_WRITE_INTERVAL"""
+        if self.nvm is None:
+            return
+        while True:
+            await macroPadState.warmChanged.wait()
+            macroPadState.warmChanged.clear()
+            while True:
+                await asyncio.sleep(WARM_SAVE_DELAY)
+                if (
+                    not macroPadState.appAutoSwitch
+                    or self.lastWrite is None
+                    or time.monotonic() - self.lastWrite >= WARM_WRITE_INTERVAL
+                ):
+                    break
+            macroPadState.warmChanged.clear()
+            if macroPadState.currentApp is not None:
+                self.Save(macroPadState.currentApp, macroPadState.appAutoSwitch)
+
+class MacroSequencer:
+    """Plays macros from a task of its own, so delays and long strings
+    don't stop the key, encoder and serial handlers.
+
+    Press hands the sequencer a slot and returns straight away. Only the
+    newest press waits its turn: one that comes in while a macro is still
+    playing cancels that macro, cutting a delay short, and lets go of its
+    keys. Release lets go of a slot's keys once it has finished playing and
+    ends hold-to-repeat.
+
+    Text of a macro marked to run on the host is sent to the server to
+    type, when one with an injector is listening, and typed here otherwise.
+    The rest of the macro waits until the server says it has been typed.
+    """
+    def __init__(self, macropad: MacroPad, serial=None, serverData=None):
+        self.keyboard = macropad.keyboard
+        self.layout = macropad.keyboard_layout
+        self.serial = serial
+        self.serverData = serverData
+        self.wake = asyncio.Event()
+        self.pendingKeymap = None
+        self.pendingKey = None
+        self.pendingHeld = False
+        self.keymap = None
+        self.keyNumber = None
+        self.held = False
+        self.cancelled = False
+
+    def Press(self, keymap: Keymap, keyNumber: int):
+        self.pendingKeymap = keymap
+        self.pendingKey = keyNumber
+        self.pendingHeld = True
+        if self.keymap is not None:
+            self.cancelled = True
+        self.wake.set()
+
+    def Release(self, keyNumber: int):
+        if self.pendingKeymap is not None and keyNumber == self.pendingKey:
+            self.pendingHeld = False
+        elif self.keymap is not None and keyNumber == self.keyNumber:
+            self.held = False
+            self.wake.set()
+
+    async def Run(self):
+        while True:
+            if self.pendingKeymap is None:
+                await self.wake.wait()
+                self.wake.clear()
+                continue
+            keymap = self.keymap = self.pendingKeymap
+            keyNumber = self.keyNumber = self.pendingKey
+            self.held = self.pendingHeld
+            self.pendingKeymap = None
+            self.cancelled = False
+            repeat = keymap.flags[keyNumber] & bundle.FLAG_REPEAT
+            wait = REPEAT_DELAY
+            while True:
+                await self.Play(keymap, keyNumber)
+                if not repeat or not await self.Held(wait):
+                    break
+                self.ReleaseKeys(keymap, keyNumber)
+                wait = REPEAT_INTERVAL
+            await self.Held(None)
+            self.ReleaseKeys(keymap, keyNumber)
+            self.keymap = None
+            self.keyNumber = None
+
+    async def Held(self, timeout) -> bool:
+        """Wait for the key to come up or a cancel. True if it is still
+        held after timeout seconds"""
+        while self.held and not self.cancelled:
+            self.wake.clear()
+            if timeout is None:
+                await self.wake.wait()
+                continue
             try:
-                serialData = json.loads(data.buffer)
-                data.name = serialData['name']
-                data.platform = serialData['platform']
-                data.updated = True
-                data.buffer = b""
-                print(f"Focused app: {data.name}")
-            except ValueError:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                return True
+        return False
+
+    async def Play(self, keymap: Keymap, keyNumber: int):
+        ops = keymap.ops[keyNumber]
+        keyboard = self.keyboard
+        i = 0
+        end = len(ops)
+        while i < end and not self.cancelled:
+            op = ops[i]
+            argument = ops[i + 1]
+            i += 2
+            if op == bundle.OP_PRESS:
+                keyboard.press(argument)
+            elif op == bundle.OP_RELEASE:
+                keyboard.release(argument)
+            elif op == bundle.OP_DELAY:
+                await self.Sleep(argument / 1000)
+            elif keymap.flags[keyNumber] & bundle.FLAG_HOST and self.HostTyping():
+                await self.Injected(SendText(
+                    self.serial, self.serverData, keymap.texts[keyNumber][argument]
+                ))
+            else:
+                await self.Type(keymap.texts[keyNumber][argument])
+
+    def HostTyping(self) -> bool:
+        """Whether a server that can type is on the other end"""
+        return (
+            self.serverData is not None
+            and self.serverData.injector is not None
+            and self.serial.connected
+        )
+
+    async def Injected(self, injectId: int):
+        """Wait for the server to type text sent with SendText, so the keys
+        after it don't overtake it. Gives up after INJECT_TIMEOUT"""
+        data = self.serverData
+        end = time.monotonic() + INJECT_TIMEOUT
+        while data.injected != injectId and not self.cancelled:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                print("Server didn't type the text in time")
+                return
+            data.injectedEvent.clear()
+            try:
+                await asyncio.wait_for(data.injectedEvent.wait(), remaining)
+            except asyncio.TimeoutError:
                 pass
-        await asyncio.sleep(0)
-
-def ReadSerial(serial:usb_cdc.data, data: ServerData) -> str:
-    """Read incoming serial data"""
-    available = serial.in_waiting
-    text = ""
-    while available:
-        data.readTime = time.monotonic()
-        raw = serial.read(available)
-        text = raw.decode("utf-8")
-        available = serial.in_waiting
-    return text
+
+    async def Sleep(self, seconds: float):
+        """Sleep that a cancel cuts short"""
+        end = time.monotonic() + seconds
+        while not self.cancelled:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def Type(self, text: str):
+        """Type text a chunk at a time"""
+        if len(text) <= TEXT_CHUNK:
+            self.layout.write(text)
+            return
+        for start in range(0, len(text), TEXT_CHUNK):
+            if self.cancelled:
+                return
+            self.layout.write(text[start:start + TEXT_CHUNK])
+            await asyncio.sleep(0)
+
+    def ReleaseKeys(self, keymap: Keymap, keyNumber: int):
+        keyboard = self.keyboard
+        for keycode in keymap.releases[keyNumber]:
+            keyboard.release(keycode)
+
+async def GetServerData(
+    serial:usb_cdc.data, data: ServerData, macroPadState: MacroPadState
+):
+    """Get data from server and store in server data class"""
+    decoder = data.decoder
+    while True:
+        if decoder.ReadFrom(serial):
+            data.readTime = time.monotonic()
+            message = decoder.Next()
+            while message is not None:
+                HandleServerMessage(message, data, serial)
+                message = decoder.Next()
+        await asyncio.sleep(macroPadState.pollDelay)
+
+def HandleServerMessage(message: dict, data: ServerData, serial:usb_cdc.data):
+    """Apply one decoded message from the server.
+
+    Messages with a sequence number are acked, even repeats, and skipped
+    unless they are newer than the last one applied. A digest request
+    starts the numbering over for a new connection.
+    """
+    if "seq" in message:
+        seq = message["seq"]
+        SendToServer(serial, data, {"ack": seq})
+        if seq <= data.seq:
+            return
+        data.seq = seq
+    if message.get("digestRequested"):
+        data.seq = 0
+        data.digestEvent.set()
+    if "version" in message:
+        try:
+            data.protocol = min(int(message["version"]), wire.PROTOCOL_VERSION)
+        except ValueError:
+            pass
+    if "profile" in message:
+        data.profile = message["profile"]
+        data.updated = True
+        data.updatedEvent.set()
+        print(f"Focused app: {data.profile}")
+    if "profileChunk" in message:
+        ReceiveProfileChunk(message["profileChunk"], data, serial)
+    if "reportKeys" in message:
+        data.reportKeys = bool(message["reportKeys"])
+    if "injector" in message:
+        data.injector = message["injector"]
+    if "injected" in message:
+        data.injected = message["injected"]
+        data.injectedEvent.set()
+    if "idle" in message:
+        data.idle = bool(message["idle"])
+        data.idleEvent.set()
+    if "ping" in message:
+        SendToServer(serial, data, {"pong": message["ping"]})
+    if message.get("statsRequested"):
+        if data.taskStats:
+            now = time.monotonic_ns()
+            stats = [taskStats.Report(now) for taskStats in data.taskStats]
+        else:
+            stats = None
+        leds = data.leds.Report() if data.leds is not None else None
+        SendToServer(serial, data, {"stats": stats, "leds": leds})
+
+def ReceiveProfileChunk(chunk: dict, data: ServerData, serial:usb_cdc.data):
+    """Collect the chunks of a streamed profile. A complete one that passes
+    its checksum is handed to ProfileReloader"""
+    part = chunk["part"]
+    if part == 0:
+        data.transfer = ProfileTransfer(chunk)
+        data.dropped = None
+    transfer = data.transfer
+    if transfer is None or chunk["key"] != transfer.key or part != transfer.next:
+        # A chunk went missing, give up on this profile. The server is told
+        # once, also when it was the first chunk that got lost
+        key = transfer.key if transfer is not None else chunk["key"]
+        if key != data.dropped:
+            SendToServer(serial, data, {"profileLoaded": [key, False]})
+        data.dropped = key
+        data.transfer = None
+        return
+    payload = chunk["data"]
+    if isinstance(payload, str):
+        # JSON can't carry bytes, protocol 1 chunks are base64
+        payload = binascii.a2b_base64(payload)
+    transfer.data.extend(payload)
+    transfer.next += 1
+    if transfer.next < transfer.parts:
+        return
+    data.transfer = None
+    if wire.Checksum(transfer.data) != transfer.checksum:
+        SendToServer(serial, data, {"profileLoaded": [transfer.key, False]})
+        return
+    data.reloads.append(transfer)
+    data.reloadEvent.set()
+
+def SendText(serial:usb_cdc.data, data: ServerData, text: str) -> int:
+    """Have the server type text. It goes over INJECT_CHUNK characters per
+    message, as [id, part, parts, text]. Returns the id"""
+    data.injectId = (data.injectId + 1) % 0x10000
+    parts = max(1, (len(text) + INJECT_CHUNK - 1) // INJECT_CHUNK)
+    for part in range(parts):
+        start = part * INJECT_CHUNK
+        SendToServer(serial, data, {
+            "inject": [data.injectId, part, parts, text[start:start + INJECT_CHUNK]]
+        })
+    return data.injectId
+
+def SendToServer(serial:usb_cdc.data, data: ServerData, message: dict):
+    """Send a message in the protocol version the server understands"""
+    serial.write(wire.Pack(message, data.protocol))
 
 async def RequestUpdateFromServer(
-    macropadState: MacroPadState, serial:usb_cdc.data
+    macropadState: MacroPadState, serial:usb_cdc.data, serverData: ServerData
 ):
     autoSwitch = None
     while True:
+        await macropadState.autoSwitchChanged.wait()
+        macropadState.autoSwitchChanged.clear()
         if macropadState.appAutoSwitch != autoSwitch:
             autoSwitch = macropadState.appAutoSwitch
-            message = json.dumps(
-                {
-                    "updateRequested": True,
-                    "version": MESSAGING_VERSION,
-                }
-            )
+            message = {
+                "updateRequested": True,
+                "version": MESSAGING_VERSION,
+            }
             print(f"Requesting update: {message}")
-            serial.write(bytes(f"{message}\n", "utf-8"))
+            SendToServer(serial, serverData, message)
         await asyncio.sleep(0.2)
 
-async def IdleState(
-    macropad:MacroPad, macroPadState:MacroPadState
+async def LedModeHandler(
+    macroPadState:MacroPadState, leds:LedAnimator
 ):
-    """Handle key colors in idle states"""
+    """Pick the LED effect for each mode"""
     while True:
-        colorInterval = 0
-        if macroPadState.currentMode in (MacropadMode.IDLE, MacropadMode.SWITCH):
-            for pin in range(12):
-                if pin not in macroPadState.pressed:
-                    cIndex = macroPadState.colorIndex
-                    oPin = pin - 3
-                    cIndex = (cIndex - ((pin // 4 + oPin % 3) * 6)) % 256
-                    macropad.pixels[pin] = colorwheel(cIndex)
-                macroPadState.values[pin] = colorwheel(cIndex)
-            macroPadState.colorIndex = (macroPadState.colorIndex + int(1)) % 256
-        await asyncio.sleep(colorInterval)
+        leds.SetBlank(macroPadState.currentMode == MacropadMode.IDLE)
+        leds.SetEffect(MODE_EFFECTS.get(macroPadState.currentMode))
+        await macroPadState.modeEntered.wait()
+        macroPadState.modeEntered.clear()
 
 async def KeyHandler(
     macropad:MacroPad,
     macroPadState:MacroPadState,
+    sequencer:MacroSequencer,
+    leds:LedAnimator,
+    serverData:ServerData,
+    serial:usb_cdc.data,
 ):
-    """Poll keys for state changes"""
+    """Poll keys for state changes. A key pressed in IDLE only wakes the
+    pad"""
     while True:
         keyEvent = macropad.keys.events.get()
         if keyEvent:
             keyNumber = keyEvent.key_number
-            print(f"keyEvent: {keyEvent}")
-            macro = GetAppMacro(keyNumber, macroPadState)
             if keyEvent.pressed:
-                macropad.pixels[keyNumber] = 0xAAAAAA
                 macroPadState.pressed.add(keyNumber)
-                if macroPadState.currentMode == MacropadMode.HOTKEY:
-                    KeyPressedAction(macro, macropad)
+                leds.Redraw()
+                if macroPadState.currentMode == MacropadMode.IDLE:
+                    macroPadState.SetTargetMode(MacropadMode.HOTKEY)
+                elif macroPadState.currentMode == MacropadMode.HOTKEY:
+                    keymap = macroPadState.keymap
+                    sequencer.Press(keymap, keyNumber)
+                    if serverData.reportKeys:
+                        SendToServer(serial, serverData, {"keyPressed": [
+                            macroPadState.currentApp,
+                            keyNumber,
+                            keymap.labels[keyNumber],
+                        ]})
             if keyEvent.released:
-                macropad.pixels[keyNumber] = macroPadState.values[keyNumber]
-                if macroPadState.currentMode == MacropadMode.HOTKEY:
-                    KeyReleaseAction(macro, macropad)
+                # Even after a mode change, so no key is left held
+                sequencer.Release(keyNumber)
                 macroPadState.pressed.remove(keyNumber)
-        await asyncio.sleep(0)
+                leds.Redraw()
+        await asyncio.sleep(macroPadState.pollDelay)
 
-def KeyPressedAction(
-    macro: tuple, macropad: MacroPad
+async def EncoderHandler(
+    macropad:MacroPad, macroPadState:MacroPadState, encoder:EncoderPipeline
 ):
-    print(macro)
-    sequence = macro[2]
-    if sequence:
-        try:
-            for item in sequence:
-                if isinstance(item, int):
-                    if item >= 0:
-                        macropad.keyboard.press(item)
-                    else:
-                        macropad.keyboard.release(-item)
-                elif isinstance(item, float):
-                    time.sleep(item)
-                else:
-                    macropad.keyboard_layout.write(item)
-        except TypeError as e:
-            print(f"TypeError: {e}")
-            print("Are the macro keys in a list?")
-    return
-
-def KeyReleaseAction(
-    macro: tuple, macropad: MacroPad
-):
-    sequence = macro[2]
-    if sequence:
-        for item in sequence:
-            if isinstance(item, int):
-                if item >= 0:
-                    macropad.keyboard.release(item)
-    return
-
-def GetAppMacro(keyNumber: int, mpState: MacroPadState):
-    appData = mpState.apps[mpState.currentApp]
-    if appData is None:
-        print("No app data found")
-        return None
-    else:
-        macro = appData['macros'][keyNumber]
-        if macro is None:
-            macro = mpState.apps[mpState.defaultApp]['macros'][keyNumber]
-    return macro
-
-async def EncoderHandler(macropad:MacroPad, macroPadState:MacroPadState):
-    """Poll encoder position for changes"""
+    """Poll encoder position for changes. Pressing or turning it in IDLE
+    only wakes the pad"""
     while True:
         macropad.encoder_switch_debounced.update()
         encoderSwitch = macropad.encoder_switch_debounced.pressed
+        encoderDifference = macropad.encoder - macroPadState.position
+        if macroPadState.currentMode == MacropadMode.IDLE:
+            if encoderSwitch or encoderDifference:
+                macroPadState.SetTargetMode(MacropadMode.HOTKEY)
+            encoderSwitch = False
+            encoderDifference = 0
+            macroPadState.position = macropad.encoder
         if encoderSwitch:
             print("encoder pressed")
             if macroPadState.currentMode != MacropadMode.SWITCH:
-                macroPadState.targetMode = MacropadMode.SWITCH 
+                macroPadState.SetTargetMode(MacropadMode.SWITCH)
             else:
-                macroPadState.targetMode = MacropadMode.HOTKEY
-        encoderDifference = macropad.encoder - macroPadState.position
+                macroPadState.SetTargetMode(MacropadMode.HOTKEY)
         if encoderDifference != 0:
             if macroPadState.currentMode != MacropadMode.SWITCH:
-                if encoderDifference > 0:
-                    macropad.consumer_control.send(
-                        macropad.ConsumerControlCode.VOLUME_INCREMENT
-                    )
-                else:
-                    macropad.consumer_control.send(
-                        macropad.ConsumerControlCode.VOLUME_DECREMENT
-                    )
+                encoder.Add(macroPadState.keymap, encoderDifference)
             else:
                 i = macroPadState.switchIndex + encoderDifference
-                macroPadState.targetSwitchIndex = i % len(macroPadState.appList)
+                macroPadState.SetTargetSwitchIndex(
+                    i % len(macroPadState.appList)
+                )
                 macroPadState.switchTime = time.monotonic()
             macroPadState.position = macropad.encoder
-        await asyncio.sleep(0)
+        await asyncio.sleep(macroPadState.pollDelay)
 
 async def SwitchModeHandler(
     macroPadState:MacroPadState,
 ):
     while True:
+        await macroPadState.switchChanged.wait()
+        macroPadState.switchChanged.clear()
         if macroPadState.currentMode == MacropadMode.SWITCH:
             targetIndex = macroPadState.targetSwitchIndex
             switchIndex = macroPadState.switchIndex
@@ -243,19 +1332,33 @@ async def SwitchModeHandler(
                     appLabel = "Auto Switch Apps"
                 else:
                     appKey = appList[targetIndex]
-                    app = macroPadState.apps[appKey]
-                    appLabel = f"{app['name']} ({app['platform']})"
-                macroPadState.displayGroup[1].text = appLabel
-        await asyncio.sleep(0)
+                    apps = macroPadState.apps
+                    appLabel = f"{apps.Name(appKey)} ({apps.Platform(appKey)})"
+                macroPadState.renderer.SetKey(1, appLabel)
 
 async def ModeChangeHandler(
     macroPadState:MacroPadState
 ):
     """Change modes of the macropad"""
     while True:
+        if macroPadState.currentMode == MacropadMode.SWITCH:
+            # Wake up for the switch mode timeout as well. Turning the
+            # encoder moves switchTime, so this may wake early and go round
+            remaining = SWITCH_TIMEOUT - (
+                time.monotonic() - macroPadState.switchTime
+            )
+            try:
+                await asyncio.wait_for(
+                    macroPadState.modeChanged.wait(), max(remaining, 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await macroPadState.modeChanged.wait()
+        macroPadState.modeChanged.clear()
         if (
             macroPadState.currentMode == MacropadMode.SWITCH and
-            time.monotonic() - macroPadState.switchTime > 60
+            time.monotonic() - macroPadState.switchTime > SWITCH_TIMEOUT
         ):
             print("Switch Time Up")
             macroPadState.targetMode = MacropadMode.HOTKEY
@@ -265,158 +1368,197 @@ async def ModeChangeHandler(
                 # Close out switch mode
                 i = macroPadState.switchIndex
                 if i != 0:
-                    macroPadState.targetApp = macroPadState.appList[i]
+                    macroPadState.SetTargetApp(macroPadState.appList[i])
                 else:
-                    macroPadState.appAutoSwitch = True
+                    macroPadState.SetAutoSwitch(True)
                 macroPadState.targetSwitchIndex = None
                 macroPadState.switchIndex = None
                 macroPadState.switchTime = None
+            if macroPadState.currentMode == MacropadMode.IDLE:
+                macroPadState.renderer.Wake()
+                macroPadState.pollDelay = 0
             if macroPadState.targetMode == MacropadMode.SWITCH:
-                macroPadState.displayGroup[13].text = "Switch Mode"
-                for i in range(12):
-                    if i == 0:
-                        macroPadState.displayGroup[0].text = "<"
-                    elif i == 2:
-                        macroPadState.displayGroup[2].text = ">"
-                    else:
-                        macroPadState.displayGroup[i].text = ""
+                macroPadState.renderer.SetTitle("Switch Mode")
+                macroPadState.renderer.ShowKeys("switch", SWITCH_LABELS)
                 if macroPadState.appAutoSwitch:
                     targetIndex = 0
                 else:
                     targetIndex = macroPadState.appList.index(
                         macroPadState.currentApp
                     )
-                macroPadState.targetSwitchIndex = targetIndex
-                macroPadState.appAutoSwitch = False
+                macroPadState.SetTargetSwitchIndex(targetIndex)
+                macroPadState.SetAutoSwitch(False)
                 macroPadState.switchTime = time.monotonic()
                 print("Switching mode activated")
             elif macroPadState.targetMode == MacropadMode.IDLE:
-                macroPadState.displayGroup[13].text = "Sleeping..."
+                # Blank rather than show "Sleeping..." all night on the OLED
+                macroPadState.renderer.Sleep()
+                macroPadState.pollDelay = IDLE_POLL_INTERVAL
                 print("Idle mode activated")
             elif macroPadState.targetMode == MacropadMode.HOTKEY:
                 macroPadState.currentApp = None
+                macroPadState.appChanged.set()
                 print("App mode activated")
             macroPadState.currentMode = macroPadState.targetMode
+            macroPadState.modeEntered.set()
             print(f"macroPadState.currentMode = {macroPadState.currentMode}")
-            
-        await asyncio.sleep(0)
+
+async def IdleHandler(macroPadState:MacroPadState, serverData:ServerData):
+    """Sleep while the server says the user is away, wake when they are
+    back"""
+    while True:
+        await serverData.idleEvent.wait()
+        serverData.idleEvent.clear()
+        if serverData.idle:
+            if macroPadState.currentMode != MacropadMode.IDLE:
+                macroPadState.SetTargetMode(MacropadMode.IDLE)
+        elif macroPadState.currentMode == MacropadMode.IDLE:
+            macroPadState.SetTargetMode(MacropadMode.HOTKEY)
 
 async def SetAppAuto(
     macroPadState:MacroPadState,
     serverData:ServerData
 ):
     while True:
+        await serverData.updatedEvent.wait()
+        serverData.updatedEvent.clear()
         if macroPadState.appAutoSwitch == True and serverData.updated == True:
             print("Auto Switching App")
             serverData.updated = False
-            platform = serverData.platform
-            appName = serverData.name
-            macroPadState.targetApp = f"{platform}-{appName}"
-        await asyncio.sleep(0)
+            # The server already resolved the window to a profile
+            macroPadState.SetTargetApp(serverData.profile)
+
+async def ProfileReloader(
+    macroPadState:MacroPadState, serverData:ServerData, serial:usb_cdc.data
+):
+    """Swap in profiles streamed from the server, redrawing if they change
+    what is on the pad"""
+    while True:
+        await serverData.reloadEvent.wait()
+        serverData.reloadEvent.clear()
+        while serverData.reloads:
+            transfer = serverData.reloads.pop(0)
+            appKey = transfer.key
+            loaded = macroPadState.apps.Replace(
+                appKey, transfer.header, transfer.data
+            )
+            SendToServer(serial, serverData, {"profileLoaded": [appKey, loaded]})
+            if not loaded:
+                continue
+            print(f"Reloaded {appKey}")
+            if appKey not in macroPadState.appList:
+                macroPadState.appList.append(appKey)
+            if appKey in (macroPadState.currentApp, macroPadState.defaultApp):
+                macroPadState.currentApp = None
+                if macroPadState.currentMode == MacropadMode.HOTKEY:
+                    macroPadState.appChanged.set()
+
+async def DigestResponder(
+    macroPadState:MacroPadState, serverData:ServerData, serial:usb_cdc.data
+):
+    """Tell a server that (re)connects what state the pad has, so it only
+    sends what differs. The protocol version goes along, as the pad may have
+    booted long before the server opened the port"""
+    while True:
+        await serverData.digestEvent.wait()
+        serverData.digestEvent.clear()
+        streamed = macroPadState.apps.streamed
+        SendToServer(serial, serverData, {"digest": {
+            "profile": serverData.profile,
+            "profiles": {
+                appKey: wire.Checksum(record)
+                for appKey, record in streamed.items()
+            },
+            "reportKeys": serverData.reportKeys,
+            "injector": serverData.injector,
+            "idle": serverData.idle,
+        }, "version": MESSAGING_VERSION})
 
 async def LoadApp(
     macropad:MacroPad,
     macroPadState:MacroPadState
 ):
-    """Poll for app changes and load up required info"""
+    """Wait for app changes and load up required info"""
     while True:
+        await macroPadState.appChanged.wait()
+        macroPadState.appChanged.clear()
         currentApp = macroPadState.currentApp
         targetApp = macroPadState.targetApp
         apps = macroPadState.apps
         if currentApp != targetApp:
-            defaultAppKey = macroPadState.defaultApp
-            if targetApp not in apps:
-                displayName = f"{targetApp.split('-', 1)[1]}*"
-                currentApp = defaultAppKey
+            keymap = apps.Get(targetApp)
+            if keymap is None:
+                displayName = f"{targetApp.partition('-')[2] or targetApp}*"
+                currentApp = macroPadState.defaultApp
                 macroPadState.targetApp = currentApp
+                keymap = apps[currentApp]
             else:
                 currentApp = targetApp
                 displayName = None
             macroPadState.currentApp = currentApp
-            appData = apps[currentApp]
-            defaultAppData = apps[defaultAppKey]
-            print(
-                f"Load App: {appData['name']}"
+            macroPadState.keymap = keymap
+            macroPadState.warmChanged.set()
+            print(f"Load App: {keymap.name}")
+            renderer = macroPadState.renderer
+            renderer.SetTitle(
+                keymap.name if displayName is None else displayName
             )
-            macroPadState.displayGroup[13].text = appData['name'] if \
-                displayName is None else displayName
-            for i, macro in enumerate(appData['macros']):
-                if i > 11:
-                    continue
-                if macro is None:
-                    macro = defaultAppData['macros'][i]
-                macropad.pixels[i] = macro[0]
-                macroPadState.values[i] = macro[0]
-                macroPadState.displayGroup[i].text = macro[1]
-        await asyncio.sleep(0)
+            renderer.ShowKeys(currentApp, keymap.labels)
+            macroPadState.leds.SetColors(keymap.colors)
 
 async def main():
     serial = usb_cdc.data
     serverData = ServerData()
     macropad = MacroPad()
     macroPadState = MacroPadState()
-    macroPadState.displayGroup = displayio.Group()
+    sequencer = MacroSequencer(macropad, serial, serverData)
+    encoder = EncoderPipeline(macropad)
+    macroPadState.leds = LedAnimator(macropad.pixels, macroPadState.pressed)
+    serverData.leds = macroPadState.leds
     
-    files = os.listdir(MACRO_FOLDER)
-    files.sort()
-    for filename in files:
-        if filename.endswith('.py'):
-            try:
-                # module = __import__(f"{MACRO_FOLDER}/{filename[:-3]}")
-                module = __import__("{}/{}".format(MACRO_FOLDER, filename[:-3]))
-                appKey = f"{module.app['platform']}-{module.app['appName']}"
-                macroPadState.apps[appKey] = module.app
-                macroPadState.appList.append(appKey)
-            except (
-                AttributeError,
-                ImportError,
-                IndexError,
-                KeyError,
-                NameError,
-                SyntaxError,
-                TypeError,
-            ) as e:
-                print(f"Error Loading Macros: {filename}\n{e}")
-    for keyIndex in range(12):
-        x = keyIndex % 3
-        y = keyIndex // 3
-        macroPadState.displayGroup.append(
-            label.Label(
-                terminalio.FONT,
-                text="",
-                color=0xFFFFFF,
-                anchored_position=(
-                    (macropad.display.width - 1) * x / 2,
-                    (macropad.display.height - 1) - ((3 - y) * 12)
-                ),
-                anchor_point=(x / 2, 1.0)
-            )
-        )
-    macroPadState.displayGroup.append(
-        Rect(0, 0, macropad.display.width, 12, fill=0xFFFFFF)
+    IndexMacros(macroPadState.apps, macroPadState.appList)
+    macroPadState.apps.Pin(macroPadState.defaultApp)
+    warmStart = WarmStart(
+        getattr(microcontroller, "nvm", None), macroPadState.appList
     )
-    macroPadState.displayGroup.append(
-        label.Label(
-            terminalio.FONT,
-            text=macroPadState.labelText,
-            color=0x000000,
-            anchored_position=(macropad.display.width // 2, -2),
-            anchor_point=(0.5, 0)
-        )
+    warmStart.Restore(macroPadState)
+    macroPadState.renderer = Renderer(
+        macropad.display, macroPadState.labelText
     )
-    macropad.display.show(macroPadState.displayGroup)
-    await asyncio.gather(
-        RequestUpdateFromServer(macroPadState, serial),
-        IdleState(macropad, macroPadState),
-        GetServerData(serial, serverData),
-        KeyHandler(macropad, macroPadState),
-        EncoderHandler(macropad, macroPadState),
-        ModeChangeHandler(macroPadState),
-        LoadApp(macropad, macroPadState),
-        SetAppAuto(macroPadState, serverData),
-        SwitchModeHandler(macroPadState),
+    macropad.display.show(macroPadState.renderer.root)
+    tasks = (
+        ("RequestUpdate", RequestUpdateFromServer(
+            macroPadState, serial, serverData
+        )),
+        ("LedMode", LedModeHandler(macroPadState, macroPadState.leds)),
+        ("ServerData", GetServerData(serial, serverData, macroPadState)),
+        ("Keys", KeyHandler(
+            macropad, macroPadState, sequencer, macroPadState.leds,
+            serverData, serial
+        )),
+        ("Macros", sequencer.Run()),
+        ("Encoder", EncoderHandler(macropad, macroPadState, encoder)),
+        ("EncoderOut", encoder.Run()),
+        ("ModeChange", ModeChangeHandler(macroPadState)),
+        ("LoadApp", LoadApp(macropad, macroPadState)),
+        ("AppAuto", SetAppAuto(macroPadState, serverData)),
+        ("Reload", ProfileReloader(macroPadState, serverData, serial)),
+        ("Digest", DigestResponder(macroPadState, serverData, serial)),
+        ("Idle", IdleHandler(macroPadState, serverData)),
+        ("SwitchMode", SwitchModeHandler(macroPadState)),
+        ("WarmStart", warmStart.Run(macroPadState)),
+        ("Render", macroPadState.renderer.Run()),
+        ("Leds", macroPadState.leds.Run()),
     )
+    if TASK_STATS:
+        serverData.taskStats = [TaskStats(name) for name, _ in tasks]
+        await asyncio.gather(*(
+            Profiled(task, stats)
+            for (_, task), stats in zip(tasks, serverData.taskStats)
+        ))
+    else:
+        await asyncio.gather(*(task for _, task in tasks))
 
-asyncio.run(main())
-
+if __name__ == "__main__":
+    asyncio.run(main())
 
@@ -7,6 +7,12 @@ app = {
     "name": "VSCode",  # Application name
     "appName": "Code", # Name as reported by OS
     "platform": "mac", # OS name. choose from ["mac", "linux", "windows"]
+    # Turn the encoder to zoom in and out
+    "encoder": {
+        "action": "keys",
+        "increment": [Keycode.COMMAND, Keycode.EQUALS],
+        "decrement": [Keycode.COMMAND, Keycode.MINUS],
+    },
     "macros": [
         # List of button macros...
         # Macros set to "None" will be pulled from the default macro list
@@ -7,6 +7,8 @@ app = {
     "name": "Firefox",  # Application name
     "appName": "Firefox",
     "platform": "mac",
+    # Turn the encoder to scroll the page
+    "encoder": {"action": "scroll"},
     "macros": [
         # List of button macros...
         # Macros set to "None" will be pulled from the default macro list
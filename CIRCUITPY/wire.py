@@ -0,0 +1,370 @@
+"""Message framing shared by server.py and the MacroPad.
+
+Messages are dicts. From protocol version 2 on they are sent as binary
+frames:
+
+    0xA5 | version (1) | payload length (2, big endian) | payload | checksum (2)
+
+with the payload written by Encode. Protocol version 1 peers only
+understand JSON, which is sent one message per line. FrameDecoder accepts
+both, so either side can fall back to JSON at any time.
+
+This file runs on the device as well as the host, so it sticks to what
+CircuitPython supports.
+"""
+import json
+import struct
+
+PROTOCOL_VERSION = 2
+FRAME_START = 0xA5
+HEADER_SIZE = 4
+TRAILER_SIZE = 2
+MAX_PAYLOAD = 4096
+
+NEWLINE = 0x0A
+JSON_START = 0x7B  # "{"
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_BYTES = 6
+TAG_LIST = 7
+TAG_DICT = 8
+TAG_KEY = 9
+TAG_SHORT_STR = 10
+TAG_SMALL_INT = 0x80
+"""0x80 to 0xFF carry an int from 0 to 127 in the tag itself"""
+
+KEYS = (
+    "name",
+    "platform",
+    "version",
+    "updateRequested",
+    "profile",
+    "statsRequested",
+    "stats",
+    "leds",
+    "profileChunk",
+    "profileLoaded",
+    "key",
+    "part",
+    "parts",
+    "header",
+    "data",
+    "checksum",
+    "reportKeys",
+    "keyPressed",
+    "inject",
+    "injector",
+    "ping",
+    "pong",
+    "seq",
+    "ack",
+    "digestRequested",
+    "digest",
+    "profiles",
+    "idle",
+    "injected",
+)
+"""Strings sent as a single index byte. Only append to this list, the
+index of an existing entry must never change."""
+KEY_IDS = {key: i for i, key in enumerate(KEYS)}
+
+def Checksum(data) -> int:
+    """Fletcher-16 checksum of data"""
+    a = b = 0
+    for byte in data:
+        a = (a + byte) % 255
+        b = (b + a) % 255
+    return (b << 8) | a
+
+def _EncodeInto(value, out: bytearray) -> None:
+    if value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(TAG_SMALL_INT | value)
+        else:
+            out.append(TAG_INT)
+            out.extend(struct.pack(">q", value))
+    elif isinstance(value, float):
+        out.append(TAG_FLOAT)
+        out.extend(struct.pack(">f", value))
+    elif isinstance(value, str):
+        if value in KEY_IDS:
+            out.append(TAG_KEY)
+            out.append(KEY_IDS[value])
+            return
+        value = value.encode("utf-8")
+        if len(value) < 0x100:
+            out.append(TAG_SHORT_STR)
+            out.append(len(value))
+        else:
+            out.append(TAG_STR)
+            out.extend(struct.pack(">H", len(value)))
+        out.extend(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(TAG_BYTES)
+        out.extend(struct.pack(">H", len(value)))
+        out.extend(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(TAG_LIST)
+        out.extend(struct.pack(">H", len(value)))
+        for item in value:
+            _EncodeInto(item, out)
+    elif isinstance(value, dict):
+        out.append(TAG_DICT)
+        out.extend(struct.pack(">H", len(value)))
+        for key, item in value.items():
+            _EncodeInto(key, out)
+            _EncodeInto(item, out)
+    else:
+        raise TypeError(f"Can't encode {type(value)}")
+
+def Encode(value) -> bytes:
+    """Encode value in the compact binary format"""
+    out = bytearray()
+    _EncodeInto(value, out)
+    return bytes(out)
+
+def _Check(data, end: int) -> int:
+    """end, if data holds that many bytes. Raises IndexError otherwise"""
+    if end > len(data):
+        raise IndexError("Value runs past the end of the data")
+    return end
+
+def Decode(data, offset=0):
+    """Decode one value from data. Returns (value, next offset). Raises
+    ValueError or IndexError for data that isn't a whole value"""
+    tag = data[offset]
+    offset += 1
+    if tag & TAG_SMALL_INT:
+        return tag & 0x7F, offset
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag == TAG_INT:
+        end = _Check(data, offset + 8)
+        return struct.unpack_from(">q", data, offset)[0], end
+    if tag == TAG_FLOAT:
+        end = _Check(data, offset + 4)
+        return struct.unpack_from(">f", data, offset)[0], end
+    if tag == TAG_KEY:
+        return KEYS[data[offset]], offset + 1
+    if tag == TAG_SHORT_STR:
+        end = _Check(data, offset + 1 + data[offset])
+        return bytes(data[offset + 1:end]).decode("utf-8"), end
+    if tag not in (TAG_STR, TAG_BYTES, TAG_LIST, TAG_DICT):
+        raise ValueError(f"Unknown tag {tag}")
+    _Check(data, offset + 2)
+    size = struct.unpack_from(">H", data, offset)[0]
+    offset += 2
+    if tag == TAG_STR:
+        end = _Check(data, offset + size)
+        return bytes(data[offset:end]).decode("utf-8"), end
+    if tag == TAG_BYTES:
+        end = _Check(data, offset + size)
+        return bytes(data[offset:end]), end
+    if tag == TAG_LIST:
+        items = []
+        for _ in range(size):
+            item, offset = Decode(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == TAG_DICT:
+        items = {}
+        for _ in range(size):
+            key, offset = Decode(data, offset)
+            items[key], offset = Decode(data, offset)
+        return items, offset
+
+def Frame(message: dict) -> bytes:
+    """Wrap a message in a binary frame"""
+    payload = Encode(message)
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("Message too large")
+    return (
+        struct.pack(">BBH", FRAME_START, PROTOCOL_VERSION, len(payload))
+        + payload
+        + struct.pack(">H", Checksum(payload))
+    )
+
+def JsonLine(message: dict) -> bytes:
+    """Write a message for protocol version 1 peers"""
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+def Pack(message: dict, version) -> bytes:
+    """Encode message for a peer speaking the given protocol version"""
+    if int(version) >= 2:
+        return Frame(message)
+    return JsonLine(message)
+
+class FrameDecoder:
+    """Incrementally split a byte stream into messages.
+
+    Bytes land in a preallocated ring buffer, either straight from a stream
+    with ReadFrom (readinto, no intermediate bytes objects) or copied in
+    with Feed. Next returns each complete message once. A payload that is
+    contiguous in the ring is decoded through a memoryview. Only a payload
+    that wraps around the end is copied, into a preallocated scratch
+    buffer. A newline search resumes where the previous one stopped, so a
+    message that arrives in pieces is scanned only once.
+    """
+    def __init__(self, size=2048):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.scratch = bytearray(size)
+        self.head = 0
+        self.count = 0
+        self.scanned = 0
+        self.errors = 0
+
+    def Reset(self):
+        self.head = 0
+        self.count = 0
+        self.scanned = 0
+
+    def _Free(self):
+        """Return (start, length) of the contiguous free space"""
+        tail = (self.head + self.count) % self.size
+        if tail >= self.head and self.count < self.size:
+            return tail, self.size - tail
+        return tail, self.size - self.count
+
+    def ReadFrom(self, stream) -> int:
+        """Read what the stream has waiting straight into the ring. Anything
+        that doesn't fit stays in the stream until the next call."""
+        if self.count == self.size:
+            # Next had nothing to give us from a full ring
+            self._Overflow()
+        total = 0
+        available = stream.in_waiting
+        while available and self.count < self.size:
+            start, length = self._Free()
+            length = min(length, available)
+            read = stream.readinto(self.view[start:start + length]) or 0
+            if not read:
+                break
+            self.count += read
+            total += read
+            available -= read
+            if not available:
+                available = stream.in_waiting
+        return total
+
+    def Write(self, data) -> int:
+        """Copy as much of data into the ring as fits"""
+        written = 0
+        while written < len(data) and self.count < self.size:
+            start, length = self._Free()
+            length = min(length, len(data) - written)
+            self.view[start:start + length] = data[written:written + length]
+            self.count += length
+            written += length
+        return written
+
+    def Feed(self, data) -> list:
+        """Add data and return every message it completes"""
+        messages = []
+        data = memoryview(data)
+        while True:
+            if self.count == self.size:
+                self._Overflow()
+            data = data[self.Write(data):]
+            message = self.Next()
+            while message is not None:
+                messages.append(message)
+                message = self.Next()
+            if not len(data):
+                return messages
+
+    def _Overflow(self):
+        """The ring is full without a complete message in it, drop it all"""
+        self.errors += 1
+        self.Reset()
+
+    def _Peek(self, index: int) -> int:
+        return self.buffer[(self.head + index) % self.size]
+
+    def _Consume(self, length: int):
+        self.head = (self.head + length) % self.size
+        self.count -= length
+        self.scanned = 0
+        if not self.count:
+            self.head = 0
+
+    def _Slice(self, start: int, end: int):
+        """A contiguous view of ring bytes start to end"""
+        first = (self.head + start) % self.size
+        length = end - start
+        if first + length <= self.size:
+            return self.view[first:first + length]
+        split = self.size - first
+        self.scratch[:split] = self.view[first:]
+        self.scratch[split:length] = self.view[:length - split]
+        return memoryview(self.scratch)[:length]
+
+    def Next(self):
+        """Return the next complete message, or None if more data is needed"""
+        while self.count:
+            first = self._Peek(0)
+            if first == FRAME_START:
+                if self.count < HEADER_SIZE:
+                    return None
+                version = self._Peek(1)
+                size = (self._Peek(2) << 8) | self._Peek(3)
+                end = HEADER_SIZE + size
+                if (
+                    not 2 <= version < 0x80 or size > MAX_PAYLOAD
+                    or end + TRAILER_SIZE > self.size
+                ):
+                    # A stray FRAME_START, not the start of a frame
+                    self.errors += 1
+                    self._Consume(1)
+                    continue
+                if self.count < end + TRAILER_SIZE:
+                    return None
+                checksum = (self._Peek(end) << 8) | self._Peek(end + 1)
+                payload = self._Slice(HEADER_SIZE, end)
+                if Checksum(payload) != checksum:
+                    self.errors += 1
+                    self._Consume(1)
+                    continue
+                try:
+                    message = Decode(payload)[0]
+                except (ValueError, IndexError, UnicodeError):
+                    self.errors += 1
+                    message = None
+                self._Consume(end + TRAILER_SIZE)
+                if message is not None:
+                    return message
+            elif first == JSON_START:
+                index = max(self.scanned, 1)
+                while index < self.count and self._Peek(index) != NEWLINE:
+                    index += 1
+                if index == self.count:
+                    self.scanned = index
+                    return None
+                try:
+                    message = json.loads(bytes(self._Slice(0, index)))
+                except ValueError:
+                    self.errors += 1
+                    message = None
+                self._Consume(index + 1)
+                if message is not None:
+                    return message
+            else:
+                # Whitespace between messages or line noise
+                self._Consume(1)
+        return None
@@ -0,0 +1,419 @@
+"""End to end focus-to-relabel benchmark that needs no MacroPad.
+
+server.py talks over a pty pair to an emulated device: CIRCUITPY/code.py
+running under CPython in a child process, with small stand-ins for the
+CircuitPython modules it imports. A FakeWindowSource drives focus changes
+and the time from each change to the device's title label showing the new
+profile is recorded.
+
+    python benchmark.py --iterations 200
+"""
+import argparse
+import asyncio
+import contextlib
+import fcntl
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import termios
+import time
+import tty
+import types
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEVICE_ROOT = os.path.join(ROOT, "CIRCUITPY")
+DEVICE_CODE = os.path.join(DEVICE_ROOT, "code.py")
+MACRO_FOLDER = os.path.join(DEVICE_ROOT, "macros")
+LABEL_TIMEOUT = 2.0
+NVM_SIZE = 4096
+"""Size of microcontroller.nvm on the MacroPad. Erased flash reads as 0xFF"""
+
+# --- CircuitPython stand-ins -------------------------------------------------
+
+class PtySerial:
+    """usb_cdc.data on top of the master side of a pty"""
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.timeout = 0
+        self.connected = True
+
+    @property
+    def in_waiting(self) -> int:
+        buffer = bytearray(4)
+        fcntl.ioctl(self.fd, termios.FIONREAD, buffer)
+        return int.from_bytes(buffer, sys.byteorder)
+
+    def read(self, size: int) -> bytes:
+        try:
+            return os.read(self.fd, size)
+        except BlockingIOError:
+            return b""
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def write(self, data) -> int:
+        return os.write(self.fd, bytes(data))
+
+class Label:
+    """adafruit_display_text.label.Label that reports text changes"""
+    listener = None
+
+    def __init__(self, font=None, text="", **kwargs) -> None:
+        self._text = text
+        self.index = None
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        if Label.listener is not None:
+            Label.listener(self, value)
+
+class Group(list):
+    def __init__(self, **kwargs) -> None:
+        super().__init__()
+
+class Anything:
+    """Accepts any attribute access or call"""
+    def __init__(self, **attributes) -> None:
+        self.__dict__.update(attributes)
+
+    def __getattr__(self, name):
+        return Anything()
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+class Events:
+    def get(self):
+        return None
+
+class Debouncer:
+    pressed = False
+    released = False
+
+    def update(self):
+        pass
+
+class MacroPad:
+    def __init__(self, *args, **kwargs) -> None:
+        self.pixels = Pixels()
+        self.keys = Anything(events=Events())
+        self.encoder = 0
+        self.encoder_switch_debounced = Debouncer()
+        self.display = Anything(width=128, height=64, auto_refresh=True)
+        self.keyboard = Anything()
+        self.keyboard_layout = Anything()
+        self.consumer_control = Anything()
+        self.mouse = Anything()
+        self.ConsumerControlCode = Anything()
+
+class Pixels(list):
+    def __init__(self) -> None:
+        super().__init__([0] * 12)
+        self.auto_write = True
+        self.brightness = 1.0
+
+    def show(self):
+        pass
+
+    def fill(self, color):
+        self[:] = [color] * 12
+
+class KeycodeMeta(type):
+    def __getattr__(cls, name):
+        return 4 + sum(name.encode()) % 200
+
+class Keycode(metaclass=KeycodeMeta):
+    pass
+
+def InstallDeviceModules(serial: PtySerial) -> None:
+    """Put the CircuitPython stand-ins in sys.modules"""
+    def Module(name, **attributes):
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+        return module
+
+    Module("usb_cdc", data=serial, console=None)
+    Module("displayio", Group=Group)
+    Module("terminalio", FONT=None)
+    Module("board", KEY12=None)
+    Module("microcontroller", nvm=bytearray(b"\xff" * NVM_SIZE))
+    Module("rainbowio", colorwheel=lambda index: int(index) & 0xFFFFFF)
+    Module("adafruit_macropad", MacroPad=MacroPad)
+    Module("adafruit_display_text")
+    Module("adafruit_display_text.label", Label=Label)
+    Module("adafruit_display_shapes")
+    Module("adafruit_display_shapes.rect", Rect=lambda *args, **kwargs: Label())
+    LoadKeycode()
+
+def LoadKeycode():
+    """Real keycodes when adafruit_hid is installed, made up ones otherwise"""
+    import build_macros
+    try:
+        return build_macros.LoadKeycode()
+    except ImportError:
+        keycode = types.ModuleType("adafruit_hid.keycode")
+        keycode.Keycode = Keycode
+        sys.modules.setdefault("adafruit_hid", types.ModuleType("adafruit_hid"))
+        sys.modules["adafruit_hid.keycode"] = keycode
+        return keycode
+
+def LoadFile(path: str, name: str):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def LoadDeviceCode(bundlePath=None):
+    """Import CIRCUITPY/code.py without running its main"""
+    sys.path.insert(0, DEVICE_ROOT)
+    device = LoadFile(DEVICE_CODE, "macropad_code")
+    device.MACRO_FOLDER = MACRO_FOLDER
+    device.MACRO_BUNDLE = bundlePath or os.path.join(MACRO_FOLDER, "missing")
+
+    def MacroImport(name, *args):
+        # code.py imports macros by absolute path the CircuitPython way
+        return LoadFile(f"{name}.py", os.path.basename(name))
+
+    device.__dict__["__import__"] = MacroImport
+    return device
+
+def MacroProfiles(platform="mac"):
+    """(profile key, owner, display name) of every macro file"""
+    import build_macros
+    LoadKeycode()
+    profiles, _, _ = build_macros.CollectProfiles(MACRO_FOLDER)
+    return [
+        (appKey, app["appName"], app["name"]) for appKey, app in profiles
+        if app["platform"] == platform and app["appName"] != "Default"
+    ]
+
+def BuildBundle(path: str) -> None:
+    import build_macros
+    LoadKeycode()
+    profiles, errors, _ = build_macros.CollectProfiles(MACRO_FOLDER)
+    if errors:
+        raise ValueError("\n".join(errors))
+    with open(path, "wb") as output:
+        output.write(build_macros.bundle.PackBundle(profiles))
+
+def RunDevice(fd: int, results, bundlePath=None) -> None:
+    """Child process: run code.py against the pty and report label changes"""
+    sys.stdout = open(os.devnull, "w")
+    os.set_blocking(fd, False)
+    serial = PtySerial(fd)
+    InstallDeviceModules(serial)
+    device = LoadDeviceCode(bundlePath)
+    received = [0]
+    handle = device.HandleServerMessage
+
+    def CountingHandler(message, *args):
+        received[0] += 1
+        handle(message, *args)
+
+    device.HandleServerMessage = CountingHandler
+
+    def OnText(label, text):
+        results.send((time.monotonic(), text, received[0]))
+
+    Label.listener = OnText
+    try:
+        asyncio.run(device.main())
+    except KeyboardInterrupt:
+        pass
+
+def ProcessCpuTime(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def Percentile(values, percent: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# --- Benchmark ---------------------------------------------------------------
+
+async def Benchmark(args) -> dict:
+    import server
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    slavePath = os.ttyname(slave)
+    bundlePath = None
+    if not args.no_bundle:
+        bundlePath = os.path.join(tempfile.mkdtemp(), "macros.bin")
+        BuildBundle(bundlePath)
+    parentEnd, childEnd = multiprocessing.Pipe(duplex=False)
+    device = multiprocessing.get_context("fork").Process(
+        target=RunDevice, args=(master, childEnd, bundlePath), daemon=True
+    )
+    device.start()
+
+    labels = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    loop.add_reader(parentEnd.fileno(), lambda: labels.put_nowait(parentEnd.recv()))
+
+    sent = {"messages": 0, "bytes": 0}
+    write = server.SerialWrite
+
+    def CountingWrite(macropadData, message):
+        if macropadData.Connected and message:
+            sent["messages"] += 1
+            sent["bytes"] += len(server.wire.Pack(message, macropadData.Protocol))
+        write(macropadData, message)
+
+    server.SerialWrite = CountingWrite
+
+    profiles = MacroProfiles()
+    windowData = server.ActiveWindowData()
+    windowData.Platform = "mac"
+    windowSource = server.FakeWindowSource()
+    hub = server.MacropadHub(
+        windowData, [], detectPorts=lambda: {"benchmark": slavePath}
+    )
+    coalescer = server.FocusCoalescer(args.settle, args.max_rate)
+    tasks = [
+        asyncio.ensure_future(task) for task in server.ServerTasks(
+            hub, windowData, windowSource, coalescer
+        )
+    ]
+    await asyncio.sleep(0)
+    await asyncio.wait_for(hub.Devices["benchmark"].ConnectedEvent.wait(), 10)
+    # Let the device finish booting and the first exchange settle
+    await asyncio.sleep(1)
+    while not labels.empty():
+        labels.get_nowait()
+
+    latencies = []
+    timeouts = 0
+    deviceReceived = 0
+    serverCpu = time.process_time()
+    deviceCpu = ProcessCpuTime(device.pid)
+    started = time.monotonic()
+    last = None
+    for i in range(args.iterations):
+        choices = [profile for profile in profiles if profile != last]
+        profile = random.choice(choices)
+        last = profile
+        for _ in range(args.burst):
+            other = random.choice(choices)
+            windowSource.Push(other[1])
+            await asyncio.sleep(args.burst_gap)
+        event = windowSource.Push(profile[1])
+        deadline = time.monotonic() + LABEL_TIMEOUT
+        while True:
+            try:
+                shown, text, received = await asyncio.wait_for(
+                    labels.get(), deadline - time.monotonic()
+                )
+            except asyncio.TimeoutError:
+                timeouts += 1
+                break
+            deviceReceived = received
+            if text == profile[2]:
+                latencies.append(shown - event.Time)
+                break
+        await asyncio.sleep(args.gap)
+    elapsed = time.monotonic() - started
+    serverCpu = time.process_time() - serverCpu
+    deviceCpu = ProcessCpuTime(device.pid) - deviceCpu
+
+    for task in tasks:
+        task.cancel()
+    device.kill()
+    loop.remove_reader(parentEnd.fileno())
+
+    report = {
+        "iterations": args.iterations,
+        "timeouts": timeouts,
+        "elapsedSeconds": elapsed,
+        "messagesSent": sent["messages"],
+        "bytesSent": sent["bytes"],
+        "messagesReceivedByDevice": deviceReceived,
+        "focusDelivered": coalescer.Delivered,
+        "focusSuppressed": coalescer.Suppressed,
+        "serverCpuSeconds": serverCpu,
+        "deviceCpuSeconds": deviceCpu,
+    }
+    if latencies:
+        report.update({
+            "latencyMs": {
+                "p50": Percentile(latencies, 50) * 1000,
+                "p95": Percentile(latencies, 95) * 1000,
+                "p99": Percentile(latencies, 99) * 1000,
+                "mean": statistics.mean(latencies) * 1000,
+                "max": max(latencies) * 1000,
+            },
+        })
+    for name in ("focusToWrite", "serialWrite", "roundTrip"):
+        histogram = hub.Metrics.Histograms.get(name)
+        if histogram is not None and histogram.Count:
+            report[f"{name}Ms"] = {
+                "p50": histogram.Percentile(50),
+                "p95": histogram.Percentile(95),
+                "mean": histogram.TotalMs / histogram.Count,
+                "max": histogram.MaxMs,
+            }
+    return report
+
+def PrintReport(report: dict) -> None:
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{key}:")
+            for name, number in value.items():
+                print(f"  {name:>5}: {number:8.2f}")
+        elif isinstance(value, float):
+            print(f"{key}: {value:.3f}")
+        else:
+            print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    import server
+
+    parser = argparse.ArgumentParser(
+        description="Measure focus change to MacroPad relabel latency"
+    )
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument(
+        "--gap", type=float, default=0.3,
+        help="Seconds between focus changes"
+    )
+    parser.add_argument(
+        "--burst", type=int, default=0,
+        help="Windows flicked through before each measured focus change"
+    )
+    parser.add_argument("--burst-gap", type=float, default=0.02)
+    parser.add_argument("--settle", type=float, default=server.FOCUS_SETTLE_TIME)
+    parser.add_argument("--max-rate", type=float, default=server.FOCUS_MAX_RATE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-bundle", action="store_true",
+        help="Have the device import macro files instead of a bundle"
+    )
+    parser.add_argument("--json", action="store_true", help="Print JSON")
+    parser.add_argument(
+        "--verbose", action="store_true",
+        help="Show the server's own output on stderr"
+    )
+    args = parser.parse_args()
+    random.seed(args.seed)
+    with contextlib.redirect_stdout(sys.stderr if args.verbose else open(os.devnull, "w")):
+        report = asyncio.run(Benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        PrintReport(report)
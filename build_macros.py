@@ -0,0 +1,193 @@
+"""Validate the MacroPad macro files and pack them into a bundle.
+
+Every file in CIRCUITPY/macros is imported here on the workstation with
+the real adafruit_hid keycodes. Mistakes are reported with the file and
+key they belong to, and the result is written to CIRCUITPY/macros.bin.
+The MacroPad reads that bundle at boot instead of importing each file.
+
+    python build_macros.py            # validate and write the bundle
+    python build_macros.py --check    # only validate
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEVICE_ROOT = os.path.join(ROOT, "CIRCUITPY")
+MACRO_FOLDER = os.path.join(DEVICE_ROOT, "macros")
+BUNDLE_FILE = os.path.join(DEVICE_ROOT, "macros.bin")
+DEFAULT_APP = "mac-Default"
+
+sys.path.append(DEVICE_ROOT)
+import bundle
+
+def LoadFile(path: str, name: str):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def LoadKeycode(path=None):
+    """Make `from adafruit_hid.keycode import Keycode` work on the host.
+
+    Only keycode.py is loaded. The package __init__ wants usb_hid, which
+    is only there on a board.
+    """
+    if "adafruit_hid.keycode" in sys.modules:
+        return sys.modules["adafruit_hid.keycode"]
+    if path is None:
+        spec = importlib.util.find_spec("adafruit_hid")
+        if spec is None or not spec.submodule_search_locations:
+            raise ImportError(
+                "adafruit_hid not found, pip install adafruit-circuitpython-hid"
+                " or pass --keycode with the path to keycode.py"
+            )
+        path = os.path.join(spec.submodule_search_locations[0], "keycode.py")
+    package = types.ModuleType("adafruit_hid")
+    package.__path__ = [os.path.dirname(path)]
+    sys.modules.setdefault("adafruit_hid", package)
+    keycode = LoadFile(path, "adafruit_hid.keycode")
+    sys.modules["adafruit_hid.keycode"] = keycode
+    return keycode
+
+def LoadMacroFile(path: str) -> dict:
+    """Import a macro file and return its app dict"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return LoadFile(path, f"macros.{name}").app
+
+def ValidateApp(app) -> list:
+    """Return a list of problems with an app dict"""
+    if not isinstance(app, dict):
+        return ["'app' is not a dict"]
+    errors = []
+    for key in ("name", "appName", "platform"):
+        if not isinstance(app.get(key), str):
+            errors.append(f"'{key}' is missing or not a string")
+    macros = app.get("macros")
+    if not isinstance(macros, (list, tuple)):
+        return errors + ["'macros' is missing or not a list"]
+    for slot, macro in enumerate(macros[:bundle.SLOT_COUNT]):
+        if macro is None:
+            continue
+        where = f"key {slot + 1}"
+        if not isinstance(macro, (list, tuple)) or len(macro) < 3:
+            errors.append(f"{where}: expected (color, label, sequence)")
+            continue
+        color, label, sequence = macro[:3]
+        if not isinstance(color, int) or not 0 <= color <= 0xFFFFFF:
+            errors.append(f"{where}: color {color!r} is not 0x000000-0xFFFFFF")
+        if not isinstance(label, str):
+            errors.append(f"{where}: label {label!r} is not a string")
+        if len(macro) > 3:
+            options = macro[3]
+            if not isinstance(options, dict):
+                errors.append(f"{where}: options {options!r} is not a dict")
+            else:
+                for key in options:
+                    if key not in bundle.MACRO_OPTIONS:
+                        errors.append(f"{where}: unknown option {key!r}")
+        if not isinstance(sequence, (list, tuple, str)):
+            errors.append(f"{where}: key sequence is not a list")
+            continue
+        try:
+            bundle.PackSequence(sequence)
+        except (TypeError, ValueError) as e:
+            errors.append(f"{where}: {e}")
+    return errors + ValidateEncoder(app.get("encoder"))
+
+def ValidateEncoder(encoder) -> list:
+    """Return a list of problems with an app's encoder dict"""
+    if encoder is None:
+        return []
+    if not isinstance(encoder, dict):
+        return ["encoder: expected a dict"]
+    errors = [
+        f"encoder: unknown option {key!r}"
+        for key in encoder if key not in bundle.ENCODER_OPTIONS
+    ]
+    action = encoder.get("action", "volume")
+    if action not in bundle.ENCODER_ACTIONS:
+        errors.append(
+            f"encoder: action {action!r} is not one of {bundle.ENCODER_ACTIONS}"
+        )
+    for key in ("increment", "decrement"):
+        keys = encoder.get(key)
+        if action == "keys" and not keys:
+            errors.append(f"encoder: 'keys' needs {key} keycodes")
+        if keys is not None and not isinstance(keys, (list, tuple)):
+            errors.append(f"encoder: {key} is not a list")
+            continue
+        try:
+            bundle.PackKeys(keys)
+        except ValueError as e:
+            errors.append(f"encoder: {key}: {e}")
+    return errors
+
+def CollectProfiles(folder=MACRO_FOLDER):
+    """Load every macro file. Returns ([(appKey, app)], [error], [warning])"""
+    profiles = []
+    errors = []
+    warnings = []
+    seen = {}
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith(".py"):
+            continue
+        try:
+            app = LoadMacroFile(os.path.join(folder, filename))
+        except Exception as e:
+            errors.append(f"{filename}: {type(e).__name__}: {e}")
+            continue
+        problems = ValidateApp(app)
+        if problems:
+            errors.extend(f"{filename}: {problem}" for problem in problems)
+            continue
+        appKey = f"{app['platform']}-{app['appName']}"
+        if appKey in seen:
+            errors.append(f"{filename}: {appKey} is already used by {seen[appKey]}")
+            continue
+        seen[appKey] = filename
+        if len(app["macros"]) > bundle.SLOT_COUNT:
+            warnings.append(
+                f"{filename}: only the first {bundle.SLOT_COUNT} macros are used"
+            )
+        profiles.append((appKey, app))
+    if DEFAULT_APP not in seen:
+        warnings.append(f"No macro file defines the default app {DEFAULT_APP}")
+    return profiles, errors, warnings
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Validate macro files and pack them for the MacroPad"
+    )
+    parser.add_argument("--macros", default=MACRO_FOLDER)
+    parser.add_argument("--output", default=BUNDLE_FILE)
+    parser.add_argument("--keycode", help="Path to adafruit_hid/keycode.py")
+    parser.add_argument(
+        "--check", action="store_true", help="Validate without writing"
+    )
+    args = parser.parse_args()
+    try:
+        LoadKeycode(args.keycode)
+    except ImportError as e:
+        print(e)
+        return 1
+    profiles, errors, warnings = CollectProfiles(args.macros)
+    for warning in warnings:
+        print(f"warning: {warning}")
+    for error in errors:
+        print(f"error: {error}")
+    if errors:
+        return 1
+    data = bundle.PackBundle(profiles)
+    if not args.check:
+        with open(args.output, "wb") as output:
+            output.write(data)
+        print(f"Wrote {len(profiles)} profiles, {len(data)} bytes, to {args.output}")
+    else:
+        print(f"{len(profiles)} profiles OK")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Type text on the workstation for macros the MacroPad hands to the host.
+
+A MacroPad types by sending one HID report per character, which takes
+seconds for a long snippet and only covers ASCII. Macros marked
+{'host': True} send their text to server.py instead, and one of these
+injectors puts it into the focused window.
+"""
+import asyncio
+import shutil
+import subprocess
+
+CLIPBOARD_RESTORE_DELAY = 0.3
+"""Seconds the focused app gets to read the clipboard before it is restored"""
+
+async def RunCommand(command: list, text=None, output=True) -> bytes:
+    """Run a command without blocking the event loop. Returns its output,
+    or None when output is False.
+
+    Commands that leave a child running, like xclip serving the clipboard,
+    must be run with output=False: the child keeps stdout open and reading
+    it would never finish.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=subprocess.PIPE if text is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE if output else subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    stdout, _ = await process.communicate(
+        text.encode("utf-8") if text is not None else None
+    )
+    if process.returncode:
+        raise OSError(f"{command[0]} exited with {process.returncode}")
+    return stdout
+
+class ClipboardInjector:
+    """Paste through the clipboard, then put back what was on it"""
+    Name = "clipboard"
+
+    def __init__(self, copy: list, read: list, paste: list) -> None:
+        self.Copy = copy
+        self.Read = read
+        self.Paste = paste
+
+    @classmethod
+    def ForPlatform(cls, platform: str):
+        """The injector for this platform, None without the tools it needs"""
+        if platform == "mac":
+            return cls(["pbcopy"], ["pbpaste"], [
+                "osascript", "-e",
+                'tell application "System Events" to keystroke "v" using command down',
+            ])
+        if platform == "linux" and shutil.which("xclip") and shutil.which("xdotool"):
+            return cls(
+                ["xclip", "-selection", "clipboard"],
+                ["xclip", "-selection", "clipboard", "-o"],
+                ["xdotool", "key", "--clearmodifiers", "ctrl+v"],
+            )
+        return None
+
+    async def Inject(self, text: str) -> None:
+        try:
+            previous = (await RunCommand(self.Read)).decode("utf-8")
+        except (OSError, UnicodeError):
+            previous = None
+        await RunCommand(self.Copy, text, output=False)
+        await RunCommand(self.Paste, output=False)
+        if previous is not None:
+            await asyncio.sleep(CLIPBOARD_RESTORE_DELAY)
+            await RunCommand(self.Copy, previous, output=False)
+
+class XdotoolInjector:
+    """Type with xdotool on X11. Slower than pasting but leaves the
+    clipboard alone"""
+    Name = "xdotool"
+
+    @classmethod
+    def Available(cls) -> bool:
+        return shutil.which("xdotool") is not None
+
+    async def Inject(self, text: str) -> None:
+        await RunCommand([
+            "xdotool", "type", "--clearmodifiers", "--delay", "0", "--", text
+        ], output=False)
+
+class FakeInjector:
+    """Remembers what it was asked to type, for tests"""
+    Name = "fake"
+
+    def __init__(self) -> None:
+        self.Injected = []
+
+    async def Inject(self, text: str) -> None:
+        self.Injected.append(text)
+
+def SelectInjector(name: str, platform: str):
+    """An injector by name. "auto" picks the best one this machine has.
+    None when there is none, the MacroPad then types itself"""
+    if name == "none":
+        return None
+    if name in ("auto", "clipboard"):
+        injector = ClipboardInjector.ForPlatform(platform)
+        if injector is not None or name == "clipboard":
+            return injector
+    if name in ("auto", "xdotool") and XdotoolInjector.Available():
+        return XdotoolInjector()
+    return None
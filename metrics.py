@@ -0,0 +1,199 @@
+"""Counters and latency histograms for server.py.
+
+server.py counts what it does in a Registry and can expose it in two ways,
+both JSON with the same content:
+
+    python server.py --metrics-port 9108     # GET http://localhost:9108/
+    python server.py --metrics-file metrics.json
+
+Histograms keep counts in fixed buckets, so observing is cheap and the
+memory used never grows. Percentiles are read off the buckets and are
+only as precise as the bucket they land in.
+"""
+import asyncio
+import json
+import os
+import time
+
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+"""Upper bounds of the histogram buckets. Slower values go in an overflow
+bucket"""
+METRICS_INTERVAL = 10
+"""Seconds between writes of the metrics file"""
+HTTP_TIMEOUT = 5
+
+class Histogram:
+    """Durations counted into BUCKETS_MS"""
+    def __init__(self, bounds=BUCKETS_MS) -> None:
+        self.Bounds = bounds
+        self.Counts = [0] * (len(bounds) + 1)
+        self.Count = 0
+        self.TotalMs = 0.0
+        self.MaxMs = 0.0
+
+    def Observe(self, seconds: float) -> None:
+        ms = seconds * 1000
+        index = 0
+        while index < len(self.Bounds) and ms > self.Bounds[index]:
+            index += 1
+        self.Counts[index] += 1
+        self.Count += 1
+        self.TotalMs += ms
+        self.MaxMs = max(self.MaxMs, ms)
+
+    def Percentile(self, percent: float) -> float:
+        """Upper bound of the bucket the percentile falls in, in ms"""
+        if not self.Count:
+            return 0.0
+        rank = self.Count * percent / 100
+        seen = 0
+        for bound, count in zip(self.Bounds, self.Counts):
+            seen += count
+            if seen >= rank:
+                return min(float(bound), self.MaxMs)
+        return self.MaxMs
+
+    def Snapshot(self) -> dict:
+        buckets = {
+            f"le{bound}": count for bound, count in zip(self.Bounds, self.Counts)
+        }
+        buckets["inf"] = self.Counts[-1]
+        return {
+            "count": self.Count,
+            "meanMs": self.TotalMs / self.Count if self.Count else 0.0,
+            "p50Ms": self.Percentile(50),
+            "p95Ms": self.Percentile(95),
+            "p99Ms": self.Percentile(99),
+            "maxMs": self.MaxMs,
+            "buckets": buckets,
+        }
+
+class Registry:
+    """Named counters and histograms, created the first time they are used.
+
+    A MacroPad's own numbers go under "name:serial" as well as under the
+    name, so a single slow pad stands out.
+    """
+    def __init__(self) -> None:
+        self.Started = time.monotonic()
+        self.Counters = {}
+        self.Histograms = {}
+
+    def Count(self, name: str, amount: int = 1, device: str = "") -> None:
+        self.Counters[name] = self.Counters.get(name, 0) + amount
+        if device:
+            key = f"{name}:{device}"
+            self.Counters[key] = self.Counters.get(key, 0) + amount
+
+    def Histogram(self, name: str) -> Histogram:
+        histogram = self.Histograms.get(name)
+        if histogram is None:
+            histogram = self.Histograms[name] = Histogram()
+        return histogram
+
+    def Observe(self, name: str, seconds: float, device: str = "") -> None:
+        self.Histogram(name).Observe(seconds)
+        if device:
+            self.Histogram(f"{name}:{device}").Observe(seconds)
+
+    def Snapshot(self) -> dict:
+        uptime = time.monotonic() - self.Started
+        return {
+            "time": time.time(),
+            "uptimeSeconds": uptime,
+            "counters": dict(sorted(self.Counters.items())),
+            "rates": {
+                name: value / uptime if uptime else 0.0
+                for name, value in sorted(self.Counters.items())
+            },
+            "histograms": {
+                name: histogram.Snapshot()
+                for name, histogram in sorted(self.Histograms.items())
+            },
+        }
+
+class Timer:
+    """Context manager that observes how long its block took"""
+    def __init__(self, registry: Registry, name: str, device: str = "") -> None:
+        self.Registry = registry
+        self.Name = name
+        self.Device = device
+        self.Start = None
+
+    def __enter__(self):
+        self.Start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.Registry is not None:
+            self.Registry.Observe(
+                self.Name, time.monotonic() - self.Start, self.Device
+            )
+
+def WriteFile(registry: Registry, path: str) -> None:
+    """Write a snapshot, replacing the file in one go so readers never see
+    half of it"""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as output:
+        json.dump(registry.Snapshot(), output, indent=1)
+    os.replace(temporary, path)
+
+async def WriteFilePeriodically(
+    registry: Registry, path: str, interval=METRICS_INTERVAL
+) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            WriteFile(registry, path)
+        except OSError as e:
+            print(f"Unable to write {path}: {e}")
+
+class MetricsServer:
+    """Answers every HTTP request with a JSON snapshot of the registry.
+
+    Only listens on localhost unless told otherwise.
+    """
+    def __init__(self, registry: Registry, port: int, host="127.0.0.1") -> None:
+        self.Registry = registry
+        self.Host = host
+        self.Port = port
+        self.server = None
+
+    async def Start(self) -> None:
+        self.server = await asyncio.start_server(
+            self._Client, self.Host, self.Port
+        )
+        self.Port = self.server.sockets[0].getsockname()[1]
+
+    def Stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        self.server = None
+
+    async def Run(self) -> None:
+        await self.Start()
+        print(f"Metrics on http://{self.Host}:{self.Port}/")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.Stop()
+
+    async def _Client(self, reader, writer) -> None:
+        try:
+            # The request itself doesn't matter, read up to the blank line
+            while True:
+                line = await asyncio.wait_for(reader.readline(), HTTP_TIMEOUT)
+                if not line.strip():
+                    break
+            body = json.dumps(self.Registry.Snapshot()).encode("utf-8")
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+                + body
+            )
+            await asyncio.wait_for(writer.drain(), HTTP_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
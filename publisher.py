@@ -0,0 +1,265 @@
+"""Publish what server.py sees to an external message bus.
+
+server.py hands events to an EventPublisher, which never makes it wait: a
+slow or missing broker only ever costs the oldest queued events. Backends
+are small classes with Connect, Send(batch) and Close. TcpJsonBackend
+writes one JSON object per line, MqttBackend publishes with paho-mqtt
+when it is installed.
+
+    python publisher.py                # stand-in broker printing events
+    python server.py --publish tcp://localhost:1884
+"""
+import argparse
+import asyncio
+from collections import deque
+import json
+import time
+from urllib.parse import urlparse
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+PUBLISH_QUEUE_SIZE = 1000
+PUBLISH_BATCH_SIZE = 50
+PUBLISH_LINGER = 0.05
+"""Seconds to wait for a batch to fill up"""
+PUBLISH_TIMEOUT = 5
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+TOPIC_PREFIX = "macropad"
+BROKER_PORT = 1884
+
+class TcpJsonBackend:
+    """Newline separated JSON objects over a TCP connection"""
+    def __init__(self, host: str, port: int = BROKER_PORT) -> None:
+        self.Host = host
+        self.Port = port
+        self.writer = None
+
+    @property
+    def Connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def Connect(self) -> None:
+        _, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.Host, self.Port), PUBLISH_TIMEOUT
+        )
+
+    async def Send(self, batch: list) -> None:
+        self.writer.write(b"".join(
+            (json.dumps(event) + "\n").encode("utf-8") for event in batch
+        ))
+        await asyncio.wait_for(self.writer.drain(), PUBLISH_TIMEOUT)
+
+    def Close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+
+class MqttBackend:
+    """MQTT through paho-mqtt. Each event goes to its topic as JSON"""
+    def __init__(self, host: str, port: int = 1883) -> None:
+        if mqtt is None:
+            raise ImportError("MQTT needs paho-mqtt, pip install paho-mqtt")
+        self.Host = host
+        self.Port = port
+        self.client = None
+
+    @property
+    def Connected(self) -> bool:
+        return self.client is not None and self.client.is_connected()
+
+    async def Connect(self) -> None:
+        self.Close()
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            client = mqtt.Client()
+        # paho runs the network loop on a thread of its own
+        client.connect_async(self.Host, self.Port)
+        client.loop_start()
+        self.client = client
+        deadline = time.monotonic() + PUBLISH_TIMEOUT
+        while not client.is_connected():
+            if time.monotonic() > deadline:
+                self.Close()
+                raise ConnectionError(f"No MQTT broker at {self.Host}:{self.Port}")
+            await asyncio.sleep(0.05)
+
+    async def Send(self, batch: list) -> None:
+        for event in batch:
+            info = self.client.publish(event["topic"], json.dumps(event))
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise ConnectionError(mqtt.error_string(info.rc))
+
+    def Close(self) -> None:
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+        self.client = None
+
+def Backend(url: str):
+    """A backend for tcp://host:port or mqtt://host:port"""
+    parsed = urlparse(url)
+    if parsed.scheme == "tcp":
+        return TcpJsonBackend(parsed.hostname or "localhost", parsed.port or BROKER_PORT)
+    if parsed.scheme == "mqtt":
+        return MqttBackend(parsed.hostname or "localhost", parsed.port or 1883)
+    raise ValueError(f"Don't know how to publish to {url}")
+
+class EventPublisher:
+    """Queue events and send them to a backend in batches.
+
+    Publish never waits. The queue holds at most `queueSize` events and the
+    oldest one is dropped to make room. Run connects in the background,
+    backing off exponentially while the broker is away, and sends up to
+    `batchSize` events at a time. A batch that fails to send goes back on
+    the front of the queue.
+    """
+    def __init__(self, backend, queueSize=PUBLISH_QUEUE_SIZE,
+                 batchSize=PUBLISH_BATCH_SIZE, linger=PUBLISH_LINGER) -> None:
+        self.Backend = backend
+        self.Queue = deque()
+        self.QueueSize = queueSize
+        self.BatchSize = batchSize
+        self.Linger = linger
+        self.Ready = asyncio.Event()
+        self.Published = 0
+        self.Dropped = 0
+        self.Batches = 0
+        self.Failures = 0
+        self.Connects = 0
+        self.MaxDepth = 0
+
+    def Publish(self, topic: str, payload: dict) -> None:
+        if len(self.Queue) >= self.QueueSize:
+            self.Queue.popleft()
+            self.Dropped += 1
+        event = {"topic": f"{TOPIC_PREFIX}/{topic}", "time": time.time()}
+        event.update(payload)
+        self.Queue.append(event)
+        self.MaxDepth = max(self.MaxDepth, len(self.Queue))
+        self.Ready.set()
+
+    def Stats(self) -> dict:
+        return {
+            "published": self.Published,
+            "dropped": self.Dropped,
+            "batches": self.Batches,
+            "failures": self.Failures,
+            "connects": self.Connects,
+            "depth": len(self.Queue),
+            "maxDepth": self.MaxDepth,
+        }
+
+    async def _Connect(self) -> None:
+        delay = RECONNECT_DELAY_MIN
+        while not self.Backend.Connected:
+            try:
+                await self.Backend.Connect()
+                self.Connects += 1
+            except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                self.Failures += 1
+                print(f"Publisher can't connect: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    def _Requeue(self, batch: list) -> None:
+        for event in reversed(batch):
+            if len(self.Queue) >= self.QueueSize:
+                # The batch holds the oldest events, they go first
+                self.Dropped += 1
+            else:
+                self.Queue.appendleft(event)
+
+    async def Run(self) -> None:
+        try:
+            while True:
+                while not self.Queue:
+                    self.Ready.clear()
+                    await self.Ready.wait()
+                if len(self.Queue) < self.BatchSize:
+                    await asyncio.sleep(self.Linger)
+                await self._Connect()
+                count = min(len(self.Queue), self.BatchSize)
+                batch = [self.Queue.popleft() for _ in range(count)]
+                try:
+                    await self.Backend.Send(batch)
+                except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                    print(f"Publisher lost the broker: {e}")
+                    self.Failures += 1
+                    self.Backend.Close()
+                    self._Requeue(batch)
+                    continue
+                self.Published += count
+                self.Batches += 1
+        finally:
+            self.Backend.Close()
+
+class LocalBroker:
+    """Stand-in broker for TcpJsonBackend that counts what it receives.
+
+    `delay` seconds are spent on every line, to act like a slow consumer.
+    """
+    def __init__(self, host="localhost", port=BROKER_PORT, delay=0.0,
+                 verbose=False) -> None:
+        self.Host = host
+        self.Port = port
+        self.Delay = delay
+        self.Verbose = verbose
+        self.Received = 0
+        self.Events = deque(maxlen=100)
+        self.server = None
+
+    async def Start(self) -> None:
+        self.server = await asyncio.start_server(
+            self._Client, self.Host, self.Port
+        )
+        self.Port = self.server.sockets[0].getsockname()[1]
+
+    def Stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        self.server = None
+
+    async def _Client(self, reader, writer) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                event = json.loads(line)
+                self.Received += 1
+                self.Events.append(event)
+                if self.Verbose:
+                    print(json.dumps(event))
+                if self.Delay:
+                    await asyncio.sleep(self.Delay)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def main(host: str, port: int, delay: float) -> None:
+    broker = LocalBroker(host, port, delay, verbose=True)
+    await broker.Start()
+    print(f"Listening on {broker.Host}:{broker.Port}")
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stand-in broker that prints what server.py publishes"
+    )
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=BROKER_PORT)
+    parser.add_argument(
+        "--delay", type=float, default=0,
+        help="Seconds to spend on every event, to act like a slow broker"
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.host, args.port, args.delay))
+    except KeyboardInterrupt:
+        pass
@@ -1,23 +1,88 @@
 from adafruit_board_toolkit.circuitpython_serial import data_comports
+import argparse
 import asyncio
+import binascii
+from collections import OrderedDict
 import json
-from pygetwindow import getActiveWindow
-import Quartz
+import os
+import re
+import shutil
 from serial_asyncio import open_serial_connection
 from serial import SerialException
 import sys
+import time
+import traceback
+
+# wire.py is shared with the MacroPad, so it lives on the CIRCUITPY drive
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "CIRCUITPY")
+)
+import bundle
+import wire
+import injector
+import metrics
+import publisher
 
 PLATFORM = sys.platform
+if PLATFORM == "darwin":
+    import Quartz
+try:
+    from pygetwindow import getActiveWindow
+except (ImportError, NotImplementedError):
+    # pygetwindow refuses to import on platforms it does not support
+    getActiveWindow = None
+
 WINDOW_LIBRARY = None
+WINDOW_POLL_INTERVAL = 0.3
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
+MATCH_CACHE_SIZE = 256
+FOCUS_SETTLE_TIME = 0.1
+FOCUS_MAX_HOLD = 0.5
+FOCUS_MAX_RATE = 5
+PORT_SCAN_INTERVAL = 2
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+WRITE_TIMEOUT = 5
+"""Seconds a MacroPad gets to take a message before it is dropped"""
+OUTBOUND_SIZE = 256
+"""Most messages queued for one MacroPad"""
+LATEST_ONLY = (
+    "profile", "idle", "injector", "reportKeys", "ping", "statsRequested",
+    "digestRequested",
+)
+"""Keys of messages that only matter in their newest version"""
+MACRO_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "CIRCUITPY", "macros"
+)
+MACRO_SCAN_INTERVAL = 1
+PROFILE_CHUNK = 256
+"""Bytes of a profile record sent per message"""
+PROFILE_RESENDS = 2
+"""Times a profile the MacroPad failed to load is sent again before it is
+left to the digest on the next connect"""
 SERVER_VERSION = "2022-02.0"
-MESSAGE_VERSION = "1"
+MESSAGE_VERSION = str(wire.PROTOCOL_VERSION)
+SERIAL_READ_SIZE = 256
+SERIAL_BUFFER_SIZE = 8192
+ACK_TIMEOUT = 0.5
+"""Seconds a MacroPad gets to ack a focus change before it is resent"""
+DIGEST_TIMEOUT = 2
+"""Seconds to wait for a reconnected MacroPad's digest before sending it
+everything"""
+IDLE_TIMEOUT = 300
+"""Seconds without keyboard or mouse input before the user counts as away"""
+IDLE_POLL_INTERVAL = 2
+PING_INTERVAL = 5
+"""Seconds between round trip measurements to each MacroPad"""
 
 def getActiveWindowMac():
     """Function to mimic pygetwindow behavior due to a memory leak in the for
     loop of the getActiveWindow on a mac.
 
     Returns:
-        str: String identifying the active window
+        tuple: (owner, title) of the active window. macOS only hands out
+        titles to apps with the Screen Recording permission, the title is
+        "" without it.
     """
     windows = Quartz.CGWindowListCopyWindowInfo(
         Quartz.kCGWindowListExcludeDesktopElements | Quartz.kCGWindowListOptionOnScreenOnly,
@@ -30,9 +95,300 @@ def getActiveWindowMac():
     for i in range(len(windows)):
         win = windows[i]
         if win['kCGWindowLayer'] == 0:
-            return '%s' % (
-                win[Quartz.kCGWindowOwnerName]
-            ) # Temporary. For now, we'll just return the title of the active window.
+            return (
+                '%s' % win[Quartz.kCGWindowOwnerName],
+                '%s' % win.get(Quartz.kCGWindowName, ""),
+            )
+
+class WindowEvent:
+    """A focus change reported by a window source"""
+    def __init__(self, name: str, title: str = "", timestamp=None) -> None:
+        self.Name = name
+        self.Title = title
+        self.Time = time.monotonic() if timestamp is None else timestamp
+
+class WindowSource:
+    """Base class for the things that can tell us which window has focus.
+
+    A source runs forever and puts a WindowEvent on the queue each time the
+    focused window changes. Metrics, when set, gets the time each look at
+    the OS took.
+    """
+    Metrics = None
+
+    async def Run(self, queue: asyncio.Queue):
+        raise NotImplementedError
+
+class PollingWindowSource(WindowSource):
+    """Fallback source that asks the OS for the active window on an interval"""
+    def __init__(self, platform: str, interval=WINDOW_POLL_INTERVAL) -> None:
+        self.Platform = platform
+        self.Interval = interval
+
+    def Probe(self):
+        """Return the (name, title) of the focused window"""
+        if self.Platform == "mac":
+            name, title = getActiveWindowMac() or ("", "")
+            return name.strip(), title.strip()
+        window = getActiveWindow() if getActiveWindow else None
+        if window is None:
+            return "", ""
+        title = getattr(window, "title", window)
+        return title.strip(), title.strip()
+
+    async def Run(self, queue: asyncio.Queue):
+        lastWindow = None
+        while True:
+            with metrics.Timer(self.Metrics, "windowProbe"):
+                window = self.Probe()
+            if window != lastWindow:
+                lastWindow = window
+                queue.put_nowait(WindowEvent(*window))
+            await asyncio.sleep(self.Interval)
+
+class XpropWindowSource(WindowSource):
+    """Linux/X11 source that subscribes to _NET_ACTIVE_WINDOW on the root
+    window with `xprop -spy`, so we only wake up when focus actually moves.
+    The title of the focused window is followed the same way. When xprop
+    exits, with X restarting for example, it is started again, backing off
+    exponentially up to RECONNECT_DELAY_MAX."""
+    WINDOW_ID = re.compile(rb"window id # (0x[0-9a-fA-F]+)")
+    QUOTED = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self) -> None:
+        self.WindowId = None
+        self.Name = ""
+        self.TitleTask = None
+
+    @staticmethod
+    def Available() -> bool:
+        return bool(os.environ.get("DISPLAY")) and bool(shutil.which("xprop"))
+
+    async def Query(self, windowId: str):
+        """Return the (class name, title) of an X window"""
+        process = await asyncio.create_subprocess_exec(
+            "xprop", "-id", windowId, "WM_CLASS", "_NET_WM_NAME",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        output, _ = await process.communicate()
+        name = title = ""
+        for line in output.decode("utf-8", "replace").splitlines():
+            values = self.QUOTED.findall(line)
+            if not values:
+                continue
+            if line.startswith("WM_CLASS"):
+                name = values[-1]
+            elif line.startswith("_NET_WM_NAME"):
+                title = values[0]
+        return name, title
+
+    async def WatchTitle(self, windowId: str, queue: asyncio.Queue):
+        """Follow title changes of the focused window (browser tabs etc.)"""
+        process = await asyncio.create_subprocess_exec(
+            "xprop", "-spy", "-id", windowId, "_NET_WM_NAME",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            firstLine = True
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    return
+                if firstLine:
+                    # xprop reports the current value straight away
+                    firstLine = False
+                    continue
+                values = self.QUOTED.findall(line.decode("utf-8", "replace"))
+                if values:
+                    queue.put_nowait(WindowEvent(self.Name, values[0]))
+        finally:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+
+    async def Run(self, queue: asyncio.Queue):
+        delay = RECONNECT_DELAY_MIN
+        while True:
+            try:
+                if await self.Spy(queue):
+                    delay = RECONNECT_DELAY_MIN
+                print("xprop exited, restarting it")
+            except OSError as e:
+                print(f"Unable to run xprop: {e}")
+            # Report the focused window again once xprop is back
+            self.WindowId = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    async def Spy(self, queue: asyncio.Queue) -> bool:
+        """Follow the active window until xprop exits. True if it reported
+        anything"""
+        process = await asyncio.create_subprocess_exec(
+            "xprop", "-spy", "-root", "_NET_ACTIVE_WINDOW",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        reported = False
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    return reported
+                reported = True
+                match = self.WINDOW_ID.search(line)
+                if not match:
+                    continue
+                windowId = match.group(1).decode()
+                if windowId == self.WindowId or int(windowId, 16) == 0:
+                    continue
+                self.WindowId = windowId
+                if self.TitleTask:
+                    self.TitleTask.cancel()
+                with metrics.Timer(self.Metrics, "windowProbe"):
+                    self.Name, title = await self.Query(windowId)
+                queue.put_nowait(WindowEvent(self.Name, title))
+                self.TitleTask = asyncio.create_task(
+                    self.WatchTitle(windowId, queue)
+                )
+        finally:
+            if self.TitleTask:
+                self.TitleTask.cancel()
+                self.TitleTask = None
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+
+class FakeWindowSource(WindowSource):
+    """Scriptable source for tests and benchmarks.
+
+    `script` is a sequence of (delay, name[, title]) tuples that are played
+    back in order. More events can be pushed at any time with Push.
+    """
+    def __init__(self, script=()) -> None:
+        self.Script = list(script)
+        self.Queue = asyncio.Queue()
+
+    def Push(self, name: str, title: str = "") -> WindowEvent:
+        event = WindowEvent(name, title)
+        self.Queue.put_nowait(event)
+        return event
+
+    async def Run(self, queue: asyncio.Queue):
+        self.Queue = queue
+        for delay, *window in self.Script:
+            await asyncio.sleep(delay)
+            self.Push(*window)
+
+def SelectWindowSource(platform: str) -> WindowSource:
+    """Pick the best window source for this machine"""
+    if platform == "linux" and XpropWindowSource.Available():
+        return XpropWindowSource()
+    return PollingWindowSource(platform)
+
+class IdleSource:
+    """Base class for the things that can tell us the user is away.
+
+    Probe returns True while the screen is locked, the screensaver is on
+    or nobody has touched the workstation for `timeout` seconds. Run asks
+    every `interval` seconds and puts True or False on the queue each time
+    the answer changes.
+    """
+    def __init__(self, timeout=IDLE_TIMEOUT, interval=IDLE_POLL_INTERVAL) -> None:
+        self.Timeout = timeout
+        self.Interval = interval
+
+    async def Probe(self) -> bool:
+        raise NotImplementedError
+
+    async def Run(self, queue: asyncio.Queue):
+        idle = None
+        while True:
+            try:
+                probed = await self.Probe()
+            except (OSError, ValueError) as e:
+                print(f"Unable to tell if the user is away: {e}")
+                probed = idle
+            if probed is not None and probed != idle:
+                idle = probed
+                queue.put_nowait(idle)
+            await asyncio.sleep(self.Interval)
+
+class LogindIdleSource(IdleSource):
+    """Linux session lock and idle hint from systemd-logind"""
+    @staticmethod
+    def Available() -> bool:
+        return bool(shutil.which("loginctl"))
+
+    async def Probe(self) -> bool:
+        output = await injector.RunCommand([
+            "loginctl", "show-session", os.environ.get("XDG_SESSION_ID", "auto"),
+            "-p", "IdleHint", "-p", "LockedHint",
+        ])
+        return "=yes" in output.decode("utf-8", "replace")
+
+class XprintidleIdleSource(IdleSource):
+    """Time since the last input on X11, from the screensaver extension"""
+    @staticmethod
+    def Available() -> bool:
+        return bool(os.environ.get("DISPLAY")) and bool(shutil.which("xprintidle"))
+
+    async def Probe(self) -> bool:
+        idleMs = int(await injector.RunCommand(["xprintidle"]))
+        return idleMs >= self.Timeout * 1000
+
+class MacIdleSource(IdleSource):
+    """Time since the last input on macOS, from the HID system"""
+    IDLE_TIME = re.compile(rb'"HIDIdleTime" = (\d+)')
+
+    async def Probe(self) -> bool:
+        output = await injector.RunCommand(["ioreg", "-c", "IOHIDSystem", "-d", "4"])
+        match = self.IDLE_TIME.search(output)
+        if match is None:
+            raise ValueError("ioreg reported no HIDIdleTime")
+        return int(match.group(1)) >= self.Timeout * 1000000000
+
+class AnyIdleSource(IdleSource):
+    """Away when any of several sources says so"""
+    def __init__(self, sources: list, interval=IDLE_POLL_INTERVAL) -> None:
+        super().__init__(interval=interval)
+        self.Sources = sources
+
+    async def Probe(self) -> bool:
+        for source in self.Sources:
+            if await source.Probe():
+                return True
+        return False
+
+class FakeIdleSource(IdleSource):
+    """Scriptable source for tests. Push reports the user away or back"""
+    def __init__(self) -> None:
+        super().__init__()
+        self.Queue = asyncio.Queue()
+
+    def Push(self, idle: bool) -> None:
+        self.Queue.put_nowait(idle)
+
+    async def Run(self, queue: asyncio.Queue):
+        self.Queue = queue
+
+def SelectIdleSource(name: str, platform: str, timeout=IDLE_TIMEOUT):
+    """An idle source by name. "auto" picks what this machine has. None
+    when there is none, the MacroPads then never go idle"""
+    if name == "none":
+        return None
+    sources = []
+    if name in ("auto", "logind") and platform == "linux" \
+            and LogindIdleSource.Available():
+        sources.append(LogindIdleSource(timeout))
+    if name in ("auto", "xprintidle") and XprintidleIdleSource.Available():
+        sources.append(XprintidleIdleSource(timeout))
+    if name in ("auto", "mac") and platform == "mac":
+        sources.append(MacIdleSource(timeout))
+    if not sources:
+        return None
+    return sources[0] if len(sources) == 1 else AnyIdleSource(sources)
 
 class ActiveWindowData:
     """Handle Active Window information across async calls"""
@@ -42,17 +398,311 @@ class ActiveWindowData:
             "windows" if PLATFORM in ['Windows', 'win32', 'cygwin'] else \
             "mac" if PLATFORM in ["Mac", "darwin", "os2", "os2emx"] else \
             PLATFORM
+        self.Events = asyncio.Queue()
+        self.LastEvent = None
+
+class FocusCoalescer:
+    """Sits between the window source and the MacroPad so the pad only
+    redraws for focus that sticks.
+
+    An event is held until no newer one has arrived for `settle` seconds
+    (but never longer than `maxHold`). Newer events replace the held one
+    and are counted as suppressed. Deliveries are also spaced at least
+    1 / `maxRate` seconds apart.
+    """
+    def __init__(self, settle=FOCUS_SETTLE_TIME, maxRate=FOCUS_MAX_RATE,
+                 maxHold=FOCUS_MAX_HOLD) -> None:
+        self.Settle = settle
+        self.MaxHold = max(maxHold, settle)
+        self.MinInterval = 1 / maxRate if maxRate else 0
+        self.LastDelivery = None
+        self.Delivered = 0
+        self.Suppressed = 0
+
+    async def Next(self, queue: asyncio.Queue) -> WindowEvent:
+        """Wait for the next focus change worth delivering"""
+        event = await queue.get()
+        held = time.monotonic()
+        while True:
+            now = time.monotonic()
+            deadline = min(now + self.Settle, held + self.MaxHold)
+            if self.LastDelivery is not None:
+                deadline = max(deadline, self.LastDelivery + self.MinInterval)
+            if deadline <= now and queue.empty():
+                break
+            try:
+                newer = await asyncio.wait_for(queue.get(), deadline - now)
+            except asyncio.TimeoutError:
+                break
+            self.Suppressed += 1
+            event = newer
+        self.Delivered += 1
+        self.LastDelivery = time.monotonic()
+        return event
+
+class ContextRule:
+    """One entry of the rule manifest.
+
+    Every condition that is given has to match: `owner` is compared exactly,
+    `ownerPattern` and `titlePattern` are regular expressions searched for
+    in the owner name and window title, and `title` is a case insensitive
+    substring of the title. The highest `priority` wins, ties go to the
+    rule listed first. A rule with `devices` only applies to the MacroPads
+    with those serial numbers.
+    """
+    def __init__(self, rule: dict, order: int) -> None:
+        if not isinstance(rule, dict):
+            raise TypeError("a rule must be an object")
+        self.Profile = rule.get("profile")
+        if not isinstance(self.Profile, str):
+            raise ValueError("a rule needs a \"profile\" string")
+        if not self.Profile.partition("-")[2]:
+            raise ValueError(
+                f"profile {self.Profile!r} isn't a <platform>-<appName> key"
+            )
+        self.Platform = rule.get("platform")
+        self.Devices = rule.get("devices")
+        self.Owner = rule.get("owner")
+        self.OwnerPattern = re.compile(rule["ownerPattern"]) \
+            if "ownerPattern" in rule else None
+        self.Title = rule["title"].lower() if "title" in rule else None
+        self.TitlePattern = re.compile(rule["titlePattern"]) \
+            if "titlePattern" in rule else None
+        self.Priority = int(rule.get("priority", 0))
+        self.Order = order
+
+    def Matches(self, owner: str, title: str, lowerTitle: str) -> bool:
+        if self.Owner is not None and owner != self.Owner:
+            return False
+        if self.OwnerPattern and not self.OwnerPattern.search(owner):
+            return False
+        if self.Title is not None and self.Title not in lowerTitle:
+            return False
+        if self.TitlePattern and not self.TitlePattern.search(title):
+            return False
+        return True
+
+    def AppliesTo(self, platform: str, device=None) -> bool:
+        if self.Platform is not None and self.Platform != platform:
+            return False
+        return self.Devices is None or device in self.Devices
+
+def CompileRules(rules: list) -> list:
+    """ContextRules for every rule of a manifest. Rules that are compiled
+    already are kept. Raises ValueError naming the first bad rule"""
+    compiled = []
+    for i, rule in enumerate(rules):
+        if isinstance(rule, ContextRule):
+            compiled.append(rule)
+            continue
+        try:
+            compiled.append(ContextRule(rule, i))
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            raise ValueError(f"rule {i + 1} {rule!r}: {e}") from None
+    return compiled
+
+def LoadRules(path: str) -> list:
+    """Read the rules of a JSON manifest. A missing file means no rules"""
+    try:
+        with open(path, encoding="utf-8") as manifest:
+            return json.load(manifest).get("rules", [])
+    except FileNotFoundError:
+        return []
+
+class ContextMatcher:
+    """Resolve a focused window to the key of the profile the MacroPad
+    should show.
+
+    Rules for other platforms are dropped when the manifest is compiled.
+    Rules with an exact owner are indexed by that owner, so a lookup only
+    evaluates those plus the rules that have no exact owner, each list
+    already in priority order. Results are memoized per (owner, title).
+    Windows no rule claims keep the "<platform>-<owner>" key the device has
+    always used. Given a device serial number, rules meant only for other
+    devices are dropped as well. Rules can be given already compiled by
+    CompileRules, so one manifest is only compiled once for every pad.
+    """
+    def __init__(self, rules: list, platform: str,
+                 cacheSize=MATCH_CACHE_SIZE, device=None) -> None:
+        self.Platform = platform
+        self.ByOwner = {}
+        self.Others = []
+        compiled = [
+            rule for rule in CompileRules(rules)
+            if rule.AppliesTo(platform, device)
+        ]
+        compiled.sort(key=lambda rule: (-rule.Priority, rule.Order))
+        for rule in compiled:
+            if rule.Owner is not None:
+                self.ByOwner.setdefault(rule.Owner, []).append(rule)
+            else:
+                self.Others.append(rule)
+        self.Cache = OrderedDict()
+        self.CacheSize = cacheSize
+
+    @classmethod
+    def Load(cls, path: str, platform: str, device=None):
+        """Build a matcher from a JSON manifest"""
+        return cls(LoadRules(path), platform, device=device)
+
+    @staticmethod
+    def _First(rules, owner, title, lowerTitle):
+        for rule in rules:
+            if rule.Matches(owner, title, lowerTitle):
+                return rule
+        return None
+
+    def Match(self, owner: str, title: str = "") -> str:
+        key = (owner, title)
+        profile = self.Cache.get(key)
+        if profile is not None:
+            self.Cache.move_to_end(key)
+            return profile
+        lowerTitle = title.lower()
+        best = self._First(self.ByOwner.get(owner, ()), owner, title, lowerTitle)
+        other = self._First(self.Others, owner, title, lowerTitle)
+        if other is not None and (
+            best is None or
+            (-other.Priority, other.Order) < (-best.Priority, best.Order)
+        ):
+            best = other
+        profile = best.Profile if best else f"{self.Platform}-{owner}"
+        self.Cache[key] = profile
+        if len(self.Cache) > self.CacheSize:
+            self.Cache.popitem(last=False)
+        return profile
+
+class OutboundQueue:
+    """Messages waiting to be written to one MacroPad.
+
+    A message with a key from LATEST_ONLY replaces a queued one with the
+    same key, which is counted as superseded, so a stalled pad only ever
+    has the newest focus change waiting. Other messages, like profile
+    chunks, keep their order. At most `size` messages are held. When it is
+    full the oldest of those is dropped.
+    """
+    def __init__(self, size=OUTBOUND_SIZE, registry=None, serial="") -> None:
+        self.Size = size
+        self.Metrics = registry if registry is not None else metrics.Registry()
+        self.Serial = serial
+        self.Messages = OrderedDict()
+        self.Ready = asyncio.Event()
+        self.Next = 0
+
+    def __len__(self) -> int:
+        return len(self.Messages)
+
+    def Put(self, message: dict) -> None:
+        slot = next((key for key in LATEST_ONLY if key in message), None)
+        if slot is not None and slot in self.Messages:
+            del self.Messages[slot]
+            self.Metrics.Count("superseded", device=self.Serial)
+        elif len(self.Messages) >= self.Size:
+            oldest = next(
+                (key for key in self.Messages if not isinstance(key, str)),
+                next(iter(self.Messages))
+            )
+            del self.Messages[oldest]
+            self.Metrics.Count("outboundDropped", device=self.Serial)
+        if slot is None:
+            slot = self.Next
+            self.Next += 1
+        self.Messages[slot] = message
+        self.Ready.set()
+
+    async def Get(self) -> dict:
+        while not self.Messages:
+            self.Ready.clear()
+            await self.Ready.wait()
+        return self.Messages.popitem(last=False)[1]
+
+    def Clear(self) -> None:
+        if self.Messages:
+            self.Metrics.Count("outboundDropped", len(self.Messages), self.Serial)
+        self.Messages.clear()
 
 class MacropadData:
-    """Handle MacroPad serial data across async calls"""
-    def __init__(self) -> None:
+    """Handle one MacroPad's serial data across async calls.
+
+    Tasks never poll `Connected`; they wait on ConnectedEvent or
+    DisconnectedEvent, which are flipped together by SetConnected and
+    SetDisconnected. Messages for the pad go through its own Outbound
+    queue. Profile is the last profile queued for it and FocusTime when
+    the focus change behind it happened.
+
+    Once the pad has sent a digest it is known to ack, and focus changes
+    carry a sequence number. Pending holds the (seq, message, sent time)
+    of the newest one not acked yet.
+    """
+    def __init__(self, serial: str = "", matcher=None, registry=None) -> None:
+        self.Serial = serial
+        self.Matcher = matcher
+        self.Metrics = registry if registry is not None else metrics.Registry()
+        self.Profile = ""
+        self.FocusTime = None
+        self.Acks = False
+        self.Seq = 0
+        self.Pending = None
+        self.PendingEvent = asyncio.Event()
+        self.Digest = None
+        self.DigestEvent = asyncio.Event()
+        self.Injecting = None
+        """(id, parts, texts) of the text the pad is sending over"""
+        self.ProfileResends = {}
+        """Times each profile was sent again after the pad failed to load it"""
+        self.Outbound = OutboundQueue(registry=self.Metrics, serial=serial)
         self.Connected = False
         self.Port = ""
         self.Buffer = ""
-        self.Incoming = ""
+        self.Incoming = asyncio.Queue()
         self.ReadStart = None
         self.reader = None
         self.writer = None
+        self.ConnectedEvent = asyncio.Event()
+        self.DisconnectedEvent = asyncio.Event()
+        self.DisconnectedEvent.set()
+        self.Reconnects = 0
+        self.Protocol = 1
+        self.Decoder = wire.FrameDecoder(SERIAL_BUFFER_SIZE)
+
+    def SetConnected(self, port: str, reader, writer) -> None:
+        self.Port = port
+        self.reader = reader
+        self.writer = writer
+        self.Connected = True
+        self.Reconnects += 1
+        self.Metrics.Count("connects", device=self.Serial)
+        # Speak JSON until the MacroPad tells us which version it understands
+        self.Protocol = 1
+        self.Decoder.Reset()
+        # Numbering starts over, the pad does the same on digestRequested
+        self.Acks = False
+        self.Seq = 0
+        self.Digest = None
+        self.DigestEvent.clear()
+        self.Injecting = None
+        self.ProfileResends.clear()
+        self.DisconnectedEvent.clear()
+        self.ConnectedEvent.set()
+        print(f"Connected to MacroPad {self.Serial} on {port}")
+
+    def SetDisconnected(self, reason: str = "") -> None:
+        if not self.Connected:
+            return
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+        self.Connected = False
+        self.ConnectedEvent.clear()
+        self.DisconnectedEvent.set()
+        self.Metrics.Count("disconnects", device=self.Serial)
+        # Nothing queued is worth sending to the next connection. The
+        # newest state goes out again once the pad's digest is in
+        self.Profile = ""
+        self.Pending = None
+        self.Outbound.Clear()
+        print(f"Disconnected from Macropad {self.Serial} {reason}".strip())
 
     def data_received(self, data: bytes) -> None:
         print("data received", repr(data))
@@ -65,110 +715,748 @@ class MacropadData:
         print("connection lost")
         self.transport.loop.stop()
 
-def DetectPort():
-    comports = data_comports()
-    ports = [
-        comport.device for comport in comports
+def DetectPorts() -> dict:
+    """Map the serial number of every connected MacroPad to its data port"""
+    return {
+        comport.serial_number or comport.device: comport.device
+        for comport in data_comports()
         if comport.description.startswith("Macropad")
-    ]
-    if len(ports) > 0:
-        return ports[0]
+    }
+
+async def OpenSerialConnection(data:MacropadData, detectPorts=DetectPorts):
+    """Keep one MacroPad connected, whichever port its serial number is on.
+
+    While connected the ports are rescanned every PORT_SCAN_INTERVAL so an
+    unplugged pad is noticed even if no read is pending. Failed opens back
+    off exponentially up to RECONNECT_DELAY_MAX.
+    """
+    delay = RECONNECT_DELAY_MIN
+    while True:
+        port = detectPorts().get(data.Serial)
+        if data.Connected:
+            if data.Port != port:
+                data.SetDisconnected("(port removed)")
+                continue
+            try:
+                await asyncio.wait_for(
+                    data.DisconnectedEvent.wait(), PORT_SCAN_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            continue
+        if port is None:
+            # Not plugged in, just watch for its port to show up
+            await asyncio.sleep(PORT_SCAN_INTERVAL)
+            continue
+        try:
+            reader, writer = await open_serial_connection(
+                url=port,
+                baudrate=9600
+            )
+        except (SerialException, OSError) as e:
+            print(f"Unable to open {port}: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+            continue
+        delay = RECONNECT_DELAY_MIN
+        data.SetConnected(port, reader, writer)
+
+class MacropadHub:
+    """Every MacroPad seen so far, by serial number.
+
+    Run picks up new pads and gives each its own MacropadData, matcher and
+    tasks. Broadcast hands a focus change to all of them. Each pad queues
+    what it has to send on its own Outbound queue, so a slow or unplugged
+    pad only ever holds up itself. With a Publisher, focus changes, key
+    presses and connection changes are published as well. With an
+    Injector, text the pads send over is typed here, in the order it came.
+    Everything is counted and timed in Metrics. SetIdle tells every pad
+    whether the user is away.
+    """
+    def __init__(self, windowData: ActiveWindowData, rules: list,
+                 detectPorts=DetectPorts, eventPublisher=None,
+                 textInjector=None, registry=None) -> None:
+        self.WindowData = windowData
+        self.Metrics = registry if registry is not None else metrics.Registry()
+        self.Rules = CompileRules(rules)
+        self.DetectPorts = detectPorts
+        self.Publisher = eventPublisher
+        self.Injector = textInjector
+        self.Injections = asyncio.Queue()
+        self.Idle = False
+        self.Devices = {}
+        self.Tasks = []
+        self.Profiles = OrderedDict()
+        """appKey: (header, record) of every profile streamed so far"""
+
+    def Add(self, serial: str) -> MacropadData:
+        matcher = ContextMatcher(
+            self.Rules, self.WindowData.Platform, device=serial
+        )
+        data = MacropadData(serial, matcher, self.Metrics)
+        self.Devices[serial] = data
+        self.Tasks.extend(
+            asyncio.ensure_future(Supervise(data, name, task))
+            for name, task in DeviceTasks(data, self)
+        )
+        print(f"Found MacroPad {serial}")
+        return data
+
+    def Broadcast(self, event: WindowEvent) -> None:
+        self.Metrics.Count("focusChanges")
+        for data in self.Devices.values():
+            SendFocus(data, event)
+        self.Publish("focus", {
+            "name": event.Name,
+            "title": event.Title,
+            "platform": self.WindowData.Platform,
+            "profiles": {
+                serial: data.Profile for serial, data in self.Devices.items()
+            },
+        })
+
+    def SetIdle(self, idle: bool) -> None:
+        if idle == self.Idle:
+            return
+        self.Idle = idle
+        print("User away" if idle else "User back")
+        self.Metrics.Count("idleChanges")
+        for data in self.Devices.values():
+            Send(data, {"idle": idle})
+        self.Publish("idle", {"idle": idle})
+
+    def Publish(self, topic: str, payload: dict) -> None:
+        if self.Publisher is not None:
+            self.Publisher.Publish(topic, payload)
+
+    def BroadcastProfile(self, appKey: str, header: list, record: bytes) -> None:
+        self.Profiles[appKey] = (header, record)
+        self.Profiles.move_to_end(appKey)
+        for data in self.Devices.values():
+            # A new version gets its own resends
+            data.ProfileResends.pop(appKey, None)
+            SendProfile(data, appKey, header, record)
+
+    async def Run(self) -> None:
+        try:
+            while True:
+                for serial in self.DetectPorts():
+                    if serial not in self.Devices:
+                        self.Add(serial)
+                await asyncio.sleep(PORT_SCAN_INTERVAL)
+        finally:
+            for task in self.Tasks:
+                task.cancel()
+
+def Send(macropadData: MacropadData, message: dict) -> None:
+    """Queue a message for one MacroPad. Dropped while it is disconnected"""
+    if macropadData.Connected:
+        macropadData.Outbound.Put(message)
     else:
-        return ""
+        macropadData.Metrics.Count("outboundDropped", device=macropadData.Serial)
+
+def SendFocus(macropadData: MacropadData, event: WindowEvent) -> None:
+    """Queue the profile for a focused window, unless the pad has it. Only
+    the profile key goes over, the rules have already picked it"""
+    profile = macropadData.Matcher.Match(event.Name, event.Title)
+    if profile == macropadData.Profile or not macropadData.Connected:
+        return
+    print(f"{macropadData.Serial}: {event.Name} -> {profile}")
+    macropadData.Profile = profile
+    macropadData.FocusTime = event.Time
+    message = {"profile": profile}
+    if macropadData.Acks:
+        macropadData.Seq += 1
+        message["seq"] = macropadData.Seq
+        macropadData.Pending = (macropadData.Seq, message, time.monotonic())
+        macropadData.PendingEvent.set()
+    Send(macropadData, message)
+
+async def AckWatcher(macropadData: MacropadData):
+    """Resend the newest focus change every ACK_TIMEOUT until it is acked.
+    Older ones don't matter, the newest replaces them on the pad"""
+    while True:
+        await macropadData.PendingEvent.wait()
+        pending = macropadData.Pending
+        await asyncio.sleep(ACK_TIMEOUT)
+        if macropadData.Pending is None:
+            macropadData.PendingEvent.clear()
+        elif macropadData.Pending is pending and macropadData.Connected:
+            macropadData.Metrics.Count("resends", device=macropadData.Serial)
+            Send(macropadData, pending[1])
 
-async def OpenSerialConnection(data:MacropadData):
-    port = ""
+def Resync(macropadData: MacropadData, hub: MacropadHub, digest) -> None:
+    """Send a MacroPad whatever differs from its digest, or everything
+    when there is no digest"""
+    if digest is None:
+        digest = {}
+    sent = 0
+    reportKeys = hub.Publisher is not None
+    if digest.get("reportKeys") != reportKeys:
+        Send(macropadData, {"reportKeys": reportKeys})
+        sent += 1
+    # A pad doesn't keep the injector of an earlier server
+    name = hub.Injector.Name if hub.Injector is not None else None
+    if "injector" not in digest or digest["injector"] != name:
+        Send(macropadData, {"injector": name})
+        sent += 1
+    if bool(digest.get("idle")) != hub.Idle:
+        Send(macropadData, {"idle": hub.Idle})
+        sent += 1
+    checksums = digest.get("profiles") or {}
+    for appKey, (header, record) in list(hub.Profiles.items()):
+        if checksums.get(appKey) != wire.Checksum(record):
+            SendProfile(macropadData, appKey, header, record)
+            sent += 1
+    windowData = hub.WindowData
+    if windowData.LastEvent is not None:
+        event = windowData.LastEvent
+        profile = macropadData.Matcher.Match(event.Name, event.Title)
+        if digest.get("profile") == profile:
+            macropadData.Profile = profile
+        else:
+            macropadData.Profile = ""
+            SendFocus(macropadData, event)
+            sent += 1
+    macropadData.Metrics.Count("resyncs", device=macropadData.Serial)
+    macropadData.Metrics.Count("resyncSent", sent, macropadData.Serial)
+
+def SendProfile(
+    macropadData: MacropadData, appKey: str, header: list, record: bytes
+) -> None:
+    """Queue a packed profile for one MacroPad, PROFILE_CHUNK bytes at a
+    time, with a checksum of the whole record"""
+    parts = max(1, -(-len(record) // PROFILE_CHUNK))
+    checksum = wire.Checksum(record)
+    for part in range(parts):
+        data = record[part * PROFILE_CHUNK:(part + 1) * PROFILE_CHUNK]
+        if int(macropadData.Protocol) < 2:
+            # JSON can't carry bytes
+            data = binascii.b2a_base64(data).decode("ascii").strip()
+        chunk = {"key": appKey, "part": part, "parts": parts, "data": data}
+        if part == 0:
+            chunk["header"] = header
+            chunk["checksum"] = checksum
+        Send(macropadData, {"profileChunk": chunk})
+
+def ReceiveText(macropadData: MacropadData, hub: MacropadHub, chunk) -> None:
+    """Join the [id, part, parts, text] chunks of a text to type. Once all
+    of it is in, it is queued for RunInjections"""
+    try:
+        injectId, part, parts, text = chunk
+    except (TypeError, ValueError):
+        macropadData.Metrics.Count("parseErrors", device=macropadData.Serial)
+        return
+    if part == 0:
+        macropadData.Injecting = (injectId, parts, [])
+    injecting = macropadData.Injecting
+    if (
+        injecting is None or injecting[0] != injectId
+        or len(injecting[2]) != part or not isinstance(text, str)
+    ):
+        # A chunk went missing, the rest of this text can't be typed
+        macropadData.Injecting = None
+        return
+    injecting[2].append(text)
+    if len(injecting[2]) == parts:
+        macropadData.Injecting = None
+        hub.Injections.put_nowait(
+            (macropadData, injectId, "".join(injecting[2]))
+        )
+
+async def RunInjections(hub: MacropadHub):
+    """Type the text the MacroPads send over, one after the other. The pad
+    is told when each one is done, failed or not, so its macro can go on"""
+    while True:
+        macropadData, injectId, text = await hub.Injections.get()
+        try:
+            await hub.Injector.Inject(text)
+        except OSError as e:
+            print(f"Unable to type {len(text)} characters: {e}")
+        Send(macropadData, {"injected": injectId})
+
+async def DeviceSync(macropadData: MacropadData, hub: MacropadHub):
+    """Bring a MacroPad that (re)connects up to date.
+
+    The pad is asked for a digest of its focus profile, streamed profiles
+    and settings, and Resync sends only what differs. A pad that doesn't
+    answer within DIGEST_TIMEOUT gets everything.
+    """
     while True:
-        if not data.Connected:
-            port = DetectPort()
-            if port:
-                try:
-                    data.reader, data.writer = await open_serial_connection(
-                        url=port,
-                        baudrate=9600
-                    )
-                    data.Connected = True
-                    print("Connected to MacroPad")
-                except SerialException:
-                    data.Connected = False
-        elif not data.Connected:
-            data.reader = None
-            data.writer = None
-        await asyncio.sleep(2)
+        await macropadData.ConnectedEvent.wait()
+        hub.Publish("connection", {
+            "serial": macropadData.Serial,
+            "port": macropadData.Port,
+            "connected": True,
+        })
+        Send(macropadData, {
+            "digestRequested": True, "version": MESSAGE_VERSION
+        })
+        try:
+            await asyncio.wait_for(
+                macropadData.DigestEvent.wait(), DIGEST_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            pass
+        if macropadData.Connected:
+            Resync(macropadData, hub, macropadData.Digest)
+        await macropadData.DisconnectedEvent.wait()
+        hub.Publish("connection", {
+            "serial": macropadData.Serial,
+            "port": macropadData.Port,
+            "connected": False,
+        })
+
+class ProfileWatcher:
+    """Streams edited macro files to the MacroPads.
+
+    The folder is rescanned every `interval` seconds. A file that is new or
+    has a new mtime is checked the way build_macros.py does it, packed as a
+    bundle record and broadcast. Files that are there at start are taken to
+    be on the pads already.
+    """
+    def __init__(self, hub: MacropadHub, folder=MACRO_FOLDER,
+                 interval=MACRO_SCAN_INTERVAL) -> None:
+        self.Hub = hub
+        self.Folder = folder
+        self.Interval = interval
+        self.Times = {}
+        self.Unreadable = False
+
+    def Scan(self) -> list:
+        """Names of the macro files changed since the last scan. A folder
+        that can't be read, an unmounted drive say, changes nothing"""
+        try:
+            filenames = sorted(os.listdir(self.Folder))
+        except OSError as e:
+            if not self.Unreadable:
+                print(f"Unable to scan {self.Folder}: {e}")
+            self.Unreadable = True
+            return []
+        self.Unreadable = False
+        changed = []
+        times = {}
+        for filename in filenames:
+            if not filename.endswith(".py"):
+                continue
+            try:
+                times[filename] = os.stat(os.path.join(self.Folder, filename)).st_mtime
+            except OSError:
+                continue
+            if self.Times.get(filename) != times[filename]:
+                changed.append(filename)
+        self.Times = times
+        return changed
+
+    def Pack(self, filename: str):
+        """(appKey, header, record) for a macro file, None if it has errors"""
+        import build_macros
+        try:
+            app = build_macros.LoadMacroFile(os.path.join(self.Folder, filename))
+        except Exception as e:
+            print(f"{filename}: {type(e).__name__}: {e}")
+            return None
+        problems = build_macros.ValidateApp(app)
+        for problem in problems:
+            print(f"{filename}: {problem}")
+        if problems:
+            return None
+        appKey = f"{app['platform']}-{app['appName']}"
+        header = [app["platform"], app["appName"], app["name"]]
+        return appKey, header, bundle.PackProfile(app)
+
+    async def Run(self) -> None:
+        import build_macros
+        try:
+            build_macros.LoadKeycode()
+        except ImportError as e:
+            print(f"Not watching {self.Folder}: {e}")
+            return
+        self.Scan()
+        while True:
+            await asyncio.sleep(self.Interval)
+            for filename in self.Scan():
+                packed = self.Pack(filename)
+                if packed is not None:
+                    print(f"Sending {filename} as {packed[0]}")
+                    self.Hub.BroadcastProfile(*packed)
 
 async def GetActiveWindowData(
-    windowData: ActiveWindowData, macropadData:MacropadData
+    windowData: ActiveWindowData, hub: MacropadHub, coalescer: FocusCoalescer
 ):
-    """Poll the computer for it's active window"""
+    """Forward focus changes from the window source to every MacroPad"""
     while True:
-        if windowData.Platform == "mac":
-            currentWindow = getActiveWindowMac().strip()
-        else:
-            currentWindow = getActiveWindow().strip()
-        if currentWindow != windowData.WindowName:
-            print(currentWindow)
-            windowData.WindowName = currentWindow
-            message = json.dumps(
-                {
-                    "name": currentWindow,
-                    "platform": windowData.Platform,
-                    "version": MESSAGE_VERSION
-                }
-            )
-            SerialWrite(macropadData.writer, message)
-        await asyncio.sleep(0.3)
+        event = await coalescer.Next(windowData.Events)
+        windowData.LastEvent = event
+        windowData.WindowName = event.Name
+        hub.Broadcast(event)
+
+async def WatchIdle(hub: MacropadHub, idleSource: IdleSource):
+    """Tell the MacroPads when the user goes away and comes back"""
+    queue = asyncio.Queue()
+    task = asyncio.ensure_future(idleSource.Run(queue))
+    try:
+        while True:
+            hub.SetIdle(await queue.get())
+    finally:
+        task.cancel()
+
+async def DeviceWriter(macropadData: MacropadData):
+    """Send one MacroPad's queued messages, waiting for each to go out.
+
+    Only one message is ever in the serial buffer, the rest wait in
+    Outbound where newer state can still replace them. The time a write
+    takes and, for focus changes, the time from the window source noticing
+    it to the write going out, are recorded.
+    """
+    registry = macropadData.Metrics
+    serial = macropadData.Serial
+    while True:
+        message = await macropadData.Outbound.Get()
+        start = time.monotonic()
+        SerialWrite(macropadData, message)
+        if not macropadData.Connected:
+            registry.Count("outboundDropped", device=serial)
+            continue
+        try:
+            await asyncio.wait_for(macropadData.writer.drain(), WRITE_TIMEOUT)
+        except asyncio.TimeoutError:
+            registry.Count("writeTimeouts", device=serial)
+            macropadData.SetDisconnected("(write timed out)")
+            continue
+        except (SerialException, OSError) as e:
+            macropadData.SetDisconnected(f"({e})")
+            continue
+        now = time.monotonic()
+        registry.Count("messagesOut", device=serial)
+        registry.Observe("serialWrite", now - start, serial)
+        if "profile" in message and macropadData.FocusTime is not None:
+            registry.Observe("focusToWrite", now - macropadData.FocusTime, serial)
 
 def SerialWrite(
-    writer, message
+    macropadData: MacropadData, message
 ):
-    """Get/Send Messages to the Macropad"""
-    if writer and message:
-        writer.write(message.encode("utf-8"))
+    """Send a message to the Macropad in the protocol it understands"""
+    if not (macropadData.Connected and message):
+        return
+    try:
+        data = wire.Pack(message, macropadData.Protocol)
+    except (TypeError, ValueError) as e:
+        macropadData.Metrics.Count("packErrors", device=macropadData.Serial)
+        print(f"Unable to send {list(message)} to {macropadData.Serial}: {e}")
+        return
+    try:
+        macropadData.writer.write(data)
+    except (SerialException, OSError) as e:
+        macropadData.SetDisconnected(f"({e})")
 
 async def SerialRead(
     macropadData: MacropadData,
 ):
     while True:
-        if macropadData.Connected:
-            try:
-                data = await macropadData.reader.readline()
-                macropadData.Incoming = json.loads(data)
-            except SerialException:
-                macropadData.Connected = False
-                print("Disconnected from Macropad")
-            except ValueError:
-                pass
-        else:
-            await asyncio.sleep(0)
+        await macropadData.ConnectedEvent.wait()
+        try:
+            data = await macropadData.reader.read(SERIAL_READ_SIZE)
+        except (SerialException, OSError) as e:
+            macropadData.SetDisconnected(f"({e})")
+            continue
+        if not data:
+            macropadData.SetDisconnected("(end of stream)")
+            continue
+        errors = macropadData.Decoder.errors
+        messages = macropadData.Decoder.Feed(data)
+        registry = macropadData.Metrics
+        registry.Count("messagesIn", len(messages), macropadData.Serial)
+        if macropadData.Decoder.errors != errors:
+            registry.Count(
+                "parseErrors", macropadData.Decoder.errors - errors,
+                macropadData.Serial
+            )
+        for message in messages:
+            macropadData.Incoming.put_nowait(message)
+
+async def IncomingHandler(macropadData: MacropadData, hub: MacropadHub):
+    """Act on messages from one MacroPad. One that isn't shaped the way it
+    should be is counted as a parse error and skipped"""
+    while True:
+        data = await macropadData.Incoming.get()
+        if not isinstance(data, dict):
+            continue
+        try:
+            HandleMessage(macropadData, hub, data)
+        except (TypeError, ValueError, KeyError, IndexError) as e:
+            macropadData.Metrics.Count("parseErrors", device=macropadData.Serial)
+            print(f"Bad message from MacroPad {macropadData.Serial}: {e}")
+
+def HandleMessage(macropadData: MacropadData, hub: MacropadHub, data: dict):
+    """Apply one decoded message from a MacroPad"""
+    windowData = hub.WindowData
+    if "version" in data:
+        try:
+            macropadData.Protocol = min(
+                int(data["version"]), wire.PROTOCOL_VERSION
+            )
+        except (TypeError, ValueError):
+            pass
+    if data.get('updateRequested') and windowData.LastEvent is not None:
+        macropadData.Profile = ""
+        SendFocus(macropadData, windowData.LastEvent)
+    if "inject" in data and hub.Injector is not None:
+        ReceiveText(macropadData, hub, data["inject"])
+    if "keyPressed" in data:
+        appKey, key, label = data["keyPressed"]
+        hub.Publish("key", {
+            "serial": macropadData.Serial,
+            "profile": appKey,
+            "key": key,
+            "label": label,
+        })
+    if "digest" in data and isinstance(data["digest"], dict):
+        if not isinstance(data["digest"].get("profiles", {}), dict):
+            raise ValueError("digest profiles must be a dict")
+        macropadData.Digest = data["digest"]
+        macropadData.Acks = True
+        macropadData.DigestEvent.set()
+    if "ack" in data:
+        pending = macropadData.Pending
+        try:
+            acked = int(data["ack"])
+        except (TypeError, ValueError):
+            acked = 0
+        if pending is not None and acked >= pending[0]:
+            macropadData.Pending = None
+            macropadData.Metrics.Observe(
+                "ack", time.monotonic() - pending[2], macropadData.Serial
+            )
+    if "pong" in data:
+        try:
+            sent = int(data["pong"])
+        except (TypeError, ValueError):
+            sent = None
+        if sent is not None:
+            macropadData.Metrics.Observe(
+                "roundTrip", (time.monotonic_ns() // 1000 - sent) / 1000000,
+                macropadData.Serial
+            )
+    if "profileLoaded" in data:
+        appKey, loaded = data["profileLoaded"]
+        print(f"MacroPad {macropadData.Serial}"
+              f" {'loaded' if loaded else 'failed to load'} {appKey}")
+        resends = macropadData.ProfileResends
+        if loaded:
+            resends.pop(appKey, None)
+        elif appKey in hub.Profiles and resends.get(appKey, 0) < PROFILE_RESENDS:
+            # Most likely a chunk was lost on the way, try again
+            resends[appKey] = resends.get(appKey, 0) + 1
+            macropadData.Metrics.Count("profileResends", device=macropadData.Serial)
+            SendProfile(macropadData, appKey, *hub.Profiles[appKey])
+    if "stats" in data:
+        print(f"MacroPad {macropadData.Serial}")
+        PrintDeviceStats(data["stats"])
+    if data.get("leds"):
+        PrintLedStats(data["leds"])
+
+async def PingDevices(hub: MacropadHub, interval=PING_INTERVAL):
+    """Send every MacroPad the time in microseconds, which it echoes back
+    as "pong" for IncomingHandler to time the round trip"""
+    while True:
+        await asyncio.sleep(interval)
+        for data in hub.Devices.values():
+            Send(data, {"ping": time.monotonic_ns() // 1000})
+
+async def RequestDeviceStats(hub: MacropadHub, interval: float):
+    """Ask every MacroPad for its coroutine timings every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        for data in hub.Devices.values():
+            Send(data, {"statsRequested": True})
+
+def PrintDeviceStats(stats) -> None:
+    """Print the coroutine timings reported by the MacroPad"""
+    if stats is None:
+        print("MacroPad task stats are off, set TASK_STATS in code.py")
+        return
+    print(f"{'task':<14}{'loops':>9}{'total ms':>11}{'avg us':>9}"
+          f"{'max us':>9}{'idle ms':>9}")
+    for name, iterations, totalUs, maxUs, sinceUs in stats:
+        average = totalUs // iterations if iterations else 0
+        since = "-" if sinceUs is None else sinceUs // 1000
+        print(f"{name:<14}{iterations:>9}{totalUs // 1000:>11}{average:>9}"
+              f"{maxUs:>9}{since:>9}")
+
+def PrintLedStats(leds) -> None:
+    """Print the LED frame rate the MacroPad managed since the last report"""
+    effect, fpsCap, frames, windowUs, drawUs, maxDrawUs = leds
+    fps = frames * 1000000 / windowUs if windowUs else 0
+    print(f"LEDs {effect or 'static'}: {fps:.1f} fps (cap {fpsCap}),"
+          f" draw avg {drawUs} us, max {maxDrawUs} us")
+
+def DeviceTasks(macropadData: MacropadData, hub: MacropadHub):
+    """(name, coroutine function) of the tasks that look after one
+    MacroPad"""
+    return [
+        ("Connection", lambda: OpenSerialConnection(macropadData, hub.DetectPorts)),
+        ("Reader", lambda: SerialRead(macropadData)),
+        ("Incoming", lambda: IncomingHandler(macropadData, hub)),
+        ("Writer", lambda: DeviceWriter(macropadData)),
+        ("Sync", lambda: DeviceSync(macropadData, hub)),
+        ("Acks", lambda: AckWatcher(macropadData)),
+    ]
 
-async def IncomingHandler(
-    macropadData: MacropadData, windowData: ActiveWindowData
+async def Supervise(macropadData: MacropadData, name: str, task) -> None:
+    """Run one of a MacroPad's tasks, starting it again when it fails.
+    Failures are logged with their traceback and counted as taskFailures.
+    Restarts back off exponentially up to RECONNECT_DELAY_MAX"""
+    delay = RECONNECT_DELAY_MIN
+    while True:
+        try:
+            await task()
+            return
+        except Exception:
+            macropadData.Metrics.Count("taskFailures", device=macropadData.Serial)
+            print(f"MacroPad {macropadData.Serial} {name} task failed, restarting it")
+            traceback.print_exc()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+def ServerTasks(
+    hub: MacropadHub,
+    activeWindowData: ActiveWindowData,
+    windowSource: WindowSource,
+    coalescer: FocusCoalescer,
+    idleSource=None,
+):
+    """Coroutines that make up the server, for main and the benchmarks"""
+    windowSource.Metrics = hub.Metrics
+    tasks = [
+        windowSource.Run(activeWindowData.Events),
+        hub.Run(),
+        GetActiveWindowData(activeWindowData, hub, coalescer),
+        PingDevices(hub),
+    ]
+    if hub.Publisher is not None:
+        tasks.append(hub.Publisher.Run())
+    if hub.Injector is not None:
+        tasks.append(RunInjections(hub))
+    if idleSource is not None:
+        tasks.append(WatchIdle(hub, idleSource))
+    return tasks
+
+async def PrintPublisherStats(
+    eventPublisher: publisher.EventPublisher, interval: float
 ):
     while True:
-        if macropadData.Incoming:
-            data = macropadData.Incoming
-            try:
-                if data['updateRequested']:
-                    windowData.WindowName = ""
-            except ValueError:
-                pass
-            macropadData.Incoming = ""
-        await asyncio.sleep(0.3)
+        await asyncio.sleep(interval)
+        stats = eventPublisher.Stats()
+        print("Publisher " + ", ".join(
+            f"{name} {value}" for name, value in stats.items()
+        ))
 
-async def main():
-    macropadData = MacropadData()
-    macropadData.Port = DetectPort()
+async def main(
+    rulesFile=RULES_FILE, settle=FOCUS_SETTLE_TIME, maxRate=FOCUS_MAX_RATE,
+    statsInterval=0, macroFolder=MACRO_FOLDER, publishUrl="", inject="auto",
+    metricsPort=0, metricsFile="", idle="auto", idleTimeout=IDLE_TIMEOUT
+):
     activeWindowData = ActiveWindowData()
-    await asyncio.gather(
-        IncomingHandler(macropadData, activeWindowData),
-        OpenSerialConnection(macropadData),
-        SerialRead(macropadData),
-        GetActiveWindowData(activeWindowData, macropadData),
+    eventPublisher = None
+    if publishUrl:
+        eventPublisher = publisher.EventPublisher(publisher.Backend(publishUrl))
+    textInjector = injector.SelectInjector(inject, activeWindowData.Platform)
+    if textInjector is None:
+        print("No text injector, MacroPads type host macros themselves")
+    try:
+        rules = CompileRules(LoadRules(rulesFile))
+    except ValueError as e:
+        print(f"Unable to use {rulesFile}: {e}")
+        return
+    hub = MacropadHub(
+        activeWindowData, rules,
+        eventPublisher=eventPublisher, textInjector=textInjector
+    )
+    coalescer = FocusCoalescer(settle, maxRate)
+    windowSource = SelectWindowSource(activeWindowData.Platform)
+    idleSource = SelectIdleSource(idle, activeWindowData.Platform, idleTimeout)
+    if idleSource is None:
+        print("No idle detection, MacroPads stay awake")
+    tasks = ServerTasks(
+        hub, activeWindowData, windowSource, coalescer, idleSource
     )
+    if statsInterval:
+        tasks.append(RequestDeviceStats(hub, statsInterval))
+        if eventPublisher is not None:
+            tasks.append(PrintPublisherStats(eventPublisher, statsInterval))
+    if macroFolder:
+        tasks.append(ProfileWatcher(hub, macroFolder).Run())
+    if metricsPort:
+        tasks.append(metrics.MetricsServer(hub.Metrics, metricsPort).Run())
+    if metricsFile:
+        tasks.append(metrics.WriteFilePeriodically(hub.Metrics, metricsFile))
+    await asyncio.gather(*tasks)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Send the focused window to connected MacroPads"
+    )
+    parser.add_argument(
+        "--rules", default=RULES_FILE,
+        help="JSON manifest of rules mapping windows to profiles"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=FOCUS_SETTLE_TIME,
+        help="Seconds focus has to stay put before the MacroPad is updated"
+    )
+    parser.add_argument(
+        "--max-rate", type=float, default=FOCUS_MAX_RATE,
+        help="Most MacroPad updates to send per second"
+    )
+    parser.add_argument(
+        "--stats", type=float, default=0, metavar="SECONDS",
+        help="Print the MacroPad's coroutine timings this often"
+    )
+    parser.add_argument(
+        "--macros", default=MACRO_FOLDER, metavar="FOLDER",
+        help="Send macro files edited in this folder straight to the MacroPads"
+    )
+    parser.add_argument(
+        "--no-watch", dest="macros", action="store_const", const="",
+        help="Don't watch for edited macro files"
+    )
+    parser.add_argument(
+        "--publish", default="", metavar="URL",
+        help="Publish focus, key and connection events to tcp://host:port"
+             " (JSON lines) or mqtt://host:port"
+    )
+    parser.add_argument(
+        "--inject", default="auto",
+        choices=("auto", "clipboard", "xdotool", "none"),
+        help="How to type the text of macros marked to run on the host"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=0, metavar="PORT",
+        help="Serve counters and latency histograms as JSON on localhost"
+    )
+    parser.add_argument(
+        "--metrics-file", default="", metavar="FILE",
+        help="Write counters and latency histograms to this JSON file every"
+             f" {metrics.METRICS_INTERVAL} seconds"
+    )
+    parser.add_argument(
+        "--idle", default="auto",
+        choices=("auto", "logind", "xprintidle", "mac", "none"),
+        help="How to tell the screen is locked or the user is away, which"
+             " puts the MacroPads to sleep"
+    )
+    parser.add_argument(
+        "--idle-timeout", type=float, default=IDLE_TIMEOUT, metavar="SECONDS",
+        help="Seconds without input before the user counts as away"
+    )
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(
+            args.rules, args.settle, args.max_rate, args.stats, args.macros,
+            args.publish, args.inject, args.metrics_port, args.metrics_file,
+            args.idle, args.idle_timeout
+        ))
     except KeyboardInterrupt:
         print("")
         print("Keyboard Interrupt")
@@ -0,0 +1,160 @@
+"""Round trips and bad input for the macro bundle in CIRCUITPY/bundle.py"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CIRCUITPY")
+)
+import bundle
+
+CODE = {
+    "name": "VS Code",
+    "appName": "Code",
+    "platform": "mac",
+    "macros": [
+        (0x004000, "Down", [81], {"repeat": True}),
+        (0x400000, "Save", [227, 22, -22, -227]),
+        None,
+        (0x000040, "Wait", [4, 0.25, -4]),
+        (0x202020, "Snippet", ["naïve " * 100], {"host": True}),
+        (0x000000, "Empty", []),
+    ],
+    "encoder": {
+        "action": "keys", "increment": [227, 46], "decrement": [227, 45],
+        "accelerate": False,
+    },
+}
+DEFAULT = {
+    "name": "Default",
+    "appName": "Default",
+    "platform": "mac",
+    "macros": [(0xFFFFFF, "Text", "hello")],
+}
+
+def Expected(app: dict, version=bundle.BUNDLE_VERSION) -> dict:
+    """app the way UnpackProfile returns it"""
+    macros = []
+    for macro in list(app["macros"]) + [None] * (bundle.SLOT_COUNT - len(app["macros"])):
+        if macro is None:
+            macros.append(None)
+            continue
+        color, label, sequence = macro[:3]
+        if isinstance(sequence, str):
+            sequence = [sequence]
+        if len(macro) > 3:
+            options = {"repeat": False, "host": False}
+            options.update(macro[3])
+            macros.append((color, label, sequence, options))
+        else:
+            macros.append((color, label, sequence))
+    expected = {
+        "name": app["name"],
+        "appName": app["appName"],
+        "platform": app["platform"],
+        "macros": macros,
+    }
+    if version >= 2:
+        expected["encoder"] = app.get("encoder")
+    return expected
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "macros.bin")
+        self.readers = []
+
+    def tearDown(self):
+        for reader in self.readers:
+            reader.file.close()
+        self.directory.cleanup()
+
+    def Read(self, data: bytes) -> bundle.BundleReader:
+        with open(self.path, "wb") as output:
+            output.write(data)
+        reader = bundle.BundleReader(self.path)
+        self.readers.append(reader)
+        return reader
+
+    def testRoundTrip(self):
+        reader = self.Read(
+            bundle.PackBundle([("mac-Code", CODE), ("mac-Default", DEFAULT)])
+        )
+        self.assertEqual(list(reader.index), ["mac-Code", "mac-Default"])
+        self.assertEqual(reader.Read("mac-Code"), Expected(CODE))
+        self.assertEqual(reader.Read("mac-Default"), Expected(DEFAULT))
+
+    def testVersion1(self):
+        # Version 1 records end without an encoder
+        packProfile = bundle.PackProfile
+        with mock.patch.object(bundle, "BUNDLE_VERSION", 1), \
+                mock.patch.object(bundle, "PackProfile",
+                                  lambda app: packProfile(app)[:-4]):
+            data = bundle.PackBundle([("mac-Default", DEFAULT)])
+        reader = self.Read(data)
+        self.assertEqual(reader.version, 1)
+        self.assertEqual(reader.Read("mac-Default"), Expected(DEFAULT, 1))
+
+    def testBadHeader(self):
+        data = bundle.PackBundle([("mac-Default", DEFAULT)])
+        for bad in (b"XXXX" + data[4:], data[:4] + bytes([99]) + data[5:]):
+            with open(self.path, "wb") as output:
+                output.write(bad)
+            with self.assertRaises(ValueError):
+                bundle.BundleReader(self.path)
+
+    def testUnknownOp(self):
+        with self.assertRaises(ValueError):
+            bundle.UnpackSequence(bytes([1, 99, 0]), 0)
+
+class PackTest(unittest.TestCase):
+    def testSequence(self):
+        sequence = [4, -4, 0.5, "text"]
+        self.assertEqual(
+            bundle.UnpackSequence(bundle.PackSequence(sequence), 0)[0], sequence
+        )
+
+    def testBadSequence(self):
+        for sequence, error in (
+            ([True], TypeError),
+            ([0], ValueError),
+            ([256], ValueError),
+            ([-1.0], ValueError),
+            ([70.0], ValueError),
+            ([object()], TypeError),
+            ([4] * 256, ValueError),
+        ):
+            with self.assertRaises(error):
+                bundle.PackSequence(sequence)
+
+    def testLongLabel(self):
+        app = dict(DEFAULT, macros=[(0, "x" * 256, [])])
+        with self.assertRaises(ValueError):
+            bundle.PackProfile(app)
+
+    def testEncoder(self):
+        for encoder in (None, {"action": "volume"}, CODE["encoder"]):
+            data = bundle.PackEncoder(encoder)
+            unpacked, end = bundle.UnpackEncoder(data, 0)
+            self.assertEqual(end, len(data))
+            if encoder is None:
+                self.assertIsNone(unpacked)
+            else:
+                self.assertEqual(unpacked["action"], encoder["action"])
+                self.assertEqual(unpacked["increment"], encoder.get("increment", []))
+                self.assertEqual(
+                    unpacked["accelerate"], encoder.get("accelerate", True)
+                )
+
+    def testBadEncoder(self):
+        with self.assertRaises(ValueError):
+            bundle.PackEncoder({"action": "spin"})
+        with self.assertRaises(ValueError):
+            bundle.PackKeys([4] * 7)
+        with self.assertRaises(ValueError):
+            bundle.PackKeys([True])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Settling and rate limiting of focus changes by server.FocusCoalescer"""
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+class FocusCoalescerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.queue = asyncio.Queue()
+
+    async def Focus(self, names, interval=0.0):
+        for name in names:
+            self.queue.put_nowait(server.WindowEvent(name))
+            await asyncio.sleep(interval)
+
+    async def testSingleEventSettles(self):
+        coalescer = server.FocusCoalescer(settle=0.05, maxRate=0, maxHold=1)
+        self.queue.put_nowait(server.WindowEvent("Code"))
+        start = time.monotonic()
+        event = await coalescer.Next(self.queue)
+        self.assertEqual(event.Name, "Code")
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertEqual((coalescer.Delivered, coalescer.Suppressed), (1, 0))
+
+    async def testBurstDeliversNewest(self):
+        coalescer = server.FocusCoalescer(settle=0.1, maxRate=0, maxHold=1)
+        feeder = asyncio.ensure_future(
+            self.Focus(["Finder", "Terminal", "Firefox", "Code"], 0.01)
+        )
+        event = await coalescer.Next(self.queue)
+        await feeder
+        self.assertEqual(event.Name, "Code")
+        self.assertEqual((coalescer.Delivered, coalescer.Suppressed), (1, 3))
+        self.assertTrue(self.queue.empty())
+
+    async def testMaxHold(self):
+        # Focus that never settles still goes out after maxHold
+        coalescer = server.FocusCoalescer(settle=0.1, maxRate=0, maxHold=0.2)
+        feeder = asyncio.ensure_future(
+            self.Focus([f"App{i}" for i in range(30)], 0.03)
+        )
+        start = time.monotonic()
+        event = await coalescer.Next(self.queue)
+        held = time.monotonic() - start
+        feeder.cancel()
+        self.assertLess(held, 0.4)
+        self.assertNotEqual(event.Name, "App29")
+        self.assertEqual(coalescer.Suppressed, int(event.Name[3:]))
+
+    async def testMaxHoldIsAtLeastSettle(self):
+        coalescer = server.FocusCoalescer(settle=0.3, maxHold=0.1)
+        self.assertEqual(coalescer.MaxHold, 0.3)
+
+    async def testRateCap(self):
+        coalescer = server.FocusCoalescer(settle=0, maxRate=10, maxHold=0)
+        times = []
+        for name in ("Code", "Firefox", "Terminal"):
+            self.queue.put_nowait(server.WindowEvent(name))
+            event = await coalescer.Next(self.queue)
+            self.assertEqual(event.Name, name)
+            times.append(time.monotonic())
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, 0.09)
+        self.assertEqual((coalescer.Delivered, coalescer.Suppressed), (3, 0))
+
+    async def testNoCap(self):
+        coalescer = server.FocusCoalescer(settle=0, maxRate=0, maxHold=0)
+        start = time.monotonic()
+        for name in ("Code", "Firefox"):
+            self.queue.put_nowait(server.WindowEvent(name))
+            self.assertEqual((await coalescer.Next(self.queue)).Name, name)
+        self.assertLess(time.monotonic() - start, 0.05)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Telling the MacroPads the user is away, from the idle sources in
+server.py"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+class StubWriter:
+    def close(self):
+        pass
+
+class StubPublisher:
+    def __init__(self):
+        self.Events = []
+
+    def Publish(self, topic: str, payload: dict) -> None:
+        self.Events.append((topic, payload))
+
+class ScriptedIdleSource(server.IdleSource):
+    """Probe answers from a list, an exception in it is raised"""
+    def __init__(self, answers: list) -> None:
+        super().__init__(interval=0)
+        self.Answers = list(answers)
+
+    async def Probe(self) -> bool:
+        answer = self.Answers.pop(0) if self.Answers else None
+        if answer is None:
+            await asyncio.Event().wait()
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+class WatchIdleTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.publisher = StubPublisher()
+        self.hub = server.MacropadHub(
+            server.ActiveWindowData(), [], detectPorts=dict,
+            eventPublisher=self.publisher
+        )
+        self.pad = server.MacropadData("pad", registry=self.hub.Metrics)
+        self.hub.Devices["pad"] = self.pad
+        self.pad.SetConnected("/dev/null", None, StubWriter())
+
+    async def Watch(self, source) -> asyncio.Task:
+        task = asyncio.ensure_future(server.WatchIdle(self.hub, source))
+        await asyncio.sleep(0.01)
+        return task
+
+    def Sent(self) -> list:
+        return list(self.pad.Outbound.Messages.values())
+
+    async def testAwayAndBack(self):
+        source = server.FakeIdleSource()
+        task = await self.Watch(source)
+        source.Push(True)
+        await asyncio.sleep(0.01)
+        self.assertTrue(self.hub.Idle)
+        self.assertEqual(self.Sent(), [{"idle": True}])
+        source.Push(False)
+        await asyncio.sleep(0.01)
+        task.cancel()
+        self.assertFalse(self.hub.Idle)
+        # idle only keeps its newest value queued
+        self.assertEqual(self.Sent(), [{"idle": False}])
+        self.assertEqual(
+            [payload["idle"] for topic, payload in self.publisher.Events
+             if topic == "idle"],
+            [True, False]
+        )
+
+    async def testRepeatsIgnored(self):
+        source = server.FakeIdleSource()
+        task = await self.Watch(source)
+        source.Push(False)
+        source.Push(False)
+        await asyncio.sleep(0.01)
+        task.cancel()
+        self.assertEqual(self.Sent(), [])
+        self.assertNotIn("idleChanges", self.hub.Metrics.Counters)
+
+class IdleSourceTest(unittest.IsolatedAsyncioTestCase):
+    async def Changes(self, answers: list) -> list:
+        queue = asyncio.Queue()
+        task = asyncio.ensure_future(ScriptedIdleSource(answers).Run(queue))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        changes = []
+        while not queue.empty():
+            changes.append(queue.get_nowait())
+        return changes
+
+    async def testOnlyChanges(self):
+        self.assertEqual(
+            await self.Changes([False, False, True, True, False]),
+            [False, True, False]
+        )
+
+    async def testErrorsKeepTheLastAnswer(self):
+        self.assertEqual(
+            await self.Changes([True, OSError("gone"), ValueError("odd"), True]),
+            [True]
+        )
+
+    async def testAny(self):
+        source = server.AnyIdleSource([
+            ScriptedIdleSource([False, False]), ScriptedIdleSource([True, False])
+        ])
+        self.assertTrue(await source.Probe())
+        self.assertFalse(await source.Probe())
+
+class SelectIdleSourceTest(unittest.TestCase):
+    def testNone(self):
+        self.assertIsNone(server.SelectIdleSource("none", "linux"))
+
+    def testMac(self):
+        source = server.SelectIdleSource("mac", "mac", timeout=60)
+        self.assertIsInstance(source, server.MacIdleSource)
+        self.assertEqual(source.Timeout, 60)
+
+    def testNothingAvailable(self):
+        with mock.patch.object(server.shutil, "which", return_value=None):
+            self.assertIsNone(server.SelectIdleSource("auto", "linux"))
+
+if __name__ == "__main__":
+    unittest.main()
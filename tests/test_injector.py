@@ -0,0 +1,93 @@
+"""Typing text the MacroPad hands to the host, from server.py's chunk
+joining to the injector"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import injector
+import server
+
+class StubWriter:
+    def close(self):
+        pass
+
+class FailingInjector:
+    Name = "failing"
+
+    async def Inject(self, text: str) -> None:
+        raise OSError("no display")
+
+class InjectionTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.injector = injector.FakeInjector()
+        self.hub = server.MacropadHub(
+            server.ActiveWindowData(), [], detectPorts=dict,
+            textInjector=self.injector
+        )
+        self.pad = server.MacropadData("pad", registry=self.hub.Metrics)
+        self.pad.SetConnected("/dev/null", None, StubWriter())
+
+    def Receive(self, *chunks) -> None:
+        for chunk in chunks:
+            server.HandleMessage(self.pad, self.hub, {"inject": chunk})
+
+    async def Run(self) -> None:
+        task = asyncio.ensure_future(server.RunInjections(self.hub))
+        await asyncio.sleep(0.01)
+        task.cancel()
+
+    def Sent(self) -> list:
+        return list(self.pad.Outbound.Messages.values())
+
+    async def testChunksJoined(self):
+        self.Receive([1, 0, 3, "Dear "], [1, 1, 3, "Sir or "], [1, 2, 3, "Madam"])
+        await self.Run()
+        self.assertEqual(self.injector.Injected, ["Dear Sir or Madam"])
+        self.assertEqual(self.Sent(), [{"injected": 1}])
+
+    async def testInOrder(self):
+        self.Receive([1, 0, 1, "first"], [2, 0, 1, "second"])
+        await self.Run()
+        self.assertEqual(self.injector.Injected, ["first", "second"])
+        self.assertEqual(self.Sent(), [{"injected": 1}, {"injected": 2}])
+
+    async def testLostChunk(self):
+        self.Receive([1, 0, 3, "Dear "], [1, 2, 3, "Madam"], [2, 1, 2, "tail"])
+        await self.Run()
+        self.assertEqual(self.injector.Injected, [])
+        self.assertIsNone(self.pad.Injecting)
+
+    async def testBadChunk(self):
+        self.Receive(5, [1, 2], [1, 0, 1, None])
+        await self.Run()
+        self.assertEqual(self.injector.Injected, [])
+        self.assertEqual(self.hub.Metrics.Counters["parseErrors:pad"], 2)
+
+    async def testFailureStillAnswered(self):
+        # The pad's macro waits for "injected", it has to come either way
+        self.hub.Injector = FailingInjector()
+        self.Receive([7, 0, 1, "text"])
+        await self.Run()
+        self.assertEqual(self.Sent(), [{"injected": 7}])
+
+    async def testNoInjector(self):
+        self.hub.Injector = None
+        self.Receive([1, 0, 1, "text"])
+        self.assertTrue(self.hub.Injections.empty())
+
+class SelectInjectorTest(unittest.TestCase):
+    def testByName(self):
+        self.assertIsNone(injector.SelectInjector("none", "mac"))
+        self.assertIsInstance(
+            injector.SelectInjector("clipboard", "mac"), injector.ClipboardInjector
+        )
+
+    def testNothingAvailable(self):
+        with mock.patch.object(injector.shutil, "which", return_value=None):
+            self.assertIsNone(injector.SelectInjector("auto", "linux"))
+
+if __name__ == "__main__":
+    unittest.main()
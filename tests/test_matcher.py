@@ -0,0 +1,92 @@
+"""Resolving focused windows to profiles with server.ContextMatcher"""
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+RULES = [
+    {"owner": "Google Chrome", "title": "meet.google.com", "profile": "mac-Meet",
+     "priority": 10},
+    {"owner": "Google Chrome", "profile": "mac-Chrome"},
+    {"titlePattern": r"\bZoom Meeting\b", "profile": "mac-Zoom", "priority": 5},
+    {"ownerPattern": "^Microsoft ", "profile": "mac-Office"},
+    {"owner": "Code", "platform": "linux", "profile": "linux-VSCode"},
+    {"owner": "Terminal", "devices": ["padB"], "profile": "mac-Shell"},
+]
+
+class ContextMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.matcher = server.ContextMatcher(RULES, "mac")
+
+    def testOwnerAndTitle(self):
+        self.assertEqual(
+            self.matcher.Match("Google Chrome", "Standup - Meet.Google.com"),
+            "mac-Meet"
+        )
+        self.assertEqual(self.matcher.Match("Google Chrome", "News"), "mac-Chrome")
+
+    def testPriorityAcrossIndex(self):
+        # A pattern rule outranks the exact owner rule listed before it
+        self.assertEqual(
+            self.matcher.Match("Google Chrome", "Zoom Meeting"), "mac-Zoom"
+        )
+
+    def testTiesGoToFirstListed(self):
+        matcher = server.ContextMatcher([
+            {"ownerPattern": "Word", "profile": "mac-First"},
+            {"owner": "Microsoft Word", "profile": "mac-Second"},
+        ], "mac")
+        self.assertEqual(matcher.Match("Microsoft Word"), "mac-First")
+
+    def testOwnerIndex(self):
+        self.assertEqual(
+            [rule.Profile for rule in self.matcher.ByOwner["Google Chrome"]],
+            ["mac-Meet", "mac-Chrome"]
+        )
+        self.assertNotIn("Code", self.matcher.ByOwner)
+        self.assertEqual(
+            [rule.Profile for rule in self.matcher.Others],
+            ["mac-Zoom", "mac-Office"]
+        )
+
+    def testUnclaimedWindow(self):
+        self.assertEqual(self.matcher.Match("Finder", "Documents"), "mac-Finder")
+        self.assertEqual(self.matcher.Match("Code"), "mac-Code")
+        linux = server.ContextMatcher(RULES, "linux")
+        self.assertEqual(linux.Match("Code"), "linux-VSCode")
+
+    def testDevices(self):
+        self.assertEqual(self.matcher.Match("Terminal"), "mac-Terminal")
+        padB = server.ContextMatcher(RULES, "mac", device="padB")
+        self.assertEqual(padB.Match("Terminal"), "mac-Shell")
+
+    def testLeastRecentlyUsedDropped(self):
+        matcher = server.ContextMatcher(RULES, "mac", cacheSize=2)
+        matcher.Match("Finder")
+        matcher.Match("Code")
+        matcher.Match("Finder")
+        matcher.Match("Terminal")
+        self.assertEqual(
+            list(matcher.Cache), [("Finder", ""), ("Terminal", "")]
+        )
+        self.assertEqual(matcher.Cache[("Finder", "")], "mac-Finder")
+
+    def testCompiledOnce(self):
+        compiled = server.CompileRules(RULES)
+        matcher = server.ContextMatcher(compiled, "mac")
+        self.assertIs(matcher.ByOwner["Google Chrome"][0], compiled[0])
+
+    def testBadRules(self):
+        for rule in (
+            "mac-Code",
+            {"owner": "Code"},
+            {"owner": "Code", "profile": "Code"},
+            {"titlePattern": "(", "profile": "mac-Code"},
+        ):
+            with self.assertRaises(ValueError):
+                server.CompileRules([rule])
+
+if __name__ == "__main__":
+    unittest.main()
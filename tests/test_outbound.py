@@ -0,0 +1,78 @@
+"""Superseding and dropping in a MacroPad's server.OutboundQueue"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+import server
+
+class OutboundQueueTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.queue = server.OutboundQueue(4, self.registry, "pad")
+
+    async def Drain(self) -> list:
+        messages = []
+        while len(self.queue):
+            messages.append(await self.queue.Get())
+        return messages
+
+    async def testOrder(self):
+        messages = [{"profileChunk": {"part": part}} for part in range(3)]
+        for message in messages:
+            self.queue.Put(message)
+        self.assertEqual(await self.Drain(), messages)
+
+    async def testNewestStateSupersedes(self):
+        self.queue.Put({"profile": "mac-Code", "seq": 1})
+        self.queue.Put({"profileChunk": {"part": 0}})
+        self.queue.Put({"profile": "mac-Firefox", "seq": 2})
+        self.queue.Put({"idle": True})
+        self.queue.Put({"idle": False})
+        # The replacement goes to the back, behind what was queued meanwhile
+        self.assertEqual(await self.Drain(), [
+            {"profileChunk": {"part": 0}},
+            {"profile": "mac-Firefox", "seq": 2},
+            {"idle": False},
+        ])
+        self.assertEqual(self.registry.Counters["superseded:pad"], 2)
+
+    async def testFullDropsOldestChunk(self):
+        self.queue.Put({"profile": "mac-Code"})
+        for part in range(4):
+            self.queue.Put({"profileChunk": {"part": part}})
+        # State messages outlive chunks, the oldest chunk goes first
+        self.assertEqual(await self.Drain(), [
+            {"profile": "mac-Code"},
+            {"profileChunk": {"part": 1}},
+            {"profileChunk": {"part": 2}},
+            {"profileChunk": {"part": 3}},
+        ])
+        self.assertEqual(self.registry.Counters["outboundDropped:pad"], 1)
+
+    async def testFullOfStateDropsOldest(self):
+        for key in ("profile", "idle", "injector", "reportKeys", "ping"):
+            self.queue.Put({key: True})
+        self.assertEqual(
+            [list(message)[0] for message in await self.Drain()],
+            ["idle", "injector", "reportKeys", "ping"]
+        )
+
+    async def testGetWaits(self):
+        getter = asyncio.ensure_future(self.queue.Get())
+        await asyncio.sleep(0.01)
+        self.assertFalse(getter.done())
+        self.queue.Put({"ping": 1})
+        self.assertEqual(await asyncio.wait_for(getter, 1), {"ping": 1})
+
+    async def testClearCountsDropped(self):
+        self.queue.Put({"ping": 1})
+        self.queue.Put({"profileChunk": {"part": 0}})
+        self.queue.Clear()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.registry.Counters["outboundDropped:pad"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
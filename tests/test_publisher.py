@@ -0,0 +1,125 @@
+"""Queueing, batching and reconnecting in publisher.EventPublisher"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import publisher
+
+class FlakyBackend:
+    """Backend that can't connect `connectFailures` times and then fails
+    `sendFailures` sends"""
+    def __init__(self, connectFailures=0, sendFailures=0) -> None:
+        self.ConnectFailures = connectFailures
+        self.SendFailures = sendFailures
+        self.Connected = False
+        self.Batches = []
+
+    async def Connect(self) -> None:
+        if self.ConnectFailures:
+            self.ConnectFailures -= 1
+            raise ConnectionRefusedError("no broker")
+        self.Connected = True
+
+    async def Send(self, batch: list) -> None:
+        if self.SendFailures:
+            self.SendFailures -= 1
+            raise ConnectionResetError("broker went away")
+        self.Batches.append([event["n"] for event in batch])
+
+    def Close(self) -> None:
+        self.Connected = False
+
+class EventPublisherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        patcher = mock.patch.object(publisher, "RECONNECT_DELAY_MIN", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tasks = []
+
+    async def asyncTearDown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def Start(self, eventPublisher) -> None:
+        self.tasks.append(asyncio.ensure_future(eventPublisher.Run()))
+
+    async def Until(self, condition, timeout=2) -> None:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            if asyncio.get_running_loop().time() > deadline:
+                self.fail("timed out")
+            await asyncio.sleep(0.01)
+
+    def testDropsOldest(self):
+        eventPublisher = publisher.EventPublisher(FlakyBackend(), queueSize=3)
+        for n in range(5):
+            eventPublisher.Publish("focus", {"n": n})
+        self.assertEqual([event["n"] for event in eventPublisher.Queue], [2, 3, 4])
+        self.assertEqual(eventPublisher.Queue[0]["topic"], "macropad/focus")
+        stats = eventPublisher.Stats()
+        self.assertEqual((stats["dropped"], stats["maxDepth"]), (2, 3))
+
+    async def testBatches(self):
+        backend = FlakyBackend()
+        eventPublisher = publisher.EventPublisher(backend, batchSize=2, linger=0)
+        for n in range(5):
+            eventPublisher.Publish("key", {"n": n})
+        self.Start(eventPublisher)
+        await self.Until(lambda: eventPublisher.Published == 5)
+        self.assertEqual(backend.Batches, [[0, 1], [2, 3], [4]])
+
+    async def testRequeueOnFailure(self):
+        backend = FlakyBackend(sendFailures=2)
+        eventPublisher = publisher.EventPublisher(backend, batchSize=2, linger=0)
+        for n in range(3):
+            eventPublisher.Publish("key", {"n": n})
+        self.Start(eventPublisher)
+        await self.Until(lambda: eventPublisher.Published == 3)
+        # The failed batch went back on the front, nothing was reordered
+        self.assertEqual(backend.Batches, [[0, 1], [2]])
+        stats = eventPublisher.Stats()
+        self.assertEqual((stats["failures"], stats["connects"]), (2, 3))
+
+    async def testRequeueIntoFullQueue(self):
+        eventPublisher = publisher.EventPublisher(FlakyBackend(), queueSize=3)
+        eventPublisher.Publish("key", {"n": 3})
+        eventPublisher.Publish("key", {"n": 4})
+        eventPublisher._Requeue([{"n": 0}, {"n": 1}, {"n": 2}])
+        self.assertEqual([event["n"] for event in eventPublisher.Queue], [2, 3, 4])
+        self.assertEqual(eventPublisher.Dropped, 2)
+
+    async def testReconnect(self):
+        backend = FlakyBackend(connectFailures=3)
+        eventPublisher = publisher.EventPublisher(backend, linger=0)
+        eventPublisher.Publish("idle", {"n": 0})
+        self.Start(eventPublisher)
+        await self.Until(lambda: eventPublisher.Published == 1)
+        self.assertEqual(eventPublisher.Failures, 3)
+        self.assertEqual(eventPublisher.Connects, 1)
+
+    async def testLocalBroker(self):
+        broker = publisher.LocalBroker("127.0.0.1", 0)
+        await broker.Start()
+        self.addCleanup(broker.Stop)
+        backend = publisher.TcpJsonBackend("127.0.0.1", broker.Port)
+        eventPublisher = publisher.EventPublisher(backend, linger=0)
+        self.Start(eventPublisher)
+        eventPublisher.Publish("focus", {"profile": "mac-Code"})
+        await self.Until(lambda: broker.Received == 1)
+        # A dropped connection is opened again for the next event
+        backend.Close()
+        eventPublisher.Publish("key", {"key": 3})
+        await self.Until(lambda: broker.Received == 2)
+        self.assertEqual(
+            [event["topic"] for event in broker.Events],
+            ["macropad/focus", "macropad/key"]
+        )
+        self.assertEqual(broker.Events[0]["profile"], "mac-Code")
+        self.assertEqual(eventPublisher.Connects, 2)
+
+if __name__ == "__main__":
+    unittest.main()
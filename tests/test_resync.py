@@ -0,0 +1,198 @@
+"""Sequence numbers, acks and the digest resync between server.py and the
+MacroPad's code.py"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+import benchmark
+import bundle
+import server
+import wire
+
+class StubWriter:
+    """The writer half of a serial connection that is never written to"""
+    def close(self):
+        pass
+
+class StubSerial:
+    """usb_cdc.data that keeps what the MacroPad writes"""
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    def Messages(self) -> list:
+        return wire.FrameDecoder().Feed(self.data)
+
+def Focused(name: str, title: str = "") -> server.WindowEvent:
+    return server.WindowEvent(name, title)
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.windowData = server.ActiveWindowData()
+        self.windowData.Platform = "mac"
+        self.hub = server.MacropadHub(self.windowData, [], detectPorts=dict)
+        self.pad = server.MacropadData(
+            "pad", server.ContextMatcher([], "mac"), self.hub.Metrics
+        )
+        self.pad.SetConnected("/dev/null", None, StubWriter())
+
+    def Sent(self) -> list:
+        messages = list(self.pad.Outbound.Messages.values())
+        self.pad.Outbound.Messages.clear()
+        return messages
+
+    def Count(self, name: str) -> int:
+        return self.hub.Metrics.Counters.get(f"{name}:pad", 0)
+
+    def testNoSeqBeforeDigest(self):
+        server.SendFocus(self.pad, Focused("Code"))
+        self.assertEqual(self.Sent(), [{"profile": "mac-Code"}])
+        self.assertIsNone(self.pad.Pending)
+
+    def testSeqAndAck(self):
+        server.HandleMessage(self.pad, self.hub, {"digest": {}})
+        server.SendFocus(self.pad, Focused("Code"))
+        server.SendFocus(self.pad, Focused("Firefox"))
+        self.assertEqual(
+            self.Sent(), [{"profile": "mac-Firefox", "seq": 2}]
+        )
+        server.HandleMessage(self.pad, self.hub, {"ack": 1})
+        self.assertEqual(self.pad.Pending[0], 2)
+        server.HandleMessage(self.pad, self.hub, {"ack": 2})
+        self.assertIsNone(self.pad.Pending)
+
+    def testSameProfileNotResent(self):
+        server.SendFocus(self.pad, Focused("Code"))
+        server.SendFocus(self.pad, Focused("Code", "other file"))
+        self.assertEqual(len(self.Sent()), 1)
+
+    def testReconnectStartsOver(self):
+        server.HandleMessage(self.pad, self.hub, {"digest": {}})
+        server.SendFocus(self.pad, Focused("Code"))
+        self.pad.SetDisconnected("test")
+        self.pad.SetConnected("/dev/null", None, StubWriter())
+        self.assertEqual((self.pad.Seq, self.pad.Acks), (0, False))
+        self.assertIsNone(self.pad.Pending)
+        self.assertEqual(self.Sent(), [])
+
+    async def testOnlyNewestResent(self):
+        server.HandleMessage(self.pad, self.hub, {"digest": {}})
+        with mock.patch.object(server, "ACK_TIMEOUT", 0.01):
+            watcher = asyncio.ensure_future(server.AckWatcher(self.pad))
+            server.SendFocus(self.pad, Focused("Code"))
+            server.SendFocus(self.pad, Focused("Firefox"))
+            self.Sent()
+            await asyncio.sleep(0.05)
+            resent = self.Sent()
+            server.HandleMessage(self.pad, self.hub, {"ack": 2})
+            await asyncio.sleep(0.05)
+            watcher.cancel()
+        self.assertEqual(resent, [{"profile": "mac-Firefox", "seq": 2}])
+        self.assertGreater(self.Count("resends"), 0)
+        self.assertEqual(self.Sent(), [])
+
+    def testMatchingDigest(self):
+        record = bundle.PackProfile({"macros": []})
+        self.hub.Profiles["mac-Code"] = (["mac", "Code", "Code"], record)
+        self.windowData.LastEvent = Focused("Code")
+        server.Resync(self.pad, self.hub, {
+            "profile": "mac-Code",
+            "profiles": {"mac-Code": wire.Checksum(record)},
+            "reportKeys": False,
+            "injector": None,
+            "idle": False,
+        })
+        self.assertEqual(self.Sent(), [])
+        self.assertEqual(self.pad.Profile, "mac-Code")
+        self.assertEqual(self.Count("resyncSent"), 0)
+
+    def testDifferingDigest(self):
+        record = bundle.PackProfile({"macros": []})
+        self.hub.Profiles["mac-Code"] = (["mac", "Code", "Code"], record)
+        self.windowData.LastEvent = Focused("Code")
+        self.hub.Idle = True
+        server.HandleMessage(self.pad, self.hub, {"digest": {
+            "profile": "mac-Firefox",
+            "profiles": {"mac-Code": wire.Checksum(record) ^ 1},
+            "reportKeys": False,
+            "injector": None,
+            "idle": False,
+        }})
+        server.Resync(self.pad, self.hub, self.pad.Digest)
+        sent = self.Sent()
+        self.assertIn({"idle": True}, sent)
+        self.assertIn({"profile": "mac-Code", "seq": 1}, sent)
+        self.assertEqual(
+            [m["profileChunk"]["key"] for m in sent if "profileChunk" in m],
+            ["mac-Code"]
+        )
+        self.assertNotIn({"reportKeys": False}, sent)
+
+    def testNoDigestSendsEverything(self):
+        self.windowData.LastEvent = Focused("Code")
+        server.Resync(self.pad, self.hub, None)
+        self.assertEqual(self.Sent(), [
+            {"reportKeys": False}, {"injector": None}, {"profile": "mac-Code"},
+        ])
+
+    def testBadDigest(self):
+        with self.assertRaises(ValueError):
+            server.HandleMessage(self.pad, self.hub, {"digest": {"profiles": []}})
+        self.assertFalse(self.pad.Acks)
+
+class DeviceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.read, cls.write = os.pipe()
+        benchmark.InstallDeviceModules(benchmark.PtySerial(cls.read))
+        cls.device = benchmark.LoadDeviceCode()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.close(cls.read)
+        os.close(cls.write)
+
+    def setUp(self):
+        self.data = self.device.ServerData()
+        self.serial = StubSerial()
+
+    def Receive(self, message: dict) -> None:
+        self.device.HandleServerMessage(message, self.data, self.serial)
+
+    def testAppliesNewer(self):
+        self.Receive({"profile": "mac-Code", "seq": 1})
+        self.Receive({"profile": "mac-Firefox", "seq": 3})
+        self.assertEqual(self.data.profile, "mac-Firefox")
+        self.assertEqual(self.serial.Messages(), [{"ack": 1}, {"ack": 3}])
+
+    def testSkipsRepeats(self):
+        self.Receive({"profile": "mac-Firefox", "seq": 2})
+        self.Receive({"profile": "mac-Code", "seq": 1})
+        self.Receive({"profile": "mac-Code", "seq": 2})
+        self.assertEqual(self.data.profile, "mac-Firefox")
+        # Repeats are acked all the same, the first ack may have been lost
+        self.assertEqual(
+            self.serial.Messages(), [{"ack": 2}, {"ack": 1}, {"ack": 2}]
+        )
+
+    def testDigestRequestStartsOver(self):
+        self.Receive({"profile": "mac-Firefox", "seq": 5})
+        self.Receive({"digestRequested": True, "version": "2"})
+        self.assertEqual(self.data.seq, 0)
+        self.assertTrue(self.data.digestEvent.is_set())
+        self.Receive({"profile": "mac-Code", "seq": 1})
+        self.assertEqual(self.data.profile, "mac-Code")
+
+    def testUnnumbered(self):
+        self.Receive({"profile": "mac-Code"})
+        self.assertEqual(self.data.profile, "mac-Code")
+        self.assertEqual(self.serial.Messages(), [])
+
+if __name__ == "__main__":
+    unittest.main()
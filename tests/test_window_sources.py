@@ -0,0 +1,71 @@
+"""Focus events from the window sources in server.py"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+def Windows(queue: asyncio.Queue) -> list:
+    windows = []
+    while not queue.empty():
+        event = queue.get_nowait()
+        windows.append((event.Name, event.Title))
+    return windows
+
+class FakeWindowSourceTest(unittest.IsolatedAsyncioTestCase):
+    async def testScript(self):
+        source = server.FakeWindowSource([
+            (0, "Code", "server.py"), (0.01, "Firefox"), (0, "Code"),
+        ])
+        queue = asyncio.Queue()
+        await source.Run(queue)
+        self.assertEqual(
+            Windows(queue),
+            [("Code", "server.py"), ("Firefox", ""), ("Code", "")]
+        )
+
+    async def testPush(self):
+        source = server.FakeWindowSource()
+        queue = asyncio.Queue()
+        await source.Run(queue)
+        event = source.Push("Terminal", "zsh")
+        self.assertIs(queue.get_nowait(), event)
+
+class PollingWindowSourceTest(unittest.IsolatedAsyncioTestCase):
+    async def testOnlyChanges(self):
+        source = server.PollingWindowSource("linux", interval=0)
+        probes = iter([
+            ("Code", "a.py"), ("Code", "a.py"), ("Code", "b.py"), ("Firefox", ""),
+        ])
+        queue = asyncio.Queue()
+        with mock.patch.object(source, "Probe", lambda: next(probes)):
+            with self.assertRaises(RuntimeError):
+                # next() runs out once every probe was used
+                await source.Run(queue)
+        self.assertEqual(
+            Windows(queue), [("Code", "a.py"), ("Code", "b.py"), ("Firefox", "")]
+        )
+
+class SelectWindowSourceTest(unittest.TestCase):
+    def testFallback(self):
+        with mock.patch.object(
+            server.XpropWindowSource, "Available", return_value=False
+        ):
+            source = server.SelectWindowSource("linux")
+        self.assertIsInstance(source, server.PollingWindowSource)
+        self.assertIsInstance(
+            server.SelectWindowSource("mac"), server.PollingWindowSource
+        )
+
+    def testXprop(self):
+        with mock.patch.object(
+            server.XpropWindowSource, "Available", return_value=True
+        ):
+            source = server.SelectWindowSource("linux")
+        self.assertIsInstance(source, server.XpropWindowSource)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+"""Round trips and corrupt input for the wire format in CIRCUITPY/wire.py"""
+import os
+import sys
+import unittest
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CIRCUITPY")
+)
+import wire
+
+class EncodeTest(unittest.TestCase):
+    def testRoundTrip(self):
+        values = [
+            None, True, False, 0, 127, 128, -1, 2 ** 40, 0.5,
+            "", "short", "x" * 300, "naïve ✓", "profile", b"\x00\xff" * 10,
+            [1, [2, "three"], {"key": None}],
+            {"profile": "mac-Code", "seq": 7, "inject": [1, 0, 1, "text"]},
+        ]
+        for value in values:
+            data = wire.Encode(value)
+            self.assertEqual(wire.Decode(data), (value, len(data)))
+
+    def testKeysAreOneByte(self):
+        self.assertEqual(len(wire.Encode("profile")), 2)
+
+    def testUnknownTag(self):
+        with self.assertRaises(ValueError):
+            wire.Decode(bytes([0x7F]))
+
+    def testCantEncode(self):
+        with self.assertRaises(TypeError):
+            wire.Encode(object())
+
+    def testTooLarge(self):
+        with self.assertRaises(ValueError):
+            wire.Frame({"data": b"x" * wire.MAX_PAYLOAD})
+
+class FrameDecoderTest(unittest.TestCase):
+    MESSAGES = [
+        {"profile": "mac-Code", "seq": 1},
+        {"inject": [3, 0, 1, "hello"]},
+        {"digest": {"profiles": {"mac-Firefox": 1234}}, "version": "2"},
+    ]
+
+    def Stream(self, version=2) -> bytes:
+        return b"".join(wire.Pack(message, version) for message in self.MESSAGES)
+
+    def testFramesAndJson(self):
+        for version in (1, 2):
+            decoder = wire.FrameDecoder()
+            self.assertEqual(decoder.Feed(self.Stream(version)), self.MESSAGES)
+            self.assertEqual(decoder.errors, 0)
+
+    def testMixedProtocols(self):
+        decoder = wire.FrameDecoder()
+        data = wire.Pack(self.MESSAGES[0], 1) + wire.Pack(self.MESSAGES[1], 2)
+        self.assertEqual(decoder.Feed(data), self.MESSAGES[:2])
+
+    def testByteAtATime(self):
+        for version in (1, 2):
+            decoder = wire.FrameDecoder()
+            messages = []
+            for byte in self.Stream(version):
+                messages.extend(decoder.Feed(bytes([byte])))
+            self.assertEqual(messages, self.MESSAGES)
+
+    def testWrapAround(self):
+        # A small ring, so frames keep crossing its end
+        decoder = wire.FrameDecoder(64)
+        frame = wire.Frame({"profile": "mac-Code", "seq": 1})
+        messages = []
+        for _ in range(50):
+            messages.extend(decoder.Feed(frame[:5]))
+            messages.extend(decoder.Feed(frame[5:]))
+        self.assertEqual(messages, [{"profile": "mac-Code", "seq": 1}] * 50)
+        self.assertEqual(decoder.errors, 0)
+
+    def testReadFromWrapsAround(self):
+        class Stream:
+            def __init__(self, data):
+                self.data = bytearray(data)
+
+            @property
+            def in_waiting(self):
+                return len(self.data)
+
+            def readinto(self, buffer):
+                size = min(len(buffer), len(self.data))
+                buffer[:size] = self.data[:size]
+                del self.data[:size]
+                return size
+
+        decoder = wire.FrameDecoder(64)
+        frame = wire.Frame({"profile": "mac-Code"})
+        stream = Stream(frame * 20)
+        messages = []
+        while stream.in_waiting:
+            decoder.ReadFrom(stream)
+            message = decoder.Next()
+            while message is not None:
+                messages.append(message)
+                message = decoder.Next()
+        self.assertEqual(messages, [{"profile": "mac-Code"}] * 20)
+
+    def testBadChecksum(self):
+        frame = bytearray(wire.Frame(self.MESSAGES[0]))
+        frame[wire.HEADER_SIZE] ^= 0xFF
+        decoder = wire.FrameDecoder()
+        messages = decoder.Feed(bytes(frame) + wire.Frame(self.MESSAGES[1]))
+        self.assertEqual(messages, [self.MESSAGES[1]])
+        self.assertGreater(decoder.errors, 0)
+
+    def testTruncatedFrame(self):
+        # The rest of a frame was lost, the next one must still come through
+        frame = wire.Frame(self.MESSAGES[0])
+        decoder = wire.FrameDecoder()
+        messages = decoder.Feed(frame[:-3] + wire.Frame(self.MESSAGES[1]) * 2)
+        self.assertIn(self.MESSAGES[1], messages)
+
+    def testBadLength(self):
+        bogus = bytes([wire.FRAME_START, wire.PROTOCOL_VERSION, 0xFF, 0xFF])
+        decoder = wire.FrameDecoder()
+        messages = decoder.Feed(bogus + wire.Frame(self.MESSAGES[0]))
+        self.assertEqual(messages, [self.MESSAGES[0]])
+        self.assertGreater(decoder.errors, 0)
+
+    def testBadPayload(self):
+        # Checksums match but the payloads aren't whole values
+        payloads = [
+            bytes([0x7F]),
+            bytes([wire.TAG_INT, 1, 2]),
+            bytes([wire.TAG_STR, 0, 9]) + b"ab",
+            bytes([wire.TAG_SHORT_STR, 5]) + b"ab",
+            bytes([wire.TAG_LIST, 0, 3, 1]),
+            bytes([wire.TAG_KEY, 0xFF]),
+        ]
+        for payload in payloads:
+            frame = (
+                bytes([wire.FRAME_START, wire.PROTOCOL_VERSION, 0, len(payload)])
+                + payload
+                + wire.Checksum(payload).to_bytes(2, "big")
+            )
+            decoder = wire.FrameDecoder()
+            self.assertEqual(
+                decoder.Feed(frame + wire.Frame(self.MESSAGES[0])),
+                [self.MESSAGES[0]]
+            )
+            self.assertEqual(decoder.errors, 1)
+
+    def testBadJsonAndNoise(self):
+        decoder = wire.FrameDecoder()
+        data = b"\r\n  {not json}\n" + wire.Pack(self.MESSAGES[0], 1)
+        self.assertEqual(decoder.Feed(data), [self.MESSAGES[0]])
+        self.assertEqual(decoder.errors, 1)
+
+    def testOverflow(self):
+        # A line longer than the ring is dropped, what follows still decodes
+        decoder = wire.FrameDecoder(64)
+        data = b'{"name": "' + b"x" * 200 + b'"}\n' + wire.Frame(self.MESSAGES[0])
+        self.assertEqual(decoder.Feed(data), [self.MESSAGES[0]])
+        self.assertGreater(decoder.errors, 0)
+
+if __name__ == "__main__":
+    unittest.main()